@@ -0,0 +1,167 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest as ut
+import numpy as np
+from PyQt4.QtCore import QRectF
+from PyQt4.QtGui import QImage
+from qimage2ndarray import byte_view
+
+from volumina.diskcache import DiskTileStore
+from volumina.tiling import TileProvider, Tiling
+from volumina.layerstack import LayerStackModel
+from volumina.layer import GrayscaleLayer
+from volumina.pixelpipeline.datasources import ArraySource
+from volumina.pixelpipeline.imagepump import ImagePump
+from volumina.slicingtools import SliceProjection
+
+def _image( value ):
+    img = QImage(10, 10, QImage.Format_ARGB32_Premultiplied)
+    img.fill(value)
+    return img
+
+class DiskTileStoreTest( ut.TestCase ):
+    def setUp( self ):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown( self ):
+        # discarded tiles may be removed by a background thread meanwhile
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def testStoreAndLoad( self ):
+        store = DiskTileStore(self.directory, 2**20)
+        key = store.key( ('layer', 1), (0, 0) )
+        self.assertEqual( store.request( key, None ), None )
+        store.put( key, _image(0xff102030) )
+        self.assertEqual( store.load( key ).pixel(5, 5), 0xff102030 )
+
+        # found again by later sessions
+        store = DiskTileStore(self.directory, 2**20)
+        self.assertEqual( len(store), 1 )
+        key = store.key( ('layer', 1), (0, 0) )
+        self.assertEqual( store.request( key, None ).wait().pixel(5, 5), 0xff102030 )
+        self.assertEqual( store.load( store.key( ('layer', 2), (0, 0) ) ), None )
+
+    def testLeastRecentlyUsedAreEvicted( self ):
+        store = DiskTileStore(self.directory, 2**20)
+        keys = [store.key( ('layer', 1), i ) for i in range(3)]
+        for key in keys:
+            store.put( key, _image(0) )
+        tileBytes = store.nbytes // 3
+        store.maxbytes = 2 * tileBytes
+        store.load( keys[0] )
+        store.put( store.key( ('layer', 1), 3 ), _image(0) )
+        self.assertEqual( len(store), 2 )
+        self.assertNotEqual( store.load( keys[0] ), None )
+        self.assertEqual( store.load( keys[1] ), None )
+
+    def testDiscard( self ):
+        store = DiskTileStore(self.directory, 2**20)
+        key = store.key( ('layer', 1), 0 )
+        store.put( key, _image(0) )
+        store.discard( ('layer', 1) )
+        self.assertEqual( store.load( key ), None )
+        self.assertEqual( store.nbytes, 0 )
+        # rendered before the layer was dirty: outdated
+        store.put( key, _image(0) )
+        self.assertEqual( len(store), 0 )
+
+    def testPartialDiscard( self ):
+        store = DiskTileStore(self.directory, 2**20)
+        layer = ('layer', 1)
+        keys = [store.key( layer, i, ('xy', (100*i, 0, 100, 100)) ) for i in range(2)]
+        other = store.key( layer, 2, ('xz', (0, 0, 100, 100)) )
+        for key in keys + [other]:
+            store.put( key, _image(0) )
+        # only the tiles overlapping the region, in its plane
+        store.discard( layer, ('xy', (150, 50, 10, 10)) )
+        self.assertNotEqual( store.load( keys[0] ), None )
+        self.assertEqual( store.load( keys[1] ), None )
+        self.assertNotEqual( store.load( other ), None )
+        # rendered while another region became dirty
+        key = store.key( layer, 3, ('xy', (0, 100, 100, 100)) )
+        store.discard( layer, ('xy', (150, 50, 10, 10)) )
+        store.put( key, _image(0) )
+        self.assertNotEqual( store.load( key ), None )
+
+        # the regions are found again by later sessions
+        store = DiskTileStore(self.directory, 2**20)
+        self.assertEqual( len(store), 3 )
+        store.load( store.key( layer, 0, ('xy', (0, 0, 100, 100)) ) )
+        store.discard( layer, ('xy', (50, 150, 10, 10)) )
+        self.assertEqual( len(store), 2 )
+
+    def testDirtyBeforeUse( self ):
+        store = DiskTileStore(self.directory, 2**20)
+        store.put( store.key( ('layer', 1), 0 ), _image(0) )
+        # a later session sets up the layer
+        store = DiskTileStore(self.directory, 2**20)
+        store.discard( ('layer', 1) )
+        key = store.key( ('layer', 1), 0 )
+        self.assertNotEqual( store.load( key ), None )
+        # the tiles are in use now
+        store.discard( ('layer', 1) )
+        self.assertEqual( store.load( key ), None )
+
+    def testDiscardedFilesAreRemoved( self ):
+        store = DiskTileStore(self.directory, 2**20)
+        key = store.key( ('layer', 1), 0 )
+        store.put( key, _image(0) )
+        store.discard( ('layer', 1) )
+        # by a background thread
+        for i in range(100):
+            if not os.listdir(self.directory):
+                break
+            time.sleep(0.05)
+        self.assertEqual( os.listdir(self.directory), [] )
+        store.put( store.key( ('layer', 1), 0 ), _image(0) )
+        self.assertEqual( len(DiskTileStore(self.directory, 2**20)), 1 )
+
+    def testSliceKey( self ):
+        data = np.zeros((1,10,10,10,1), dtype=np.uint8)
+        keys = set()
+        for projection in (SliceProjection(1, 2, [0,3,4]), SliceProjection(1, 3, [0,2,4])):
+            lsm = LayerStackModel()
+            pump = ImagePump( lsm, projection, sync_along=(0,) )
+            layer = GrayscaleLayer( ArraySource( data ) )
+            lsm.append( layer )
+            ims = pump.stackedImageSources.getImageSource(0)
+            keys.add( ims.sliceKey( ((0, 0),) ) )
+            # a position that is not synchronized, e.g. the channel
+            for source in pump.layerToSliceSources( layer ):
+                source.setThrough(2, 1)
+            keys.add( ims.sliceKey( ((0, 0),) ) )
+        # different for other views and slices
+        self.assertEqual( len(keys), 4 )
+
+    def testTileProvider( self ):
+        store = DiskTileStore(self.directory, 2**20)
+        data = np.zeros((1,100,100,1,1), dtype=np.uint8)
+        data[0,:,:,0,0] = 7
+        rect = QRectF(0,0,100,100)
+        tiles = []
+        for i in range(2):
+            layer = GrayscaleLayer( ArraySource( data ), normalize=False )
+            layer.cacheVersion = 1
+            lsm = LayerStackModel()
+            pump = ImagePump( lsm, SliceProjection() )
+            lsm.append( layer )
+            tp = TileProvider(Tiling((100,100), blockSize=50),
+                              pump.stackedImageSources, disk_store=store)
+            try:
+                tp.requestRefresh(rect)
+                tp.join()
+                tiles.append( [byte_view(tile.qimg).copy() for tile in tp.getTiles(rect)] )
+            finally:
+                tp.notifyThreadsToStop()
+                tp.joinThreads()
+            self.assertEqual( len(store), 4 )
+            # the second provider reads the tiles from disk
+            data[0,:,:,0,0] = 9
+        for a, b in zip(*tiles):
+            self.assertTrue( np.all(a == b) )
+            self.assertTrue( np.all(a[:,:,0:3] == 7) )
+
+if __name__ == '__main__':
+    ut.main()
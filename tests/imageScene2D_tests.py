@@ -1,6 +1,7 @@
 import unittest as ut
 import os
 
+from PyQt4.QtCore import QRectF
 from PyQt4.QtGui import QImage, QPainter, QApplication
 
 from qimage2ndarray import byte_view
@@ -103,5 +104,19 @@ class ImageScene2D_RenderTest( ut.TestCase ):
         self.assertTrue(np.all(aimg[:,:,0:3] == self.GRAY))
         self.assertTrue(np.all(aimg[:,:,3] == 255))
 
+    def testTileProgressOfCoarserLevels( self ):
+        self.scene.setLevelOfDetailEnabled(True)
+        self.scene.showTileProgress = True
+        img = QImage(78,73,QImage.Format_ARGB32_Premultiplied)
+        img.fill(0)
+        p = QPainter(img)
+        # zoomed out: the tiles of a coarser level are drawn
+        target, source = QRectF(0,0,78,73), QRectF(0,0,310,290)
+        self.scene.render(p, target, source)
+        self.scene.joinRendering()
+        self.scene.render(p, target, source)
+        p.end()
+        self.assertTrue(np.all(self.scene._dirtyIndicator._indicate == 1.0))
+
 if __name__ == '__main__':
     ut.main()
@@ -7,7 +7,7 @@ from volumina.layer import GrayscaleLayer
 from volumina.slicingtools import SliceProjection
 from volumina.pixelpipeline.datasources import ConstantSource
 from volumina.pixelpipeline.imagesources import GrayscaleImageSource
-from volumina.pixelpipeline.imagepump import StackedImageSources, ImagePump
+from volumina.pixelpipeline.imagepump import StackedImageSources, ImagePump, coalesceRects
 
 
 
@@ -177,6 +177,56 @@ class StackedImageSourcesTest( ut.TestCase ):
 
 
 
+    def testDirtyNotificationsAreCoalesced( self ):
+        lsm = LayerStackModel()
+        sims = StackedImageSources( lsm )
+        lsm.append(self.layer2)
+        sims.register( self.layer2, self.ims2 )
+        dirty = []
+        sims.layerDirty.connect( lambda ims, rect: dirty.append(rect) )
+
+        # the first one is passed on right away
+        self.ims2.setDirty((slice(0,10), slice(0,10)))
+        self.assertEqual( dirty, [QRect(0,0,10,10)] )
+        # a burst is merged
+        for i in range(10):
+            self.ims2.setDirty((slice(0,10), slice(i,i+1)))
+            self.ims2.setDirty((slice(50,60), slice(0,10)))
+        self.assertEqual( len(dirty), 1 )
+        sims.flushDirty()
+        self.assertEqual( sorted(dirty[1:], key=QRect.x), [QRect(0,0,10,10), QRect(50,0,10,10)] )
+        # duplicate whole image notifications collapse into one
+        del dirty[:]
+        self.ims2.setDirty((slice(None), slice(None)))
+        self.ims2.setDirty((slice(0,10), slice(0,10)))
+        self.ims2.setDirty((slice(None), slice(None)))
+        sims.flushDirty()
+        self.assertEqual( dirty, [QRect()] )
+
+    def testPendingDirtyOfDeregisteredSources( self ):
+        lsm = LayerStackModel()
+        sims = StackedImageSources( lsm )
+        lsm.append(self.layer2)
+        sims.register( self.layer2, self.ims2 )
+        dirty = []
+        sims.layerDirty.connect( lambda ims, rect: dirty.append(rect) )
+        self.ims2.setDirty((slice(0,10), slice(0,10)))
+        # a long burst stays within maxRects while it is collected
+        for i in range(100):
+            self.ims2.setDirty((slice(3*i,3*i+1), slice(0,1)))
+        self.assertTrue( len(sims._pendingDirty[self.ims2]) <= 16 )
+        sims.deregister( self.layer2 )
+        self.assertEqual( sims._pendingDirty, {} )
+        sims.flushDirty()
+        self.assertEqual( dirty, [QRect(0,0,10,10)] )
+
+    def testCoalesceRects( self ):
+        self.assertEqual( coalesceRects([QRect(0,0,10,10), QRect(10,0,10,10), QRect(2,2,3,3)]),
+                          [QRect(0,0,20,10)] )
+        self.assertEqual( len(coalesceRects([QRect(0,0,10,10), QRect(20,20,10,10)])), 2 )
+        self.assertEqual( coalesceRects([QRect(3*i,0,1,1) for i in range(5)], maxRects=2),
+                          [QRect(0,0,13,1)] )
+
 class ImagePumpTest( ut.TestCase ):
     def setUp( self ):
         self.ds = ConstantSource()
@@ -11,12 +11,16 @@ import numpy
 from PyQt4.QtCore import QRect
 from PyQt4.QtGui import QImage
 from PyQt4.QtGui import QColor
+from qimage2ndarray import byte_view
 
 #volumina
 import volumina._testing
-from volumina.pixelpipeline.imagesources import GrayscaleImageSource, RGBAImageSource, ColortableImageSource
+from volumina.pixelpipeline.imagesources import GrayscaleImageSource, RGBAImageSource, ColortableImageSource, \
+                                                AlphaModulatedImageSource, downsample2D, kernelImage
+from volumina.pixelpipeline import imagekernels
 from volumina.pixelpipeline.datasources import ConstantSource, ArraySource
-from volumina.layer import GrayscaleLayer, RGBALayer, ColortableLayer
+from volumina.pixelpipeline.processpool import enableProcessPool, disableProcessPool
+from volumina.layer import GrayscaleLayer, RGBALayer, ColortableLayer, AlphaModulatedLayer
 
 class _ArraySource2d( ArraySource ):
     def request( self, slicing, through=None):
@@ -59,6 +63,27 @@ class GrayscaleImageSourceTest( ut.TestCase ):
         self.ims.setDirty((slice(34,37), slice(12,34)))
         self.ims.isDirty.disconnect( checkDirtyRect )
 
+    def testImageFromStridedArray( self ):
+        # e.g. a slice whose axes are swapped by the SliceProjection
+        a = self.raw[:40,:30].T
+        img = kernelImage(imagekernels.grayscale, [a], (None,))
+        self.assertEqual( img.format(), QImage.Format_ARGB32_Premultiplied )
+        self.assertEqual( (img.width(), img.height()), (40, 30) )
+        self.assertTrue( numpy.all(byte_view(img)[:,:,0] == a) )
+        self.assertTrue( numpy.all(byte_view(img)[:,:,3] == 255) )
+
+    def testLookupTable( self ):
+        raw = numpy.random.randint(0, 1000, (40, 30)).astype(numpy.uint16)
+        img = kernelImage(imagekernels.grayscale, [raw], ((100, 900),))
+        expected = numpy.clip((raw.astype(numpy.float32) - 100) * 255. / 800, 0, 255).astype(numpy.uint8)
+        self.assertTrue( numpy.all(byte_view(img)[:,:,0] == expected) )
+        self.assertTrue( numpy.all(byte_view(img)[:,:,3] == 255) )
+        table = imagekernels.lookupTable(imagekernels._grayscale, numpy.uint16, ((100, 900),))
+        self.assertEqual( len(table), 2**16 )
+        # cached
+        self.assertTrue( table is imagekernels.lookupTable(imagekernels._grayscale, numpy.uint16,
+                                                           ((100, 900),)) )
+
 
 #*******************************************************************************
 # C o l o r t a b l e I m a g e S o u r c e T e s t 
@@ -115,6 +140,24 @@ class ColortableImageSourceTest( ut.TestCase ):
         self.ims.setDirty((slice(34,37), slice(12,34)))
         self.ims.isDirty.disconnect( checkDirtyRect )
 
+    def testColortableKernel( self ):
+        table = numpy.array([[10,20,30,255], [40,50,60,128], [70,80,90,0]], dtype=numpy.uint8)
+        argb = imagekernels.argbTable(table)
+        self.assertEqual( argb[1], 0x803c3228 )
+        a = numpy.array([[0, 1, 2], [3, -1, 7]], dtype=numpy.int32)
+        expected = argb[numpy.remainder(a, 3)]
+        for data, normalize in ((a, None), (a.astype(numpy.float32), None),
+                                (a * 10 + 5, (5, 25))):
+            out = numpy.zeros(a.shape, dtype=numpy.uint32)
+            imagekernels.colortable( out, data, argb, normalize )
+            self.assertTrue( numpy.all(out == expected) )
+        # uint8 labels with a full table
+        table = numpy.random.randint(0, 256, (256, 4)).astype(numpy.uint8)
+        labels = numpy.random.randint(0, 256, (5, 6)).astype(numpy.uint8)
+        out = numpy.zeros(labels.shape, dtype=numpy.uint32)
+        imagekernels.colortable( out, labels, table, None )
+        self.assertTrue( numpy.all(out == imagekernels.argbTable(table)[labels]) )
+
 #*******************************************************************************
 # R G B A I m a g e S o u r c e T e s t                                        *
 #*******************************************************************************
@@ -166,6 +209,106 @@ class RGBAImageSourceTest( ut.TestCase ):
         self.assertFalse( ims_notopaque.isOpaque() )
         
 
+#*******************************************************************************
+# D o w n s a m p l i n g T e s t                                              *
+#*******************************************************************************
+
+class DownsamplingTest( ut.TestCase ):
+    def testDownsample2D( self ):
+        a = numpy.arange(5*7, dtype=numpy.uint8).reshape(5,7)
+        self.assertTrue( downsample2D(a, 1) is a )
+
+        nearest = downsample2D(a, 2, 'nearest')
+        self.assertEqual( nearest.shape, (3,4) )
+        self.assertTrue( numpy.all(nearest == a[::2,::2]) )
+
+        mean = downsample2D(a, 2, 'mean')
+        self.assertEqual( mean.shape, (3,4) )
+        self.assertEqual( mean.dtype, a.dtype )
+        self.assertEqual( mean[0,0], numpy.round(a[0:2,0:2].mean()) )
+        # incomplete border blocks are averaged over their actual size
+        self.assertEqual( mean[2,3], a[4,6] )
+        self.assertEqual( mean[0,3], numpy.round(a[0:2,6].mean()) )
+
+    def testGrayscaleLevel( self ):
+        raw = numpy.random.randint(0, 255, (64, 48)).astype(numpy.uint8)
+        ars = _ArraySource2d(raw)
+        ims = GrayscaleImageSource( ars, GrayscaleLayer( ars, normalize=False ) )
+        img = ims.request(QRect(0,0,64,48), level=2).wait()
+        self.assertEqual( img.height(), 16 )
+        self.assertEqual( img.width(), 12 )
+
+    def testNearestLevelIsStridedAtTheSource( self ):
+        raw = numpy.random.randint(0, 255, (64, 48)).astype(numpy.uint8)
+        slicings = []
+        class _RecordingArraySource2d( _ArraySource2d ):
+            def request( self, slicing, through=None ):
+                slicings.append( slicing )
+                return super(_RecordingArraySource2d, self).request( slicing, through )
+        ars = _RecordingArraySource2d(raw)
+        ims = GrayscaleImageSource( ars, GrayscaleLayer( ars, normalize=False ) )
+        ims.reduction = 'nearest'
+        img = ims.request(QRect(0,0,64,48), level=2).wait()
+        self.assertEqual( slicings, [(slice(0,64,4), slice(0,48,4))] )
+        self.assertTrue( numpy.all(byte_view(img)[:,:,0:3] == raw[::4,::4,None]) )
+
+    def testRequestsLessData( self ):
+        ars = _ArraySource2d(numpy.zeros((64, 48), dtype=numpy.uint8))
+        ims = GrayscaleImageSource( ars, GrayscaleLayer( ars ) )
+        # averaging needs all the data
+        self.assertFalse( ims.requestsLessData() )
+        ims.reduction = 'nearest'
+        self.assertTrue( ims.requestsLessData() )
+
+        class _UnstridedArraySource2d( _ArraySource2d ):
+            stridedRequests = False
+        ars = _UnstridedArraySource2d(numpy.zeros((64, 48), dtype=numpy.uint8))
+        ims = GrayscaleImageSource( ars, GrayscaleLayer( ars ) )
+        ims.reduction = 'nearest'
+        self.assertFalse( ims.requestsLessData() )
+
+#*******************************************************************************
+# P r o c e s s P o o l T e s t                                                *
+#*******************************************************************************
+
+class ProcessPoolTest( ut.TestCase ):
+    def tearDown( self ):
+        disableProcessPool()
+
+    def _render( self, ims, rect ):
+        disableProcessPool()
+        expected = ims.request(rect).wait()
+        enableProcessPool(2)
+        result = ims.request(rect).wait()
+        self.assertEqual( result.format(), expected.format() )
+        self.assertTrue( result == expected )
+
+    def testGrayscale( self ):
+        raw = numpy.random.randint(0, 1000, (40, 30)).astype(numpy.uint16)
+        ars = _ArraySource2d(raw)
+        self._render( GrayscaleImageSource( ars, GrayscaleLayer( ars, normalize=(100, 900) ) ), QRect(0,0,40,30) )
+
+    def testColortable( self ):
+        seg = numpy.random.randint(0, 3, (6, 7)).astype(numpy.uint32)
+        ars = _ArraySource2d(seg)
+        ctable = [QColor(255,0,0).rgba(), QColor(0,255,0,128).rgba(), QColor(0,0,255).rgba()]
+        self._render( ColortableImageSource( ars, ColortableLayer( ars, ctable ) ), QRect(0,0,6,7) )
+
+    def testAlphaModulated( self ):
+        raw = numpy.random.randint(0, 256, (40, 30)).astype(numpy.uint8)
+        ars = _ArraySource2d(raw)
+        layer = AlphaModulatedLayer( ars, tintColor=QColor(255,128,0) )
+        self._render( AlphaModulatedImageSource( ars, layer ), QRect(0,0,40,30) )
+        # uint8 data is converted with a lookup table, float data is not
+        args = ((1.0, 0.5, 0.0), (0, 255))
+        self.assertTrue( kernelImage(imagekernels.alphaModulated, [raw], args) ==
+                         kernelImage(imagekernels.alphaModulated, [raw.astype(numpy.float32)], args) )
+
+    def testRgba( self ):
+        data = numpy.load(os.path.join(os.path.dirname(volumina._testing.__file__), 'rgba129x104.npy'))
+        channels = [_ArraySource2d(data[:,:,i]) for i in range(4)]
+        self._render( RGBAImageSource( *(channels + [RGBALayer( *channels )]) ), QRect(0,0,129,104) )
+
 #*******************************************************************************
 # i f   _ _ n a m e _ _   = =   " _ _ m a i n _ _ "                            *
 #*******************************************************************************
@@ -0,0 +1,93 @@
+import os
+import shutil
+import tempfile
+import unittest as ut
+import numpy as np
+from PyQt4.QtCore import QRect, SIGNAL
+
+from volumina.offscreen import renderSlice, renderFrames, exportFrames, writeRawFrames
+from volumina.layerstack import LayerStackModel
+from volumina.layer import GrayscaleLayer
+from volumina.pixelpipeline.datasources import ArraySource
+from volumina.pixelpipeline.imagepump import ImagePump
+from volumina.slicingtools import SliceProjection
+
+class RenderSliceTest( ut.TestCase ):
+    def setUp( self ):
+        # each slice along z is labeled by its z coordinate
+        data = np.indices((1, 60, 40, 10, 1))[3].astype(np.uint8)
+        data[0, 30:, :, :, 0] += 100 # right half
+        self.lsm = LayerStackModel()
+        self.lsm.append( GrayscaleLayer( ArraySource( data ), normalize=False ) )
+        self.projection = SliceProjection( abscissa=1, ordinate=2, along=[0,3,4] )
+
+    def testWholeSlice( self ):
+        rgba = renderSlice(self.lsm, self.projection, (0, 5, 0), (60, 40))
+        self.assertEqual( rgba.shape, (40, 60, 4) )
+        self.assertTrue( np.all(rgba[:, :30, 0:3] == 5) )
+        self.assertTrue( np.all(rgba[:, 30:, 0:3] == 105) )
+        self.assertTrue( np.all(rgba[:, :, 3] == 255) )
+
+    def testRectAndSize( self ):
+        # larger than the data: every data pixel becomes 4x4 pixels
+        rgba = renderSlice(self.lsm, self.projection, (0, 7, 0), (60, 40),
+                           rect=QRect(20, 0, 20, 10), size=(80, 40), blockSize=16)
+        self.assertEqual( rgba.shape, (40, 80, 4) )
+        self.assertTrue( np.all(rgba[:, :40, 0:3] == 7) )
+        self.assertTrue( np.all(rgba[:, 40:, 0:3] == 107) )
+
+    def testNoReceiversLeft( self ):
+        layer = self.lsm[0]
+        signals = [(self.lsm, SIGNAL(s)) for s in ('layerAdded(PyQt_PyObject,int)',
+                                                    'layerRemoved(PyQt_PyObject,int)',
+                                                    'stackCleared()', 'orderChanged()')]
+        signals += [(layer, SIGNAL('opacityChanged(double)')),
+                    (layer, SIGNAL('visibleChanged(bool)'))]
+        receivers = lambda: [obj.receivers(signal) for obj, signal in signals]
+        before = receivers()
+        pump = ImagePump( self.lsm, self.projection )
+        # all of them are observed by a pump
+        self.assertTrue( all(n > m for n, m in zip(receivers(), before)) )
+        pump.close()
+        self.assertEqual( receivers(), before )
+
+        renderSlice(self.lsm, self.projection, (0, 5, 0), (60, 40))
+        self.assertEqual( receivers(), before )
+
+class RenderFramesTest( ut.TestCase ):
+    def setUp( self ):
+        data = np.indices((1, 20, 10, 10, 1))[3].astype(np.uint8)
+        self.lsm = LayerStackModel()
+        self.lsm.append( GrayscaleLayer( ArraySource( data ), normalize=False ) )
+        self.projection = SliceProjection( abscissa=1, ordinate=2, along=[0,3,4] )
+
+    def testRenderFrames( self ):
+        positions = [3, 1, 4, 1, 5, 9, 2, 6]
+        frames = list(renderFrames(self.lsm, self.projection, (0, 0, 0), (20, 10),
+                                   axis=1, positions=positions, ahead=3))
+        self.assertEqual( [p for p, rgba in frames], positions )
+        for position, rgba in frames:
+            self.assertEqual( rgba.shape, (10, 20, 4) )
+            self.assertTrue( np.all(rgba[:,:,0:3] == position) )
+
+    def testExportFrames( self ):
+        directory = tempfile.mkdtemp()
+        try:
+            names = exportFrames(os.path.join(directory, 'frame%02d.png'), self.lsm,
+                                 self.projection, (0, 0, 0), (20, 10), axis=1,
+                                 positions=range(5), size=(40, 20))
+            self.assertEqual( [os.path.basename(n) for n in names],
+                              ['frame%02d.png' % i for i in range(5)] )
+            self.assertTrue( all(os.path.exists(n) for n in names) )
+        finally:
+            shutil.rmtree(directory)
+
+    def testWriteRawFrames( self ):
+        f = tempfile.TemporaryFile()
+        n = writeRawFrames(f, renderFrames(self.lsm, self.projection, (0, 0, 0), (20, 10),
+                                           axis=1, positions=range(3)))
+        self.assertEqual( n, 3 )
+        self.assertEqual( f.tell(), 3 * 20 * 10 * 4 )
+
+if __name__ == '__main__':
+    ut.main()
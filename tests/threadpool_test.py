@@ -0,0 +1,78 @@
+import heapq
+import threading
+import unittest as ut
+
+from volumina.threadpool import RenderThreadPool
+
+class RenderThreadPoolTest( ut.TestCase ):
+    def setUp( self ):
+        self.done = []
+        self.gate = threading.Event()
+
+    def _handler( self, name ):
+        def handle( item ):
+            self.gate.wait()
+            self.done.append( (name, item) )
+        return handle
+
+    def testGlobalPriorityOrder( self ):
+        pool = RenderThreadPool(1)
+        a, b = object(), object()
+        pool.addClient( a, self._handler('a') )
+        pool.addClient( b, self._handler('b') )
+        # blocks the only thread until everything is queued
+        pool.submit( a, 0, 'first' )
+        for priority, owner, name in ((3, a, 'a3'), (1, b, 'b1'), (2, a, 'a2')):
+            pool.submit( owner, priority, name )
+        self.gate.set()
+        pool.join( a )
+        pool.join( b )
+        self.assertEqual( [item for owner, item in self.done],
+                          ['first', 'b1', 'a2', 'a3'] )
+
+    def testMaxRunning( self ):
+        pool = RenderThreadPool(3)
+        running = []
+        lock = threading.Lock()
+        def handle( item ):
+            with lock:
+                running.append( item )
+                self.assertTrue( len(running) <= 1 )
+            self.gate.wait()
+            with lock:
+                running.remove( item )
+        owner = object()
+        pool.addClient( owner, handle, maxRunning=1 )
+        for i in range(5):
+            pool.submit( owner, i, i )
+        self.gate.set()
+        self.assertTrue( pool.join( owner, timeout=10 ) )
+
+    def testRemoveClient( self ):
+        pool = RenderThreadPool(1)
+        owner = object()
+        pool.addClient( owner, self._handler('a') )
+        pool.submit( owner, 0, 0 )
+        pool.submit( owner, 1, 1, background=True )
+        pool.submit( owner, 2, 2 )
+        dropped = pool.removeClient( owner )
+        self.gate.set()
+        pool.joinRunning( owner )
+        self.assertEqual( len(dropped) + len(self.done), 3 )
+        self.assertFalse( pool.submit( owner, 3, 3 ) )
+
+    def testItemsOfRemovedClientsAreSkipped( self ):
+        pool = RenderThreadPool(1)
+        a, b = object(), object()
+        pool.addClient( b, self._handler('b') )
+        # an item whose owner is not registered (anymore)
+        with pool._cond:
+            heapq.heappush(pool._heap, (0, -1, a, 'a0', False))
+        pool.submit( b, 1, 'b1' )
+        self.gate.set()
+        self.assertTrue( pool.join( b, timeout=10 ) )
+        self.assertEqual( self.done, [('b', 'b1')] )
+        self.assertTrue( all(pool.aliveThreads().values()) )
+
+if __name__ == '__main__':
+    ut.main()
@@ -1,15 +1,16 @@
 import os
+import threading
 import unittest as ut
 import numpy as np
 from PyQt4.QtCore import QRectF, QPoint, QRect
-from PyQt4.QtGui import QTransform, qApp
+from PyQt4.QtGui import QTransform, QImage, QColor, qApp
 from qimage2ndarray import byte_view
 
-from volumina.tiling import TileProvider, Tiling
+from volumina.tiling import TileProvider, Tiling, _LayerTileRequest, _TilesCache
 from volumina.layerstack import LayerStackModel
-from volumina.layer import GrayscaleLayer
+from volumina.layer import GrayscaleLayer, ColortableLayer
 from volumina.pixelpipeline.datasources import ConstantSource, ArraySource
-from volumina.pixelpipeline.imagesources import GrayscaleImageSource
+from volumina.pixelpipeline.imagesources import GrayscaleImageSource, ColortableImageSource, ImageSource
 from volumina.pixelpipeline.imagepump import StackedImageSources, ImagePump
 from volumina.pixelpipeline.slicesources import SliceSource
 from volumina.slicingtools import SliceProjection
@@ -33,6 +34,14 @@ class TilingTest ( ut.TestCase ):
             t = Tiling((100*i, 100), blockSize = 50)
             self.assertEqual(len(t), (100*i*2)/50)
 
+    def testTileIdsForDataRect( self ):
+        t = Tiling((900,400), blockSize=100)
+        self.assertEqual( list(t.tileIdsForDataRect(QRect(150,50,100,10))), [1, 2] )
+        self.assertEqual( list(t.tileIdsForDataRect(QRect(150,50,10,100))), [1, 10] )
+        self.assertEqual( len(t.tileIdsForDataRect(QRect())), len(t) )
+        # tiles of coarser levels are larger
+        self.assertEqual( list(t.atLevel(1).tileIdsForDataRect(QRect(150,50,100,10))), [0, 1] )
+
     def testData2Scene(self):
         t = Tiling((0, 0))
         trans = QTransform()
@@ -44,6 +53,136 @@ class TilingTest ( ut.TestCase ):
         with self.assertRaises(AssertionError):
             t.data2scene = trans
 
+    def testLevels( self ):
+        t = Tiling((1000, 600), blockSize=100)
+        self.assertEqual( t.level, 0 )
+        self.assertEqual( t.maxLevel, 4 )
+
+        t2 = t.atLevel(2)
+        self.assertEqual( t2.level, 2 )
+        self.assertEqual( t2.sliceShape, t.sliceShape )
+        self.assertEqual( len(t2), 3*2 )
+        self.assertEqual( t2.imageRects[0], QRect(0,0,400,400) )
+        # patch images of level 2 have a quarter of the width and height
+        for rect, size in zip(t2.imageRects, t2.imageSizes):
+            self.assertEqual( size.width(), -(-rect.width() // 4) )
+            self.assertEqual( size.height(), -(-rect.height() // 4) )
+
+
+class TilesCacheTest( ut.TestCase ):
+    def setUp( self ):
+        self.sims = StackedImageSources( LayerStackModel() )
+
+    def _tile( self ):
+        img = QImage(10, 10, QImage.Format_ARGB32_Premultiplied)
+        self.assertEqual( img.byteCount(), 400 )
+        return img
+
+    def testMemoryBudget( self ):
+        cache = _TilesCache('a', self.sims, 1, maxbytes=1000)
+        cache.setTile('a', 0, self._tile())
+        cache.addStack('b')
+        cache.setTile('b', 0, self._tile())
+        self.assertEqual( cache.nbytes, 800 )
+        # 'a' is viewed again and becomes frequent
+        cache.touchStack('a')
+        cache.addStack('c')
+        cache.setTile('c', 0, self._tile())
+        self.assertTrue( 'a' in cache )
+        self.assertFalse( 'b' in cache )
+        self.assertTrue( 'c' in cache )
+        self.assertEqual( cache.nbytes, 800 )
+        self.assertRaises( KeyError, cache.tile, 'b', 0 )
+
+        # replacing an image does not add up
+        cache.setTile('c', 0, self._tile())
+        self.assertEqual( cache.nbytes, 800 )
+
+        # shrink, but never evict the stack in view
+        cache.setLimits(None, 500)
+        self.assertEqual( len(cache), 1 )
+        self.assertTrue( 'c' in cache )
+        cache.setLimits(None, 100)
+        self.assertTrue( 'c' in cache )
+
+    def testPrefetchedStacksGoFirst( self ):
+        cache = _TilesCache('a', self.sims, 1, maxbytes=1000)
+        cache.setTile('a', 0, self._tile())
+        cache.addStack('b')
+        cache.touchStack('a')
+        cache.setTile('b', 0, self._tile())
+        cache.addStack('p', prefetch=True)
+        cache.setTile('p', 0, self._tile())
+        # 'b' is the oldest stack that was viewed only once
+        self.assertFalse( 'b' in cache )
+        cache.touchStack('a')
+        cache.addStack('q', prefetch=True)
+        cache.setTile('q', 0, self._tile())
+        self.assertFalse( 'p' in cache )
+        self.assertTrue( 'a' in cache )
+
+    def testPrefetchedGhostIsViewed( self ):
+        cache = _TilesCache('a', self.sims, 1, maxbytes=1000)
+        cache.setTile('a', 0, self._tile())
+        cache.addStack('b')
+        cache.setTile('b', 0, self._tile())
+        cache.touchStack('a')
+        cache.addStack('c')
+        cache.setTile('c', 0, self._tile())
+        self.assertFalse( 'b' in cache )
+        # evicted too early, prefetched again and then viewed
+        cache.addStack('b', prefetch=True)
+        self.assertTrue( cache.touchStack('b') )
+        self.assertFalse( cache.touchStack('b') )
+        self.assertTrue( 'b' in cache )
+
+    def testLayerState( self ):
+        lsm = LayerStackModel()
+        sims = StackedImageSources( lsm )
+        imss = []
+        for gray in (10, 20):
+            ds = ConstantSource( gray )
+            layer = GrayscaleLayer( ds )
+            # translucent layers do not occlude each other
+            layer.opacity = 0.5
+            lsm.append( layer )
+            ims = GrayscaleImageSource( ds, layer )
+            sims.register( layer, ims )
+            imss.append( ims )
+        ims1, ims2 = imss
+
+        cache = _TilesCache('a', sims, 6)
+        cache.addStack('b')
+        self.assertTrue( cache.layerDirty('a', ims1, 3) )
+        cache.updateTileIfNecessary('a', ims1, 3, 1.0, self._tile())
+        self.assertFalse( cache.layerDirty('a', ims1, 3) )
+        self.assertTrue( cache.layerDirty('a', ims2, 3) )
+        self.assertEqual( cache.layerTimestamp('a', ims1, 3), 1.0 )
+        self.assertTrue( cache.tileDirty('a', 3) )
+
+        # progress is the fraction of shown layers that are clean
+        cache.setTile('a', 3, self._tile())
+        self.assertEqual( cache.tile('a', 3)[1], 0.5 )
+        self.assertEqual( cache.nbytes, 800 )
+
+        cache.setTileDirty('a', 3, False)
+        cache.setTileDirtyAll(np.array([1, 3]), True)
+        self.assertTrue( cache.tileDirty('a', 3) )
+        cache.setTileDirtyAll(slice(None), False)
+        self.assertFalse( any(cache.tileDirty(sid, t) for sid in 'ab' for t in range(6)) )
+
+        cache.setLayersDirtyAll(np.array([3]), True)
+        self.assertTrue( cache.layerDirty('a', ims1, 3) )
+        self.assertTrue( cache.layerDirty('b', ims2, 3) )
+        self.assertEqual( [img is not None for img in cache.layers('a', [ims2, ims1], 3)], [False, True] )
+
+        # requested before the layer became dirty: stored, but
+        # requested again
+        cache.updateTileIfNecessary('a', ims1, 3, 2.0, self._tile())
+        self.assertEqual( cache.layerTimestamp('a', ims1, 3), 2.0 )
+        self.assertTrue( cache.layerDirty('a', ims1, 3) )
+        self.assertTrue( cache.takeRerequest('a', 3) )
+
 
 class TileProviderTest( ut.TestCase ):
     def setUp( self ):
@@ -80,6 +219,67 @@ class TileProviderTest( ut.TestCase ):
         sims.register( self.layer3, self.ims3 )
         self.sims = sims
 
+    def testResizeCache( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims, cache_memory=2**30)
+        try:
+            tp.requestRefresh(QRectF(0,0,900,400))
+            tp.join()
+            used = tp.cacheMemoryUsed()
+            self.assertTrue( used > 0 )
+            cache = tp._cache
+            tp.cacheMemory = used // 2
+            # the cache is shrunk in place, but keeps the current stack
+            self.assertTrue( tp._cache is cache )
+            self.assertEqual( tp.cacheMemory, used // 2 )
+            self.assertEqual( tp.cacheMemoryUsed(), used )
+            tp.cacheSize = 3
+            self.assertEqual( tp.cacheSize, 3 )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def testDirtyRectOnlyTouchesItsTiles( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        try:
+            tp.requestRefresh(QRectF(0,0,900,400))
+            tp.join()
+            stack_id = self.sims.stackId
+            self.assertFalse( any(tp._cache.layerDirty(stack_id, self.ims3, t)
+                                  for t in range(len(tiling))) )
+            self.ims3.setDirty((slice(150,250), slice(50,60)))
+            dirty = [t for t in range(len(tiling))
+                     if tp._cache.layerDirty(stack_id, self.ims3, t)]
+            self.assertEqual( dirty, [1, 2] )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def testCompositingInRenderThreads( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        try:
+            threads = []
+            renderTile = tp._renderTile
+            def recordingRenderTile( *args ):
+                threads.append( threading.current_thread() )
+                return renderTile( *args )
+            tp._renderTile = recordingRenderTile
+
+            tp.requestRefresh(QRectF(100,100,200,200))
+            tp.join()
+            tiles = list(tp.getTiles(QRectF(100,100,200,200)))
+            self.assertTrue( len(threads) > 0 )
+            self.assertFalse( threading.current_thread() in threads )
+            self.assertTrue( tp.requestStatistics()['composited'] > 0 )
+            for tile in tiles:
+                self.assertEqual( tile.progress, 1.0 )
+                self.assertTrue(np.all(byte_view(tile.qimg)[:,:,0:3] == self.GRAY3))
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
     def testSetAllLayersInvisible( self ):
         tiling = Tiling((900,400), blockSize=100)
         tp = TileProvider(tiling, self.sims)
@@ -118,6 +318,486 @@ class TileProviderTest( ut.TestCase ):
             tp.notifyThreadsToStop()
             tp.joinThreads()
 
+    def testLevelOfDetail( self ):
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims, level_of_detail=True)
+        try:
+            self.assertEqual( tp.levelForScale(1.0), 0 )
+            self.assertEqual( tp.levelForScale(0.5), 1 )
+            self.assertEqual( tp.levelForScale(0.3), 1 )
+            self.assertEqual( tp.levelForScale(0.01), tiling.maxLevel )
+
+            tp.requestRefresh(QRectF(0,0,900,400), scale=0.5)
+            tp.join()
+            tiles = list(tp.getTiles(QRectF(0,0,900,400), scale=0.5))
+            self.assertEqual( len(tiles), len(tiling.atLevel(1)) )
+            for tile in tiles:
+                self.assertEqual( tile.tiling.level, 1 )
+                self.assertEqual( tile.qimg.size(), tile.tiling.imageSizes[tile.id] )
+                aimg = byte_view(tile.qimg)
+                self.assertTrue(np.all(aimg[:,:,0:3] == self.GRAY3))
+                self.assertTrue(np.all(aimg[:,:,3] == 255))
+
+            tp.levelOfDetail = False
+            self.assertEqual( tp.levelForScale(0.5), 0 )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def testPreviewWhileScrolling( self ):
+        # only sources that fetch less data are previewed
+        for ims in (self.ims2, self.ims3):
+            ims.reduction = 'nearest'
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims, preview_level=1)
+        rect = QRectF(0,0,900,400)
+        def refresh():
+            tp.requestRefresh(rect)
+            tp.join()
+            return list(tp.getTiles(rect))
+        try:
+            stack_id = self.sims.stackId
+            refresh()
+
+            # e.g. only the crosshair moved: the cached tiles are kept
+            tp.settled = False
+            tiles = refresh()
+            self.assertEqual( len(tiles), len(tiling) )
+            self.assertTrue( all(tile.tiling.level == 0 and tile.progress == 1.0
+                                 for tile in tiles) )
+
+            # scrolling to another slice renders the preview only
+            self.sims.stackId = (None, ((0, 1),))
+            tiles = refresh()
+            previews = [tile for tile in tiles if tile.tiling.level == 1]
+            self.assertEqual( len(previews), len(tiling.atLevel(1)) )
+            for tile in previews:
+                self.assertEqual( tile.progress, 1.0 )
+                self.assertEqual( tile.qimg.size(), tile.tiling.imageSizes[tile.id] )
+            self.assertEqual( tiles[:len(previews)], previews )
+            self.assertTrue( all(tile.qimg is None for tile in tiles[len(previews):]) )
+
+            # the full resolution tiles of cached slices are shown
+            self.sims.stackId = stack_id
+            tiles = refresh()
+            self.assertEqual( len(tiles), len(tiling) )
+            self.assertTrue( all(tile.tiling.level == 0 and tile.progress == 1.0
+                                 for tile in tiles) )
+
+            # refined to full resolution once settled
+            self.sims.stackId = (None, ((0, 1),))
+            tp.settled = True
+            tiles = refresh()
+            self.assertEqual( len(tiles), len(tiling) )
+            for tile in tiles:
+                self.assertEqual( tile.tiling.level, 0 )
+                self.assertTrue(np.all(byte_view(tile.qimg)[:,:,0:3] == self.GRAY3))
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def testNoPreviewOfAveragedLayers( self ):
+        # averaging at the preview level fetches the full resolution
+        tiling = Tiling((900,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims, preview_level=1)
+        rect = QRectF(0,0,900,400)
+        try:
+            tp.settled = False
+            self.sims.stackId = (None, ((0, 1),))
+            tp.requestRefresh(rect)
+            tp.join()
+            tiles = list(tp.getTiles(rect))
+            self.assertEqual( len(tiles), len(tiling) )
+            self.assertTrue( all(tile.tiling.level == 0 and tile.progress == 1.0
+                                 for tile in tiles) )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def testPreferredBlockSize( self ):
+        lsm = LayerStackModel()
+        pump = ImagePump( lsm, SliceProjection() )
+        lsm.append( GrayscaleLayer( ArraySource( np.zeros((1,200,200,10,1), dtype=np.uint8) ) ) )
+        tiling = Tiling((200,200), blockSize=50)
+        tp = TileProvider(tiling, pump.stackedImageSources)
+        try:
+            # not measured yet
+            self.assertEqual( tp.preferredBlockSize(), None )
+            tp.requestRefresh(QRectF(0,0,200,200))
+            tp.join()
+            self.assertEqual( tp.preferredBlockSize(latency=1e3), 1024 )
+            self.assertEqual( tp.preferredBlockSize(latency=1e-12), 64 )
+            size = tp.preferredBlockSize()
+            self.assertTrue( 64 <= size <= 1024 and size & (size - 1) == 0 )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+
+class IncrementalCompositingTest( ut.TestCase ):
+    def setUp( self ):
+        self.lsm = LayerStackModel()
+        self.sims = StackedImageSources( self.lsm )
+        self.layers = []
+        for gray in (50, 100, 200):
+            ds = ConstantSource( gray )
+            layer = GrayscaleLayer( ds )
+            layer.opacity = 0.5
+            self.lsm.append( layer )
+            self.sims.register( layer, GrayscaleImageSource( ds, layer ) )
+            self.layers.append( layer )
+
+    def testOpacityOfOneLayer( self ):
+        tiling = Tiling((100,100), blockSize=100)
+        tp = TileProvider(tiling, self.sims)
+        try:
+            tp.requestRefresh(QRectF(0,0,100,100))
+            tp.join()
+            stack_id = self.sims.stackId
+            layer = self.layers[1]
+            ims = self.sims._layerToIms[layer]
+            for opacity in (0.8, 0.3, 0.6):
+                layer.opacity = opacity
+                tp.requestRefresh(QRectF(0,0,100,100))
+                tp.join()
+            partial = tp._cache.partial(stack_id, 0)
+            self.assertTrue( partial is not None )
+            self.assertEqual( partial.pivot, tp._cache.slots([ims])[0] )
+
+            # same result as composing all layers
+            tile, = tp.getTiles(QRectF(0,0,100,100))
+            incremental = byte_view(tile.qimg).astype(int)
+            tp._cache.setPartial(stack_id, 0, None)
+            full = byte_view(tp._renderTile(stack_id, 0, tp._cache)).astype(int)
+            self.assertTrue( np.all(np.abs(incremental - full) <= 1) )
+
+            # changing another layer invalidates the partial composites
+            self.layers[0].opacity = 0.7
+            tp.requestRefresh(QRectF(0,0,100,100))
+            tp.join()
+            self.assertTrue( tp._cache.partial(stack_id, 0) is None )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+
+class _CountingImageSource( GrayscaleImageSource ):
+    def __init__( self, *args ):
+        super(_CountingImageSource, self).__init__( *args )
+        self.numRequests = 0
+
+    def request( self, *args, **kwargs ):
+        self.numRequests += 1
+        return super(_CountingImageSource, self).request( *args, **kwargs )
+
+class _ArraySource2d( ArraySource ):
+    def request( self, slicing, through=None ):
+        return super(_ArraySource2d, self).request( slicing )
+
+class OrientationTest( ut.TestCase ):
+    def testRotationKeepsCache( self ):
+        data = (np.arange(24).reshape(6,4) * 10).astype(np.uint8)
+        ds = _ArraySource2d( data )
+        layer = GrayscaleLayer( ds, normalize=False )
+        lsm = LayerStackModel()
+        lsm.append( layer )
+        sims = StackedImageSources( lsm )
+        ims = _CountingImageSource( ds, layer )
+        sims.register( layer, ims )
+
+        tiling = Tiling((6,4), blockSize=100)
+        tp = TileProvider(tiling, sims)
+        try:
+            tp.requestRefresh(QRectF(0,0,6,4))
+            tp.join()
+            tile, = tp.getTiles(QRectF(0,0,6,4))
+            # scene x runs along the first data axis
+            self.assertTrue( np.all(byte_view(tile.qimg)[:,:,0] == data.T) )
+            self.assertEqual( ims.numRequests, 1 )
+
+            tiling.data2scene = QTransform(0,1,1,0,0,0) # swap axes
+            tp.viewMatrixChanged()
+            tp.requestRefresh(QRectF(0,0,4,6))
+            tp.join()
+            tile, = tp.getTiles(QRectF(0,0,4,6))
+            self.assertTrue( np.all(byte_view(tile.qimg)[:,:,0] == data) )
+            self.assertEqual( ims.numRequests, 1 )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def testRotationWhileComposing( self ):
+        data = (np.arange(24).reshape(6,4) * 10).astype(np.uint8)
+        ds = _ArraySource2d( data )
+        layer = GrayscaleLayer( ds, normalize=False )
+        lsm = LayerStackModel()
+        lsm.append( layer )
+        sims = StackedImageSources( lsm )
+        sims.register( layer, GrayscaleImageSource( ds, layer ) )
+
+        tiling = Tiling((6,4), blockSize=100)
+        tp = TileProvider(tiling, sims)
+        started = threading.Event()
+        proceed = threading.Event()
+        composite = tp._composite
+        def blockingComposite( req ):
+            if not started.is_set():
+                started.set()
+                proceed.wait(10)
+            composite( req )
+        tp._composite = blockingComposite
+        try:
+            tp.requestRefresh(QRectF(0,0,6,4))
+            self.assertTrue( started.wait(10) )
+            # rotated before the queued composite runs
+            tiling.data2scene = QTransform(0,1,1,0,0,0)
+            tp.viewMatrixChanged()
+            proceed.set()
+            tp.join()
+            tp.requestRefresh(QRectF(0,0,4,6))
+            tp.join()
+            tile, = tp.getTiles(QRectF(0,0,4,6))
+            self.assertTrue( np.all(byte_view(tile.qimg)[:,:,0] == data) )
+        finally:
+            proceed.set()
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+
+class OcclusionCullingTest( ut.TestCase ):
+    def setUp( self ):
+        self.lsm = LayerStackModel()
+        self.sims = StackedImageSources( self.lsm )
+        ds = ConstantSource( 100 )
+        layer = GrayscaleLayer( ds, normalize=False )
+        self.lsm.append( layer )
+        self.bottom = _CountingImageSource( ds, layer )
+        self.sims.register( layer, self.bottom )
+
+        # opaque in the first tile, transparent in the second one
+        labels = np.zeros((100, 50), dtype=np.uint8)
+        labels[:50] = 1
+        ds = _ArraySource2d( labels )
+        self.top = ColortableLayer( ds, [QColor(0,0,0,0).rgba(), QColor(255,0,0).rgba()] )
+        self.lsm.append( self.top )
+        self.sims.register( self.top, ColortableImageSource( ds, self.top ) )
+
+    def _refresh( self, tp ):
+        tp.requestRefresh(QRectF(0,0,100,50))
+        tp.join()
+        return tp.getTiles(QRectF(0,0,100,50))
+
+    def testLayersBelowOpaqueTilesAreSkipped( self ):
+        tiling = Tiling((100,50), blockSize=50)
+        tp = TileProvider(tiling, self.sims)
+        try:
+            self._refresh(tp)
+            self.bottom.setDirty((slice(None), slice(None)))
+            requests = self.bottom.numRequests
+            first, second = self._refresh(tp)
+            # only the second tile shows the bottom layer
+            self.assertEqual( self.bottom.numRequests, requests + 1 )
+            self.assertEqual( first.progress, 1.0 )
+            self.assertEqual( list(byte_view(first.qimg)[0,0]), [0, 0, 255, 255] )
+            self.assertEqual( list(byte_view(second.qimg)[0,0]), [100, 100, 100, 255] )
+
+            # the first tile becomes transparent: the bottom layer
+            # is requested again
+            self.top.colorTable = [QColor(0,0,0,0).rgba()] * 2
+            self._refresh(tp)
+            first, second = self._refresh(tp)
+            self.assertEqual( self.bottom.numRequests, requests + 2 )
+            self.assertEqual( list(byte_view(first.qimg)[0,0]), [100, 100, 100, 255] )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+
+class _BlockingImageRequest( object ):
+    def __init__( self, rect, event, log ):
+        self.rect = rect
+        self._event = event
+        self._log = log
+        self.cancelled = False
+
+    def wait( self ):
+        self._log.append(self)
+        self._event.wait()
+        img = QImage(self.rect.size(), QImage.Format_ARGB32_Premultiplied)
+        img.fill(0xffffffff)
+        return img
+
+    def notify( self, callback, **kwargs ):
+        callback(self.wait(), **kwargs)
+
+    def cancel( self ):
+        self.cancelled = True
+
+class _BlockingImageSource( ImageSource ):
+    '''Requests block until the event is set.'''
+    def __init__( self, event ):
+        super(_BlockingImageSource, self).__init__()
+        self.event = event
+        self.requests = []
+        self.waited = []
+
+    def request( self, rect, along_through=None, level=0 ):
+        req = _BlockingImageRequest(rect, self.event, self.waited)
+        self.requests.append(req)
+        return req
+
+class _BlockingSourceTestBase( ut.TestCase ):
+    def setUp( self ):
+        self.event = threading.Event()
+        self.layer = GrayscaleLayer( ConstantSource() )
+        self.ims = _BlockingImageSource( self.event )
+        self.lsm = LayerStackModel()
+        self.lsm.append(self.layer)
+        self.sims = StackedImageSources( self.lsm )
+        self.sims.register( self.layer, self.ims )
+
+class RequestCancellationTest( _BlockingSourceTestBase ):
+    def testHiddenLayerRequestsAreCancelled( self ):
+        tiling = Tiling((400,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims, n_threads=1)
+        try:
+            tp.requestRefresh(QRectF(0,0,200,200))
+            self.assertEqual( tp.requestStatistics()['queued'], 4 )
+
+            self.layer.visible = False
+            self.event.set()
+            tp.join()
+
+            stats = tp.requestStatistics()
+            self.assertEqual( stats['cancelled'], 4 )
+            self.assertEqual( stats['completed'], 0 )
+            self.assertEqual( stats['skipped'] + stats['discarded'], 4 )
+            self.assertEqual( stats['outstanding'], 0 )
+            self.assertTrue( all(req.cancelled for req in self.ims.requests) )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def testStaleStackRequestsAreCancelled( self ):
+        tiling = Tiling((400,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims, n_threads=1)
+        try:
+            tp.requestRefresh(QRectF(0,0,200,200))
+            self.sims.stackId = (None, ((0, 1),))
+            tp.requestRefresh(QRectF(0,0,200,200))
+            self.event.set()
+            tp.join()
+
+            stats = tp.requestStatistics()
+            self.assertEqual( stats['queued'], 8 )
+            self.assertEqual( stats['cancelled'], 4 )
+            self.assertEqual( stats['completed'], 4 )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+class RequestPriorityTest( _BlockingSourceTestBase ):
+    def testTilesNearFocusFirst( self ):
+        tiling = Tiling((400,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims, n_threads=1)
+        try:
+            focus = QPoint(350, 350)
+            tp.setViewportFocus(focus)
+            tp.requestRefresh(QRectF(0,0,400,400))
+            self.event.set()
+            tp.join()
+
+            # the first request may have been started before the
+            # others were queued; the rest is ordered by distance
+            def distance(req):
+                c = req.rect.center()
+                return np.hypot(c.x() - focus.x(), c.y() - focus.y())
+            distances = [distance(req) for req in self.ims.waited[1:]]
+            self.assertEqual( len(distances), 15 )
+            self.assertEqual( distances, sorted(distances) )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+    def testInactiveViewAfterActive( self ):
+        tiling = Tiling((400,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims, n_threads=1)
+        try:
+            req = _LayerTileRequest(self.ims, 0, None, None, 0, None, False)
+            req.seq = 0
+            tp.active = False
+            inactive = tp._requestPriority(req)
+            tp.active = True
+            self.assertTrue( tp._requestPriority(req) < inactive )
+            req.prefetch = True
+            self.assertTrue( inactive < tp._requestPriority(req) )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+class BatchingTest( _BlockingSourceTestBase ):
+    def testBatchedLayerRequests( self ):
+        data = np.zeros((1,400,400,1,1), dtype=np.uint8)
+        x, y = np.mgrid[0:400,0:400]
+        data[0,:,:,0,0] = (7 * x + 3 * y) % 256
+        lsm = LayerStackModel()
+        pump = ImagePump( lsm, SliceProjection() )
+        lsm.append( GrayscaleLayer( ArraySource( data ), normalize=False ) )
+        ims = pump.stackedImageSources.getImageSource(0)
+        requests = []
+        request = ims.request
+        def countingRequest( rect, *args, **kwargs ):
+            requests.append( rect )
+            return request( rect, *args, **kwargs )
+        ims.request = countingRequest
+
+        rect = QRectF(0,0,400,400)
+        rendered = []
+        for batch_tiles in (0, 2):
+            tp = TileProvider(Tiling((400,400), blockSize=50), pump.stackedImageSources,
+                              level_of_detail=True, batch_tiles=batch_tiles)
+            try:
+                del requests[:]
+                images = []
+                for scale in (1.0, 0.5):
+                    tp.requestRefresh(rect, scale)
+                    tp.join()
+                    images += [byte_view(tile.qimg).copy() for tile in tp.getTiles(rect, scale)]
+                rendered.append( images )
+                if batch_tiles:
+                    # 64 tiles at level 0 and 16 at level 1 in 2x2 blocks
+                    self.assertEqual( len(requests), 16 + 4 )
+                    self.assertEqual( requests[0].size(), QRect(0,0,100,100).size() )
+                else:
+                    self.assertEqual( len(requests), 64 + 16 )
+            finally:
+                tp.notifyThreadsToStop()
+                tp.joinThreads()
+        self.assertEqual( len(rendered[0]), len(rendered[1]) )
+        for a, b in zip(*rendered):
+            self.assertTrue( np.all(a == b) )
+
+    def testDeduplicatedPrefetchReleasesItsBatch( self ):
+        self.sims.stackId = (None, ((0, 0),))
+        tiling = Tiling((400,400), blockSize=100)
+        tp = TileProvider(tiling, self.sims, n_threads=1, batch_tiles=2)
+        rect = QRectF(0,0,200,200)
+        try:
+            # one batch for the four tiles
+            tp.prefetch(rect, (1,))
+            self.assertEqual( len(self.ims.requests), 1 )
+            # the same tiles again: all of them are still pending
+            tp.prefetch(rect, (1,))
+            self.assertEqual( len(self.ims.requests), 2 )
+            self.assertTrue( self.ims.requests[1].cancelled )
+            self.assertFalse( self.ims.requests[0].cancelled )
+            self.event.set()
+            tp.join(prefetch=True)
+            self.assertEqual( tp.requestStatistics()['queued'], 4 )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
 
 class DirtyPropagationTest( ut.TestCase ):
 
@@ -238,5 +918,100 @@ class DirtyPropagationTest( ut.TestCase ):
             tp.joinThreads()
 
 
+class DirectLayerTest( ut.TestCase ):
+    def testRangeGrowsDuringDirectRequest( self ):
+        data = np.zeros((1,100,100,1,1), dtype=np.uint8)
+        data[0,50:,:,0,0] = 200
+        lsm = LayerStackModel()
+        pump = ImagePump( lsm, SliceProjection() )
+        # wrapped into a MinMaxSource, whose range grows when the tile
+        # is rendered for the first time
+        lsm.append( GrayscaleLayer( ArraySource( data ) ) )
+        ims = pump.stackedImageSources.getImageSource(0)
+        ims.direct = True
+        requests = []
+        request = ims.request
+        def countingRequest( rect, *args, **kwargs ):
+            requests.append( rect )
+            return request( rect, *args, **kwargs )
+        ims.request = countingRequest
+
+        tp = TileProvider(Tiling((100,100), blockSize=100), pump.stackedImageSources)
+        try:
+            for i in range(3):
+                tp.requestRefresh(QRectF(0,0,100,100))
+                tp.join()
+            # rendered with the old range and thus requested again
+            self.assertEqual( len(requests), 2 )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+class PrefetchTest( ut.TestCase ):
+    def setUp( self ):
+        data = np.indices((1, 100, 100, 10, 1))[3].astype(np.uint8) # labeled by z
+        layer = GrayscaleLayer( ArraySource( data ), normalize=False )
+        self.lsm = LayerStackModel()
+        self.pump = ImagePump( self.lsm, SliceProjection(), sync_along=(0,1,2) )
+        self.lsm.append( layer )
+
+    def testPrefetchedSlicesAreReused( self ):
+        tiling = Tiling((100,100), blockSize=50)
+        tp = TileProvider(tiling, self.pump.stackedImageSources)
+        rect = QRectF(0,0,100,100)
+        try:
+            tp.requestRefresh(rect)
+            tp.join()
+            queued = tp.requestStatistics()['queued']
+            # repeated prefetches (on every repaint) are not queued twice
+            for i in range(3):
+                tp.prefetchSlices(rect, [(0,1,0), (0,2,0)])
+            tp.join(prefetch=True)
+            self.assertEqual( tp.requestStatistics()['queued'], queued + 8 )
+
+            self.pump.syncedSliceSources.through = [0,1,0]
+            tp.requestRefresh(rect)
+            tp.join()
+            # only composed from the prefetched layer tiles
+            self.assertEqual( tp.requestStatistics()['queued'], queued + 8 )
+            for tile in tp.getTiles(rect):
+                self.assertEqual( tile.progress, 1.0 )
+                self.assertTrue( np.all(byte_view(tile.qimg)[:,:,0:3] == 1) )
+            self.assertEqual( tp.prefetchStatistics(), {'hits': 1, 'misses': 0} )
+
+            self.pump.syncedSliceSources.through = [0,5,0]
+            self.assertEqual( tp.prefetchStatistics(), {'hits': 1, 'misses': 1} )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+class MetricsTest( ut.TestCase ):
+    def testMetrics( self ):
+        layer = GrayscaleLayer( ArraySource( np.zeros((1,100,100,10,1), dtype=np.uint8) ) )
+        layer.name = "gray"
+        lsm = LayerStackModel()
+        pump = ImagePump( lsm, SliceProjection() )
+        lsm.append( layer )
+        tiling = Tiling((100,100), blockSize=50)
+        tp = TileProvider(tiling, pump.stackedImageSources)
+        rect = QRectF(0,0,100,100)
+        try:
+            tp.requestRefresh(rect)
+            tp.join()
+            list(tp.getTiles(rect))
+            m = tp.metrics()
+            self.assertEqual( (m['queued'], m['running']), (0, 0) )
+            self.assertEqual( m['tiles']['hits'], 4 )
+            self.assertTrue( m['cache']['bytes'] > 0 )
+            self.assertEqual( len(m['layers']), 1 )
+            histograms = m['layers'].values()[0]
+            self.assertEqual( histograms['name'], "gray" )
+            self.assertEqual( histograms['fetch'].count, 4 )
+            self.assertTrue( histograms['composite'].count >= 4 )
+        finally:
+            tp.notifyThreadsToStop()
+            tp.joinThreads()
+
+
 if __name__=='__main__':
     ut.main()
@@ -10,6 +10,7 @@ from volumina.volumeEditorWidget import VolumeEditorWidget
 from volumina.widgets.layerwidget import LayerWidget
 
 from volumina.viewer import Viewer
+from volumina.offscreen import renderSlice
 
 from PyQt4.QtGui import QApplication
 import sys
@@ -4,6 +4,15 @@ import io, os
 default_config = """
 [pixelpipeline]
 verbose: false
+render_processes: 0
+render_threads: 0
+tile_size: 256
+disk_cache_dir:
+disk_cache_mb: 1024
+dirty_coalesce_ms: 20
+preview_level: 1
+batch_tiles: 0
+cache_memory_mb: 256
 """
 
 cfg = ConfigParser.SafeConfigParser()
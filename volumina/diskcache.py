@@ -0,0 +1,400 @@
+'''Persistent tile cache on disk.
+
+The tiles of expensive layers (e.g. predictions computed by lazyflow)
+are rendered again whenever a project is reopened, even if nothing
+changed. Layers with a cacheVersion (see Layer) keep their rendered
+tiles in a DiskTileStore, so that revisiting a slice in a later
+session reads the tiles from memory mapped files instead of computing
+them.
+
+A tile is stored under the layer id and cacheVersion of its layer, its
+slice (the projection axes and the full position of the slice, see
+ImageSource.sliceKey()) and its data rectangle and pyramid level. When
+a region of a layer becomes dirty, the tiles of the layer overlapping
+it are dropped; their files are removed by a background thread. The
+least recently used tiles are removed when the store exceeds its size.
+
+The store is disabled by default. Enable it with
+
+  [pixelpipeline]
+  disk_cache_dir: ~/.cache/volumina
+  disk_cache_mb: 1024
+
+in ~/.voluminarc or by calling enableDiskTileStore().
+
+'''
+import os
+import time
+import errno
+import shutil
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict, defaultdict, deque
+
+import numpy as np
+
+from PyQt4.QtGui import QImage
+from qimage2ndarray import raw_view
+
+from volumina.config import cfg
+
+# suffix of discarded tiles and of the directories of discarded layers
+_TRASH = '.discarded'
+# discards per layer remembered to check the tiles being rendered
+_DISCARDS = 64
+
+def _hash( key ):
+    return hashlib.sha1(repr(key)).hexdigest()
+
+def _remove( paths ):
+    for path in paths:
+        if os.path.isdir(path):
+            shutil.rmtree(path, ignore_errors=True)
+        else:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+def _removeInBackground( paths ):
+    thread = threading.Thread(target=_remove, args=(paths,),
+                              name='volumina disk cache cleanup')
+    thread.daemon = True
+    thread.start()
+
+def _fileName( tile, region ):
+    '''File name of a tile; holds its region, which is needed to find
+    the tiles of a dirty region in later sessions.'''
+    if region is None:
+        return _hash(tile) + '.npy'
+    plane, rect = region
+    return '%s.%s.%d_%d_%d_%d.npy' % ((_hash(tile), plane) + tuple(rect))
+
+def _regionOf( name ):
+    '''Region of a tile from its file name, None if unknown.'''
+    parts = name.split('.')
+    if len(parts) != 4:
+        return None
+    try:
+        rect = tuple(int(v) for v in parts[2].split('_'))
+    except ValueError:
+        return None
+    return (parts[1], rect) if len(rect) == 4 else None
+
+def _overlaps( a, b ):
+    '''Whether two regions overlap; an unknown region (None) overlaps
+    everything.'''
+    if a is None or b is None:
+        return True
+    (planeA, (xA, yA, wA, hA)), (planeB, (xB, yB, wB, hB)) = a, b
+    return planeA == planeB and xA < xB + wB and xB < xA + wA \
+        and yA < yB + hB and yB < yA + hA
+
+class DiskTileKey( object ):
+    '''Location of a tile in a DiskTileStore, see DiskTileStore.key().'''
+    def __init__( self, layer, path, region, generation ):
+        self.layer = layer
+        self.path = path
+        self.region = region
+        self.generation = generation
+
+class DiskTileRequest( object ):
+    '''Image request that reads a tile from a DiskTileStore.
+
+    If the tile has been removed in the meantime (e.g. by another
+    process sharing the store), the image request returned by
+    fallback() computes it instead.
+
+    '''
+    def __init__( self, store, key, fallback ):
+        self._store = store
+        self._key = key
+        self._fallback = fallback
+
+    def wait( self ):
+        start = time.time()
+        img = self._store.load( self._key )
+        if img is None:
+            return self._fallback().wait()
+        self.timings = (time.time() - start, 0.0)
+        return img
+
+    def cancel( self ):
+        pass
+
+#*******************************************************************************
+# D i s k T i l e S t o r e                                                    *
+#*******************************************************************************
+
+class DiskTileStore( object ):
+    def __init__( self, directory, maxbytes ):
+        '''directory -- where the tiles are stored, one subdirectory per
+                        layer and cacheVersion
+        maxbytes  -- size of the store on disk
+
+        Tiles stored by earlier sessions are found again; their
+        modification times give the least recently used order.
+
+        '''
+        self.directory = os.path.expanduser(directory)
+        self.maxbytes = maxbytes
+        self._lock = threading.Lock()
+        # path -> bytes, least recently used first
+        self._files = OrderedDict()
+        # layer directory -> paths of its tiles in _files
+        self._layerFiles = defaultdict(set)
+        # path -> region of the tile, see key()
+        self._regions = {}
+        self._nbytes = 0
+        # per layer: incremented when its tiles are dropped
+        self._generations = {}
+        # per layer: (generation, region) of its last discards
+        self._discards = {}
+        # layers whose tiles were stored or loaded in this session
+        self._inUse = set()
+        self._scan()
+
+    @property
+    def nbytes( self ):
+        '''Bytes occupied by the stored tiles.'''
+        return self._nbytes
+
+    def __len__( self ):
+        return len(self._files)
+
+    def key( self, layer, tile, region=None ):
+        '''Key of a tile.
+
+        layer  -- (layer id, cacheVersion) of the tile's layer
+        tile   -- identifies the tile within the layer (slice, data
+                  rectangle, level); must have a stable repr()
+        region -- (plane, rect): the tile covers rect (x, y, width,
+                  height) of the data in plane (e.g. the projection
+                  axes of its slice; must have a stable repr()); None
+                  if unknown. discard() drops the tiles of a region.
+
+        '''
+        if region is not None:
+            plane, rect = region
+            region = (_hash(plane)[:12], tuple(rect))
+        path = os.path.join(self.directory, _hash(layer), _fileName(tile, region))
+        with self._lock:
+            return DiskTileKey(layer, path, region, self._generations.get(layer, 0))
+
+    def request( self, key, fallback ):
+        '''Return a DiskTileRequest for a stored tile or None.'''
+        with self._lock:
+            if key.path not in self._files:
+                return None
+        return DiskTileRequest(self, key, fallback)
+
+    def load( self, key ):
+        '''Read a stored tile into a QImage; None if it is not stored.'''
+        with self._lock:
+            if key.path not in self._files:
+                return None
+            self._files[key.path] = self._files.pop(key.path)
+        try:
+            a = np.load(key.path, mmap_mode='r')
+            img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32_Premultiplied)
+            raw_view(img)[...] = a
+            del a
+            os.utime(key.path, None)
+        except (IOError, OSError, ValueError):
+            self._forget( key.path )
+            return None
+        with self._lock:
+            self._inUse.add( key.layer )
+        return img
+
+    def put( self, key, img ):
+        '''Store a tile, unless its region was discarded after the key
+        was made.'''
+        with self._lock:
+            if self._outdated( key ):
+                return
+        if img.format() != QImage.Format_ARGB32_Premultiplied:
+            img = img.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        layerDir = os.path.dirname(key.path)
+        try:
+            os.makedirs(layerDir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        # write and rename, so that readers never see partial tiles
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=layerDir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.save(f, raw_view(img))
+            nbytes = os.path.getsize(tmp)
+            os.rename(tmp, key.path)
+        except (IOError, OSError):
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            return
+        with self._lock:
+            if self._outdated( key ):
+                stale = True
+            else:
+                stale = False
+                self._nbytes += nbytes - self._files.pop(key.path, 0)
+                self._files[key.path] = nbytes
+                self._layerFiles[layerDir].add( key.path )
+                self._regions[key.path] = key.region
+                self._inUse.add( key.layer )
+                evicted = self._evict()
+        if stale:
+            self._unlink( key.path )
+        else:
+            for path in evicted:
+                self._unlink( path )
+
+    def discard( self, layer, region=None ):
+        '''Drop the tiles of a layer ((layer id, cacheVersion)) that
+        overlap region (see key()); all of them if region is None.
+
+        Called on every dirty notification of the layer. Tiles that
+        are being rendered are not stored if they overlap region. The
+        stored tiles are only dropped once the layer's tiles have been
+        used in this session: the notifications sent while a layer is
+        set up do not change the data its cacheVersion stands for.
+        Dropped tiles are forgotten at once, but their files are
+        removed by a background thread.
+
+        '''
+        if region is not None:
+            plane, rect = region
+            region = (_hash(plane)[:12], tuple(rect))
+        layerDir = os.path.join(self.directory, _hash(layer))
+        with self._lock:
+            generation = self._generations.get(layer, 0) + 1
+            self._generations[layer] = generation
+            self._discards.setdefault(layer, deque(maxlen=_DISCARDS)).append( (generation, region) )
+            if layer not in self._inUse:
+                return
+            files = self._layerFiles[layerDir]
+            paths = [path for path in files if _overlaps(region, self._regions.get(path))]
+            for path in paths:
+                files.discard( path )
+                self._regions.pop( path, None )
+                self._nbytes -= self._files.pop(path)
+            if not files:
+                del self._layerFiles[layerDir]
+        if not paths:
+            return
+        # move the files out of the way of new tiles and of later
+        # sessions right away; removing them takes longer
+        if region is None:
+            trash = tempfile.mkdtemp(suffix=_TRASH, dir=self.directory)
+            try:
+                os.rename(layerDir, os.path.join(trash, 'tiles'))
+            except OSError:
+                pass
+            trash = [trash]
+        else:
+            trash = []
+            for path in paths:
+                try:
+                    os.rename(path, path + _TRASH)
+                except OSError:
+                    continue
+                trash.append( path + _TRASH )
+        _removeInBackground( trash )
+
+    def _outdated( self, key ):
+        '''Whether the region of a key was discarded after the key was
+        made (lock held).'''
+        generation = self._generations.get(key.layer, 0)
+        if generation == key.generation:
+            return False
+        discards = self._discards.get(key.layer, ())
+        if len(discards) < generation - key.generation:
+            # not all the discards since are remembered
+            return True
+        return any(g > key.generation and _overlaps(region, key.region)
+                   for g, region in discards)
+
+    def _evict( self ):
+        '''Forget the least recently used tiles until the store fits
+        into maxbytes; returns their paths (lock held).'''
+        evicted = []
+        while self._nbytes > self.maxbytes and len(self._files) > 1:
+            path, nbytes = self._files.popitem(last=False)
+            self._nbytes -= nbytes
+            self._layerFiles[os.path.dirname(path)].discard( path )
+            self._regions.pop( path, None )
+            evicted.append( path )
+        return evicted
+
+    def _forget( self, path ):
+        with self._lock:
+            if path in self._files:
+                self._nbytes -= self._files.pop(path)
+                self._layerFiles[os.path.dirname(path)].discard( path )
+                self._regions.pop( path, None )
+
+    def _unlink( self, path ):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+
+    def _scan( self ):
+        if not os.path.isdir(self.directory):
+            return
+        found = []
+        for layerDir in os.listdir(self.directory):
+            layerDir = os.path.join(self.directory, layerDir)
+            if not os.path.isdir(layerDir):
+                continue
+            if layerDir.endswith(_TRASH):
+                # discarded, but not removed by an earlier session
+                _removeInBackground( [layerDir] )
+                continue
+            for name in os.listdir(layerDir):
+                path = os.path.join(layerDir, name)
+                if name.endswith('.tmp') or name.endswith(_TRASH):
+                    # left over by a crashed session
+                    self._unlink( path )
+                elif name.endswith('.npy'):
+                    st = os.stat(path)
+                    found.append( (st.st_mtime, path, st.st_size) )
+        for mtime, path, nbytes in sorted(found):
+            self._files[path] = nbytes
+            self._layerFiles[os.path.dirname(path)].add( path )
+            self._regions[path] = _regionOf( os.path.basename(path) )
+            self._nbytes += nbytes
+        for path in self._evict():
+            self._unlink( path )
+
+_diskTileStore = None
+_diskTileStoreConfigured = False
+_diskTileStoreLock = threading.Lock()
+
+def enableDiskTileStore( directory, maxbytes ):
+    '''Keep the tiles of layers with a cacheVersion in directory.'''
+    global _diskTileStore, _diskTileStoreConfigured
+    with _diskTileStoreLock:
+        _diskTileStore = DiskTileStore(directory, maxbytes)
+        _diskTileStoreConfigured = True
+
+def disableDiskTileStore():
+    '''Do not store tiles on disk (the default).'''
+    global _diskTileStore, _diskTileStoreConfigured
+    with _diskTileStoreLock:
+        _diskTileStore = None
+        _diskTileStoreConfigured = True
+
+def diskTileStore():
+    '''Return the active DiskTileStore or None.'''
+    global _diskTileStore, _diskTileStoreConfigured
+    if not _diskTileStoreConfigured:
+        with _diskTileStoreLock:
+            if not _diskTileStoreConfigured:
+                directory = cfg.get('pixelpipeline', 'disk_cache_dir')
+                if directory:
+                    _diskTileStore = DiskTileStore(directory,
+                                                   cfg.getint('pixelpipeline', 'disk_cache_mb') * 2**20)
+                _diskTileStoreConfigured = True
+    return _diskTileStore
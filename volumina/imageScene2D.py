@@ -1,4 +1,4 @@
-import numpy, math
+import numpy, math, time
 
 from PyQt4.QtCore import QRect, QRectF, QPointF, Qt, QSizeF, QLineF, QObject, pyqtSignal, SIGNAL
 from PyQt4.QtGui import QGraphicsScene, QTransform, QPen, QColor, QBrush, QPolygonF, QPainter, QGraphicsItem, \
@@ -8,6 +8,7 @@ from PyQt4.QtGui import QGraphicsScene, QTransform, QPen, QColor, QBrush, QPolyg
 from volumina.tiling import Tiling, TileProvider, TiledImageLayer
 from volumina.layerstack import LayerStackModel
 from volumina.pixelpipeline.imagepump import StackedImageSources
+from volumina.config import cfg
 
 import datetime
 import threading
@@ -74,6 +75,8 @@ class ImageScene2D(QGraphicsScene):
     an overlay stack, together with a 2D cursor.
     """
     axesChanged = pyqtSignal(int, bool)
+    # seconds without a step after which the scrolling counts as stopped
+    SCROLL_TIMEOUT = 1.0
 
     @property
     def stackedImageSources(self):
@@ -92,6 +95,42 @@ class ImageScene2D(QGraphicsScene):
         self._showTileOutlines = show
         self.invalidate()
 
+    @property
+    def blockSize(self):
+        '''Edge length of the tiles in data pixels.'''
+        return self._blockSize
+
+    @blockSize.setter
+    def blockSize(self, blockSize):
+        if blockSize != self._blockSize:
+            self._blockSize = blockSize
+            self._resetTiling()
+            QGraphicsScene.invalidate(self, self.sceneRect())
+
+    @property
+    def adaptiveTileSize(self):
+        '''Whether the tile size follows the measured rendering time
+        of the layers, see TileProvider.preferredBlockSize().
+
+        Off by default. Changing the tile size starts over with an
+        empty cache, so the size is only adapted when the slicing
+        position settles.
+
+        '''
+        return self._adaptiveTileSize
+
+    @adaptiveTileSize.setter
+    def adaptiveTileSize(self, adaptive):
+        self._adaptiveTileSize = adaptive
+
+    @property
+    def showMetrics(self):
+        return self._showMetrics
+    @showMetrics.setter
+    def showMetrics(self, show):
+        self._showMetrics = show
+        self.invalidate()
+
     @property
     def showTileProgress(self):
         return self._showTileProgress
@@ -148,8 +187,6 @@ class ImageScene2D(QGraphicsScene):
         t3 = QTransform.fromTranslate(*trans)
 
         self.data2scene = t1 * t2 * t3
-        if self._tileProvider:
-            self._tileProvider.axesSwapped = self._swapped
         self.axesChanged.emit(self._rotation, self._swapped)
 
     def rot90(self, transform, rect, direction):
@@ -178,7 +215,7 @@ class ImageScene2D(QGraphicsScene):
         self.scene2data, isInvertible = self.data2scene.inverted()
         self._setSceneRect()
         self._tiling.data2scene = self.data2scene
-        self._tileProvider._onSizeChanged()
+        self._tileProvider.viewMatrixChanged()
         QGraphicsScene.invalidate(self, self.sceneRect())
 
     @property
@@ -212,17 +249,35 @@ class ImageScene2D(QGraphicsScene):
         self._finishViewMatrixChange()
 
     def setCacheSize(self, cache_size):
-        if cache_size != self._tileProvider._cache_size:
-            self._tileProvider = TileProvider(self._tiling, self._stackedImageSources, cache_size=cache_size)
-            self._tileProvider.sceneRectChanged.connect(self.invalidateViewports)
+        '''Maximal number of stacks (slices) to keep in the tile cache.'''
+        self._cache_size = cache_size
+        self._tileProvider.cacheSize = cache_size
 
     def cacheSize(self):
-        return self._tileProvider._cache_size
+        return self._cache_size
+
+    def setCacheMemory(self, nbytes):
+        '''Maximal number of bytes occupied by the cached tiles.'''
+        self._cache_memory = nbytes
+        self._tileProvider.cacheMemory = nbytes
+
+    def cacheMemory(self):
+        return self._tileProvider.cacheMemory
 
     def setPrefetchingEnabled(self, enable):
         self._prefetching_enabled = enable
 
+    def setLevelOfDetailEnabled(self, enable):
+        '''Render downsampled tiles when the views are zoomed out.'''
+        self._level_of_detail = enable
+        self._tileProvider.levelOfDetail = enable
+        QGraphicsScene.invalidate(self, self.sceneRect())
+
+    def levelOfDetailEnabled(self):
+        return self._level_of_detail
+
     def setPreemptiveFetchNumber(self, n):
+        '''Maximal number of slices to prefetch.'''
         if n > self.cacheSize() - 1:
             self._n_preemptive = self.cacheSize() - 1
         else:
@@ -230,6 +285,14 @@ class ImageScene2D(QGraphicsScene):
     def preemptiveFetchNumber(self):
         return self._n_preemptive
 
+    def prefetchStatistics(self):
+        '''Prefetch hits and misses, see TileProvider.prefetchStatistics().'''
+        return self._tileProvider.prefetchStatistics()
+
+    def metrics(self):
+        '''Measurements of the rendering, see TileProvider.metrics().'''
+        return self._tileProvider.metrics()
+
     def invalidateViewports(self, sceneRectF):
         '''Call invalidate on the intersection of all observing viewport-rects and rectF.'''
         sceneRectF = sceneRectF if sceneRectF.isValid() else self.sceneRect()
@@ -242,13 +305,19 @@ class ImageScene2D(QGraphicsScene):
 
         """
         self.resetAxes(finish=False)
+        self._resetTiling()
 
-        self._tiling = Tiling(self._dataShape, self.data2scene, name=self.name)
+    def _resetTiling(self):
+        self._tiling = Tiling(self._dataShape, self.data2scene,
+                              blockSize=self._blockSize, name=self.name)
         self._brushingLayer  = TiledImageLayer(self._tiling)
 
         if self._tileProvider:
             self._tileProvider.notifyThreadsToStop() # prevent ref cycle
-        self._tileProvider = TileProvider(self._tiling, self._stackedImageSources)
+        self._tileProvider = TileProvider(self._tiling, self._stackedImageSources,
+                                          cache_size=self._cache_size,
+                                          cache_memory=self._cache_memory,
+                                          level_of_detail=self._level_of_detail)
         self._tileProvider.sceneRectChanged.connect(self.invalidateViewports)
 
         if self._dirtyIndicator:
@@ -262,7 +331,7 @@ class ImageScene2D(QGraphicsScene):
                  parent=None, name="Unnamed Scene",
                  swapped_default=False):
         """
-        * preemptive_fetch_number -- number of prefetched slices; 0 turns the feature off
+        * preemptive_fetch_number -- maximal number of prefetched slices; 0 turns the feature off
         * swapped_default -- whether axes should be swapped by default.
 
         """
@@ -279,10 +348,19 @@ class ImageScene2D(QGraphicsScene):
         self._stackedImageSources = StackedImageSources(LayerStackModel())
         self._showTileOutlines = False
         self._showTileProgress = True
+        self._showMetrics = False
 
         self._tileProvider = None
         self._dirtyIndicator = None
         self._prefetching_enabled = False
+        self._level_of_detail = False
+        self._cache_size = 100
+        self._cache_memory = None
+        # 0: start with 256 and adapt the tile size to the layers
+        # (see adaptiveTileSize)
+        tile_size = cfg.getint('pixelpipeline', 'tile_size')
+        self._blockSize = tile_size if tile_size > 0 else 256
+        self._adaptiveTileSize = tile_size <= 0
         
         self._swappedDefault = swapped_default
         self.reset()
@@ -290,11 +368,18 @@ class ImageScene2D(QGraphicsScene):
         # BowWave preemptive caching
         self.setPreemptiveFetchNumber(preemptive_fetch_number)
         self._course = (1,1) # (along, pos or neg direction)
+        # slices per second along the course and time of the last step
+        self._velocity = 0.0
+        self._lastStep = None
         self._time = self._posModel.time
         self._channel = self._posModel.channel
         self._posModel.timeChanged.connect(self._onTimeChanged)
         self._posModel.channelChanged.connect(self._onChannelChanged)
         self._posModel.slicingPositionChanged.connect(self._onSlicingPositionChanged)
+
+        # cursor position on this slice in data coordinates (see _onCursorPositionChanged)
+        self._cursorData = None
+        self._posModel.cursorPositionChanged.connect(self._onCursorPositionChanged)
         
         self._allTilesCompleteEvent = threading.Event()
 
@@ -336,7 +421,43 @@ class ImageScene2D(QGraphicsScene):
                 painter.setPen(pen)
                 painter.drawRect(self._tiling.imageRects[tileId])
 
+        if self._showMetrics and self._tileProvider is not None:
+            self._drawMetrics(painter)
+
+    def _drawMetrics(self, painter):
+        '''Draw the render metrics into the top left corner of the view.'''
+        m = self._tileProvider.metrics()
+        cache = m['cache']
+        lines = ["queued %d  running %d  incomplete tiles %.0f%%  cache %.0f/%s MB  evictions %d"
+                 % (m['queued'], m['running'], 100 * (1 - m['tiles']['hitRate']),
+                    cache['bytes'] / 2.0**20,
+                    "%.0f" % (cache['maxBytes'] / 2.0**20) if cache['maxBytes'] else "-",
+                    cache['evictions']),
+                 "requests: " + "  ".join("%s %d" % item for item in sorted(m['requests'].items()))]
+        for ims, layer in sorted(m['layers'].items(), key=lambda item: item[1]['name']):
+            lines.append("%s: fetch %.1f  convert %.1f  composite %.2f ms (p90)"
+                         % (layer['name'], 1000 * layer['fetch'].percentile(90),
+                            1000 * layer['convert'].percentile(90),
+                            1000 * layer['composite'].percentile(90)))
+
+        painter.save()
+        painter.setWorldMatrixEnabled(False)
+        lineHeight = painter.fontMetrics().height()
+        box = QRectF(0, 0, max(painter.fontMetrics().width(line) for line in lines) + 8,
+                     lineHeight * len(lines) + 8)
+        painter.fillRect(box, QColor(0, 0, 0, 160))
+        painter.setPen(QColor(Qt.white))
+        for i, line in enumerate(lines):
+            painter.drawText(4, 4 + painter.fontMetrics().ascent() + i * lineHeight, line)
+        painter.restore()
+
     def indicateSlicingPositionSettled(self, settled):
+        if settled:
+            # a new tile size drops the cache: at most once per
+            # scroll gesture, not on every step
+            self._adaptTileSize()
+        # coarse previews while scrolling, refined once settled
+        self._tileProvider.settled = settled
         if self._showTileProgress:
             self._dirtyIndicator.setVisible(settled)
 
@@ -344,7 +465,19 @@ class ImageScene2D(QGraphicsScene):
         if self._tileProvider is None:
             return
 
-        tiles = self._tileProvider.getTiles(sceneRectF)
+        # tiles near the viewport center and the cursor of the active
+        # view are rendered first
+        self._tileProvider.active = self._isActiveView()
+        views = self.views()
+        if views:
+            cursor = None
+            if self._cursorData is not None and self._tileProvider.active:
+                cursor = self.data2scene.map(self._cursorData)
+            self._tileProvider.setViewportFocus(views[0].viewportRect().center(), cursor)
+
+        # screen pixels per scene pixel, used to pick the pyramid level
+        scale = math.sqrt(abs(painter.transform().determinant()))
+        tiles = self._tileProvider.getTiles(sceneRectF, scale)
         allComplete = True
         for tile in tiles:
             #We always draw the tile, even though it might not be up-to-date
@@ -356,7 +489,8 @@ class ImageScene2D(QGraphicsScene):
             if tile.progress < 1.0:
                 allComplete = False
             if self._showTileProgress:
-                self._dirtyIndicator.setTileProgress(tile.id, tile.progress)
+                for tileId in self._indicatedTileIds(tile):
+                    self._dirtyIndicator.setTileProgress(tileId, tile.progress)
 
         if allComplete:
             self._allTilesCompleteEvent.set()
@@ -365,8 +499,17 @@ class ImageScene2D(QGraphicsScene):
 
         # preemptive fetching
         if self._prefetching_enabled:
-            for through in self._bowWave(self._n_preemptive):
-                self._tileProvider.prefetch(sceneRectF, through)
+            n = self._prefetchDepth(sceneRectF, scale)
+            self._tileProvider.prefetchSlices(sceneRectF, self._bowWave(n), scale)
+
+    def _indicatedTileIds(self, tile):
+        '''The ids of the full resolution tiles (the ones shown by the
+        dirty indicator) covered by a tile of any pyramid level.'''
+        if tile.tiling is self._tiling:
+            return (tile.id,)
+        dataRectF = tile.tiling.dataRectFs[tile.id]
+        return [i for i in self._tiling.tileIdsForDataRect(tile.tiling.dataRects[tile.id])
+                if dataRectF.contains(self._tiling.dataRectFs[i].center())]
 
     def joinRendering(self):
         return self._tileProvider.join()
@@ -405,22 +548,57 @@ class ImageScene2D(QGraphicsScene):
                 BowWave.append(tuple(t))
         return BowWave
 
-    def _onSlicingPositionChanged(self, new, old):
-        if (new[self._along[1] - 1] - old[self._along[1] - 1]) < 0:
-            self._course = (1, -1)
+    def _prefetchDepth(self, sceneRectF, scale):
+        '''Number of slices to prefetch along the course.
+
+        Enough slices to stay ahead of the user: while a slice is
+        rendered, the user moves on by velocity * render time slices.
+
+        '''
+        velocity = self._velocity
+        if self._lastStep is None or time.time() - self._lastStep > self.SCROLL_TIMEOUT:
+            velocity = 0.0
+        renderTime = self._tileProvider.sliceRenderTime(sceneRectF, scale)
+        depth = 1 + int(math.ceil(velocity * renderTime))
+        return min(depth, self._n_preemptive)
+
+    def _step(self, course, steps):
+        '''The slicing moved by steps along course[0].'''
+        if steps == 0:
+            return
+        self._course = (course, 1 if steps > 0 else -1)
+        now = time.time()
+        if self._lastStep is None or now - self._lastStep > self.SCROLL_TIMEOUT:
+            self._velocity = 0.0
         else:
-            self._course = (1, 1)
+            velocity = abs(steps) / max(now - self._lastStep, 1e-3)
+            self._velocity = 0.5 * self._velocity + 0.5 * velocity
+        self._lastStep = now
+
+    def _adaptTileSize(self):
+        '''Switch to the tile size preferred by the shown layers.'''
+        if not self._adaptiveTileSize:
+            return
+        blockSize = self._tileProvider.preferredBlockSize()
+        if blockSize is not None:
+            self.blockSize = blockSize
+
+    def _isActiveView(self):
+        # the slicing axis of this scene is the index of its view
+        return self._posModel.activeView == self._along[1] - 1
+
+    def _onCursorPositionChanged(self, new, old):
+        pos = list(new)
+        del pos[self._along[1] - 1]
+        self._cursorData = QPointF(pos[0], pos[1])
+
+    def _onSlicingPositionChanged(self, new, old):
+        self._step(1, new[self._along[1] - 1] - old[self._along[1] - 1])
 
     def _onChannelChanged(self, new):
-        if (new - self._channel) < 0:
-            self._course = (2, -1)
-        else:
-            self._course = (2, 1)
+        self._step(2, new - self._channel)
         self._channel = new
 
     def _onTimeChanged(self, new):
-        if (new - self._time) < 0:
-            self._course = (0, -1)
-        else:
-            self._course = (0, 1)
+        self._step(0, new - self._time)
         self._time = new
@@ -23,6 +23,8 @@ class Layer( QObject ):
     name -- string
     numberOfChannels -- int
     layerId -- any object that can uniquely identify this layer within a layerstack (by default, same as name)
+    cacheVersion -- identifies the data and display settings of this layer across sessions (e.g. a hash
+                    of its inputs); if not None, the rendered tiles are kept on disk, see volumina.diskcache
     '''
 
     '''changed is emitted whenever one of the more specialized
@@ -141,6 +143,7 @@ class Layer( QObject ):
         self._channel = 0
         self.direct = direct
         self._toolTip = ""
+        self.cacheVersion = None
 
         if self.direct:
             #in direct mode, we calculate the average time per tile for debug purposes
@@ -0,0 +1,75 @@
+'''Measurements of the render pipeline.
+
+The TileProvider records how long the layer tiles take to be fetched
+from the array sources, to be converted into images and to be blended
+into the tiles. See TileProvider.metrics().
+
+'''
+import math
+import threading
+
+import numpy
+
+#*******************************************************************************
+# L a t e n c y H i s t o g r a m                                              *
+#*******************************************************************************
+
+class LatencyHistogram( object ):
+    '''Histogram of durations with logarithmic bins.
+
+    The bins range from 10 microseconds to 100 seconds with BINS_PER_DECADE
+    bins per factor of ten; shorter and longer durations are counted in
+    the first and last bin. Adding a sample is thread safe.
+
+    '''
+    MIN = 1e-5
+    DECADES = 7
+    BINS_PER_DECADE = 10
+
+    def __init__( self ):
+        self._lock = threading.Lock()
+        self.counts = numpy.zeros(self.DECADES * self.BINS_PER_DECADE, dtype=numpy.int64)
+        self.total = 0.0
+        self.max = 0.0
+
+    def add( self, seconds ):
+        if seconds > self.MIN:
+            i = int(math.log10(seconds / self.MIN) * self.BINS_PER_DECADE)
+            i = min(i, len(self.counts) - 1)
+        else:
+            i = 0
+        with self._lock:
+            self.counts[i] += 1
+            self.total += seconds
+            self.max = max(self.max, seconds)
+
+    @property
+    def count( self ):
+        return int(self.counts.sum())
+
+    @property
+    def mean( self ):
+        n = self.count
+        return self.total / n if n else 0.0
+
+    def percentile( self, q ):
+        '''Upper bound of the bin containing the q-th percentile
+        (0 <= q <= 100) in seconds, or 0 without samples.'''
+        n = self.count
+        if not n:
+            return 0.0
+        i = numpy.searchsorted(numpy.cumsum(self.counts), math.ceil(n * q / 100.0))
+        return min(self.MIN * 10**((i + 1) / float(self.BINS_PER_DECADE)), self.max)
+
+    def copy( self ):
+        h = LatencyHistogram()
+        with self._lock:
+            h.counts[:] = self.counts
+            h.total = self.total
+            h.max = self.max
+        return h
+
+    def __repr__( self ):
+        return "<LatencyHistogram n=%d mean=%.1fms p50=%.1fms p90=%.1fms max=%.1fms>" \
+               % (self.count, 1000*self.mean, 1000*self.percentile(50),
+                  1000*self.percentile(90), 1000*self.max)
@@ -0,0 +1,203 @@
+'''Render slices without views.
+
+renderSlice() composes the layers of a LayerStackModel through the
+same image sources, render threads and tile composition as the views,
+but into an image of any size: batch renders for quality checks or
+screenshots larger than the screen, e.g.
+
+  rgba = renderSlice(layerstack, SliceProjection(1, 2, [0,3,4]),
+                     through=(0, 10, 0), sliceShape=(500, 400),
+                     size=(5000, 4000))
+
+renderFrames() renders a sequence of slices along one axis (e.g. the
+time points of a movie) while the next frames are rendered in the
+background on all render threads; exportFrames() saves them as
+numbered images and writeRawFrames() streams them, e.g. to a video
+encoder:
+
+  with open('frames.rgba', 'wb') as f:
+      writeRawFrames(f, renderFrames(layerstack, projection, (0, 10, 0),
+                                     (500, 400), axis=0, positions=range(1000)))
+
+'''
+import collections
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+
+from PyQt4.QtCore import QRect, QRectF
+from PyQt4.QtGui import QImage, QPainter
+from qimage2ndarray import rgb_view, alpha_view
+
+import numpy
+
+from volumina.tiling import Tiling, TileProvider
+from volumina.pixelpipeline.imagepump import ImagePump
+
+class _OffscreenRenderer( object ):
+    '''Renders slices of a layer stack into QImages of a fixed size.'''
+    def __init__( self, layerStack, sliceProjection, sliceShape, rect, size,
+                  blockSize, cache_size=2 ):
+        if rect is None:
+            rect = QRect(0, 0, sliceShape[0], sliceShape[1])
+        if size is None:
+            size = (rect.width(), rect.height())
+        self.rect = rect
+        self.size = size
+        self._sx = size[0] / float(rect.width())
+        self._sy = size[1] / float(rect.height())
+        self._rectF = QRectF(rect)
+        self._scale = min(self._sx, self._sy)
+
+        self._pump = ImagePump( layerStack, sliceProjection,
+                                sync_along=tuple(range(len(sliceProjection.along))) )
+        tiling = Tiling(tuple(sliceShape), blockSize=blockSize, name="offscreen")
+        self._tp = TileProvider(tiling, self._pump.stackedImageSources,
+                                cache_size=cache_size, level_of_detail=True)
+
+    def render( self, through, ahead=() ):
+        '''Render the slice at through while the slices at the
+        throughs in ahead are rendered in the background.'''
+        self._pump.syncedSliceSources.through = list(through)
+        tp = self._tp
+        tp.requestRefresh(self._rectF, self._scale)
+        if ahead:
+            tp.prefetchSlices(self._rectF, ahead, self._scale)
+        tp.join()
+        tiles = list(tp.getTiles(self._rectF, self._scale))
+        if any(tile.progress < 1.0 for tile in tiles):
+            # layers that became dirty while rendering
+            tp.join()
+            tiles = list(tp.getTiles(self._rectF, self._scale))
+
+        img = QImage(self.size[0], self.size[1], QImage.Format_ARGB32_Premultiplied)
+        img.fill(0xffffffff)
+        p = QPainter(img)
+        p.scale(self._sx, self._sy)
+        p.translate(-self.rect.x(), -self.rect.y())
+        for tile in tiles:
+            if tile.qimg is not None:
+                p.drawImage(tile.rectF, tile.qimg)
+        p.end()
+        return img
+
+    def close( self ):
+        self._tp.notifyThreadsToStop()
+        self._tp.joinThreads()
+        # the layer stack belongs to the caller
+        self._pump.close()
+
+def _rgba( img ):
+    img = img.convertToFormat(QImage.Format_ARGB32)
+    rgba = numpy.empty((img.height(), img.width(), 4), dtype=numpy.uint8)
+    rgba[:,:,0:3] = rgb_view(img)
+    rgba[:,:,3] = alpha_view(img)
+    return rgba
+
+def renderSlice( layerStack, sliceProjection, through, sliceShape, rect=None,
+                 size=None, blockSize=256 ):
+    '''Render a slice of the layers into an RGBA array.
+
+    layerStack      -- LayerStackModel
+    sliceProjection -- SliceProjection that selects the slice axes
+    through         -- position along each axis of sliceProjection.along
+    sliceShape      -- (width, height) of the slice in data pixels
+    rect            -- QRect of the slice to render in data coordinates
+                       (default: the whole slice)
+    size            -- (width, height) of the result (default: the size
+                       of rect); rect is stretched to fill it
+    blockSize       -- tile size used for rendering
+
+    The layers are composed onto white, like in the views. When the
+    result is smaller than rect, coarser pyramid levels are used.
+    Returns a numpy.uint8 array of shape (height, width, 4).
+
+    '''
+    renderer = _OffscreenRenderer(layerStack, sliceProjection, sliceShape,
+                                  rect, size, blockSize)
+    try:
+        return _rgba(renderer.render(through))
+    finally:
+        renderer.close()
+
+def _renderImages( layerStack, sliceProjection, through, sliceShape, axis, positions,
+                   rect, size, blockSize, ahead ):
+    '''Yield (position, QImage) for each position along axis.'''
+    if ahead is None:
+        ahead = multiprocessing.cpu_count()
+    positions = list(positions)
+    renderer = _OffscreenRenderer(layerStack, sliceProjection, sliceShape,
+                                  rect, size, blockSize, cache_size=ahead + 2)
+    def throughAt( position ):
+        t = list(through)
+        t[axis] = position
+        return tuple(t)
+    try:
+        for i, position in enumerate(positions):
+            wave = [throughAt(p) for p in positions[i + 1:i + 1 + ahead]]
+            yield position, renderer.render(throughAt(position), wave)
+    finally:
+        renderer.close()
+
+def renderFrames( layerStack, sliceProjection, through, sliceShape, axis, positions,
+                  rect=None, size=None, blockSize=256, ahead=None ):
+    '''Render a sequence of slices; a generator of (position, RGBA array).
+
+    axis      -- index into sliceProjection.along (and through) of the
+                 axis to step along, e.g. 0 for the time axis of
+                 SliceProjection(1, 2, [0,3,4])
+    positions -- positions along axis, in the order of the frames
+    ahead     -- number of following frames that are rendered in the
+                 background (default: number of cores)
+
+    The other arguments are the same as for renderSlice().
+
+    '''
+    for position, img in _renderImages(layerStack, sliceProjection, through, sliceShape,
+                                       axis, positions, rect, size, blockSize, ahead):
+        yield position, _rgba(img)
+
+def exportFrames( filenamePattern, layerStack, sliceProjection, through, sliceShape,
+                  axis, positions, rect=None, size=None, blockSize=256, ahead=None ):
+    '''Save a sequence of slices as numbered images.
+
+    filenamePattern -- e.g. 'frame%04d.png'; filled in with the frame
+                       number, the format follows from the extension
+
+    The images are encoded by a pool of threads while the next frames
+    are rendered. Returns the file names. The other arguments are the
+    same as for renderFrames().
+
+    '''
+    nthreads = multiprocessing.cpu_count()
+    pool = ThreadPool(nthreads)
+    def wait( filename, result ):
+        if not result.get():
+            raise IOError("could not save '%s'" % filename)
+    try:
+        saved = []
+        pending = collections.deque()
+        for frame, (position, img) in enumerate(_renderImages(
+                layerStack, sliceProjection, through, sliceShape, axis,
+                positions, rect, size, blockSize, ahead)):
+            filename = filenamePattern % frame
+            pending.append( (filename, pool.apply_async(img.save, (filename,))) )
+            saved.append( filename )
+            # do not keep more rendered frames than can be encoded
+            if len(pending) > 2 * nthreads:
+                wait( *pending.popleft() )
+        while pending:
+            wait( *pending.popleft() )
+        return saved
+    finally:
+        pool.close()
+        pool.join()
+
+def writeRawFrames( stream, frames ):
+    '''Write the RGBA arrays of (position, array) frames, as returned
+    by renderFrames(), to a file object one after another; e.g. for
+    'ffmpeg -f rawvideo -pix_fmt rgba -s WxH -i -'.'''
+    n = 0
+    for position, rgba in frames:
+        stream.write(numpy.ascontiguousarray(rgba).tostring())
+        n += 1
+    return n
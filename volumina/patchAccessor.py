@@ -70,21 +70,36 @@ class PatchAccessor():
         return QRectF(QPointF(startx, starty), QPointF(endx,endy))
 
     def getPatchesForRect(self,startx,starty,endx,endy):
+        return self.getPatchIdsForRect(startx, starty, endx, endy).tolist()
+
+    def getPatchIdsForRect(self,startx,starty,endx,endy):
+        """
+        Return the numbers of the patches intersecting with the given
+        rectangle as a numpy array, in row-major order.
+
+        The patches are looked up on the regular block grid, so the
+        cost only depends on the number of patches returned.
+        """
         sx = int(numpy.floor(1.0 * startx / self._blockSize))
         ex = int(numpy.ceil(1.0 * endx / self._blockSize))
         sy = int(numpy.floor(1.0 * starty / self._blockSize))
         ey = int(numpy.ceil(1.0 * endy / self._blockSize))
 
-        # Clip to rect bounds
+        # Clip to rect bounds; the merged last patches extend
+        # beyond the grid
+        if startx < self.size_x:
+            sx = min(sx, self._cX - 1)
+        if starty < self.size_y:
+            sy = min(sy, self._cY - 1)
         sx = max(sx, 0)
         sy = max(sy, 0)
         ex = min(ex, self._cX)
         ey = min(ey, self._cY)
 
-        nums = []
-        for y in range(sy,ey):
-            nums += range(y*self._cX+sx, y*self._cX+ex)
-        return nums
+        if sx >= ex or sy >= ey:
+            return numpy.zeros(0, dtype=int)
+        rows = numpy.arange(sy, ey) * self._cX
+        return (rows[:, numpy.newaxis] + numpy.arange(sx, ex)).ravel()
 
 if __name__ == "__main__":
     pa = PatchAccessor(1000,1000, 100)
@@ -94,3 +109,4 @@ if __name__ == "__main__":
     assert pa.patchRectF(1) == QRectF(100,0,100,100)
     
     assert pa.getPatchesForRect( 50, 50, 150, 150 ) == [0, 1, 10, 11]
+    assert list(pa.getPatchIdsForRect( 950, 0, 1000, 10 )) == [9]
@@ -1,7 +1,7 @@
 import threading
 import weakref
 from functools import partial
-from PyQt4.QtCore import QObject, pyqtSignal, QTimer
+from PyQt4.QtCore import QObject, pyqtSignal
 from asyncabcs import RequestABC, SourceABC
 import volumina
 from volumina.slicingtools import is_pure_slicing, slicing2shape, \
@@ -61,6 +61,8 @@ assert issubclass(ArrayRequest, RequestABC)
 
 class ArraySource( QObject ):
     isDirty = pyqtSignal( object )
+    # request() accepts slicings with steps
+    stridedRequests = True
 
     def __init__( self, array ):
         super(ArraySource, self).__init__()
@@ -334,6 +336,8 @@ assert issubclass(ConstantRequest, RequestABC)
 class ConstantSource( QObject ):
     isDirty = pyqtSignal( object )
     idChanged = pyqtSignal( object, object ) # old, new
+    # request() accepts slicings with steps
+    stridedRequests = True
 
     @property
     def constant( self ):
@@ -401,6 +405,9 @@ class MinMaxUpdateRequest( object ):
     def getResult(self):
         return self._result
 
+    def cancel( self ):
+        self._rawRequest.cancel()
+
 assert issubclass(MinMaxUpdateRequest, RequestABC)
 
 
@@ -422,11 +429,6 @@ class MinMaxSource( QObject ):
         self._rawSource = rawSource
         self._rawSource.isDirty.connect( self.isDirty )
         self._bounds = [1e9,-1e9]
-        
-        self._delayedDirtySignal = QTimer()
-        self._delayedDirtySignal.setSingleShot(True)
-        self._delayedDirtySignal.setInterval(10)
-        self._delayedDirtySignal.timeout.connect( partial(self.setDirty, sl[:,:,:,:,:]) )
             
     @property
     def dataSlot(self):
@@ -472,25 +474,10 @@ class MinMaxSource( QObject ):
             self._bounds[1] = max(self._bounds[0], dmax)
             self.boundsChanged.emit(self._bounds)
 
-            # Our min/max have changed, which means we must force the TileProvider to re-request all tiles.
-            # If we simply mark everything dirty now, then nothing changes for the tile we just rendered.
-            # (It was already dirty.  That's why we are rendering it right now.)
-            # And when this data gets back to the TileProvider that requested it, the TileProvider will mark this tile clean again.
-            # To ENSURE that the current tile is marked dirty AFTER the TileProvider has stored this data (and marked the tile clean),
-            #  we'll use a timer to set everything dirty.
-            # This fixes ilastik issue #418
-
-            # Finally, note that before this timer was added, the problem described above occurred at random due to a race condition:
-            # Sometimes the 'dirty' signal was processed BEFORE the data (bad) and sometimes it was processed after the data (good),
-            # due to the fact that the Qt signals are always delivered in the main thread.
-            # Perhaps a better way to fix this would be to store a timestamp in the TileProvider for dirty notifications, which 
-            # could be compared with the request timestamp before clearing the dirty state for each tile.
-
-            # Signal everything dirty with a timer, as described above.            
-            self._delayedDirtySignal.start()
-
-            # Now, that said, we can still give a slightly more snappy response to the OTHER tiles (not this one)
-            # if we immediately tell the TileProvider we are dirty.  This duplicates some requests, but that shouldn't be a big deal.
+            # Our min/max have changed, which means we must force the TileProvider to re-request all tiles,
+            # including the one whose data we are looking at right now. That tile may be stored after this
+            # dirty notification arrived; the TileProvider compares its request time with the time of the
+            # dirty notification and requests it again (see ilastik issue #418).
             self.setDirty( sl[:,:,:,:,:] )
 
 
@@ -0,0 +1,222 @@
+'''Pure numpy implementations of the image conversions.
+
+The kernels convert the 2D arrays delivered by the array sources into
+32 bit ARGB pixels for the toImage() methods of the requests in
+imagesources.py. They write directly into the pixel buffer of the
+resulting QImage (see imagesources.kernelImage()), so no intermediate
+image has to be converted. They neither depend on Qt nor on the
+request objects, so they can be executed in other processes as well
+(see processpool.py).
+
+Each kernel writes into 'out', a uint32 array with the shape of the
+input, where the pixel value is 0xAARRGGBB in native byte order,
+i.e. the memory layout of a QImage with a 32 bit format.
+
+Where the pixel value is a function of the data value alone, uint8 and
+uint16 data is converted with a lookup table of the pixel values of all
+data values (see lookupTable()), which is computed once per setting,
+e.g. per normalization range.
+
+'''
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+def _normalize255( a, normalize ):
+    '''Map normalize[0]..normalize[1] to 0..255 and clip (float result).'''
+    a = np.asarray(a, dtype=np.float32)
+    if normalize:
+        if normalize is True:
+            normalize = a.min(), a.max()
+        nmin, nmax = normalize
+        if nmin:
+            a = a - nmin
+        if nmax != nmin:
+            scale = 255. / (nmax - nmin)
+            if scale != 1.0:
+                a = a * scale
+    return np.clip(a, 0, 255)
+
+def _premultiply( c, alpha ):
+    '''Premultiply a color channel with alpha, rounding like Qt does.'''
+    t = c * alpha
+    return (t + (t >> 8) + 0x80) >> 8
+
+def _pack( out, r, g, b, alpha ):
+    out[...] = (alpha << 24) | (r << 16) | (g << 8) | b
+
+#*******************************************************************************
+# L o o k u p   T a b l e s                                                    *
+#*******************************************************************************
+
+# data types small enough to convert with a table
+_lookupTypes = (np.dtype(np.uint8), np.dtype(np.uint16))
+# (kernel name, dtype, repr(args)) -> table, least recently used first
+_lookupTables = OrderedDict()
+_lookupTablesLock = threading.Lock()
+# e.g. the ranges of the last steps of a contrast slider drag
+maxLookupTables = 8
+
+def lookupTable( kernel, dtype, args ):
+    '''Return the pixel values kernel(out, a, *args) yields for every
+    value of the uint8 or uint16 dtype, as a uint32 array indexed by
+    the data value.
+
+    The most recently used tables are cached.
+
+    '''
+    dtype = np.dtype(dtype)
+    key = (kernel.__name__, dtype.str, repr(args))
+    with _lookupTablesLock:
+        table = _lookupTables.pop(key, None)
+        if table is not None:
+            _lookupTables[key] = table
+            return table
+    values = np.arange(2**(8 * dtype.itemsize)).astype(dtype)
+    table = np.empty(len(values), dtype=np.uint32)
+    kernel(table, values, *args)
+    with _lookupTablesLock:
+        _lookupTables[key] = table
+        while len(_lookupTables) > maxLookupTables:
+            _lookupTables.popitem(last=False)
+    return table
+
+def _lookup( out, a, kernel, args ):
+    '''Convert uint8 and uint16 data with a lookupTable() of kernel;
+    returns False for other data.'''
+    if a.dtype not in _lookupTypes:
+        return False
+    np.take(lookupTable(kernel, a.dtype, args), a, out=out, mode='clip')
+    return True
+
+#*******************************************************************************
+# K e r n e l s                                                                *
+#*******************************************************************************
+
+def grayscale( out, a, normalize ):
+    '''Opaque gray values; see GrayscaleImageRequest.'''
+    if not _lookup(out, a, _grayscale, (normalize,)):
+        _grayscale(out, a, normalize)
+
+def _grayscale( out, a, normalize ):
+    if normalize:
+        a = np.clip(a, *normalize)
+    v = _normalize255(a, normalize).astype(np.uint32)
+    out[...] = 0xff000000 | (v * 0x010101)
+
+def alphaModulated( out, a, tint, normalize ):
+    '''Premultiplied tint color with the data as alpha; see
+    AlphaModulatedImageRequest.
+
+    tint -- (red, green, blue) in the range 0..1
+
+    '''
+    # with normalize=True, the range depends on the whole array
+    if normalize is True or not _lookup(out, a, _alphaModulated, (tuple(tint), normalize)):
+        _alphaModulated(out, a, tint, normalize)
+
+def _alphaModulated( out, a, tint, normalize ):
+    # computed in place in a few scratch arrays; the same as
+    # _pack(out, *[_premultiply(c, alpha) for c in (r, g, b)] + [alpha])
+    # with alpha = _normalize255(a) and r = _normalize255(a * tint[0]), ...
+    scratch = np.empty(a.shape, dtype=np.float32)
+    alpha = np.empty(a.shape, dtype=np.uint32)
+    channel = np.empty(a.shape, dtype=np.uint32)
+    shifted = np.empty(a.shape, dtype=np.uint32)
+
+    def normalized255( c, factor=None ):
+        np.copyto(scratch, a, casting='unsafe')
+        if factor is not None:
+            np.multiply(scratch, factor, out=scratch)
+        if normalize:
+            if normalize is True:
+                nmin, nmax = scratch.min(), scratch.max()
+            else:
+                nmin, nmax = normalize
+            if nmin:
+                np.subtract(scratch, nmin, out=scratch)
+            if nmax != nmin:
+                scale = 255. / (nmax - nmin)
+                if scale != 1.0:
+                    np.multiply(scratch, scale, out=scratch)
+        np.clip(scratch, 0, 255, out=scratch)
+        np.copyto(c, scratch, casting='unsafe')
+
+    normalized255(alpha)
+    np.left_shift(alpha, 24, out=out)
+    for f, shift in zip(tint, (16, 8, 0)):
+        normalized255(channel, f)
+        # premultiply like _premultiply()
+        channel *= alpha
+        np.right_shift(channel, 8, out=shifted)
+        channel += shifted
+        channel += 0x80
+        channel >>= 8
+        if shift:
+            channel <<= shift
+        out |= channel
+
+def argbTable( table ):
+    '''Pack a color table of shape (N, 4) in B, G, R, A memory order
+    into N uint32 pixel values 0xAARRGGBB.'''
+    table = np.ascontiguousarray(table, dtype=np.uint8)
+    return table.view('<u4').ravel().astype(np.uint32)
+
+def colortable( out, a, table, normalize ):
+    '''Non-premultiplied colors looked up in table; see
+    ColortableImageRequest.
+
+    table -- pixel values as returned by argbTable(), or a uint8
+             array of shape (N, 4) in B, G, R, A memory order
+
+    Values outside the table wrap around. The indices are computed
+    into a single scratch array and looked up straight into out.
+
+    '''
+    table = np.asarray(table)
+    if table.ndim == 2:
+        table = argbTable(table)
+    n = len(table)
+    integer = issubclass(a.dtype.type, np.integer)
+    # int64 indices computed here are wrapped in place
+    scratch = None
+    if normalize:
+        nmin, nmax = normalize
+        scale = (n - 1) / float(nmax - nmin + 1e-35)
+        scaled = np.subtract(a, nmin, dtype=np.float64)
+        if scale != 1.0:
+            np.multiply(scaled, scale, out=scaled)
+        a = scratch = scaled.astype(np.int64)
+    elif not integer:
+        a = scratch = a.astype(np.int64)
+    elif (issubclass(a.dtype.type, np.unsignedinteger)
+          and n >= 2**(8 * a.dtype.itemsize)):
+        # every value is an index into the table, e.g. uint8 labels
+        np.take(table, a, out=out, mode='clip')
+        return
+    if n & (n - 1) == 0:
+        # the same as remainder for tables of 2**k colors, also for
+        # negative values
+        index = np.bitwise_and(a, n - 1, out=scratch)
+    else:
+        index = np.remainder(a, n, out=scratch)
+    np.take(table, index, out=out, mode='clip')
+
+def rgba( out, r, g, b, a, normalizes ):
+    '''Premultiplied composition of four channels; see RGBAImageRequest.
+
+    normalizes -- (normalizeR, normalizeG, normalizeB, normalizeA);
+                  None for channels that are used as they are
+
+    '''
+    channels = []
+    for c, normalize in zip((r, g, b, a), normalizes):
+        if normalize is not None:
+            c = c.astype(np.float32)
+            c = (c - normalize[0])*255.0 / (normalize[1]-normalize[0])
+            c = np.clip(c, 0, 255)
+        channels.append(np.asarray(c).astype(np.uint8).astype(np.uint32))
+    r, g, b, alpha = channels
+    _pack(out, _premultiply(r, alpha), _premultiply(g, alpha),
+          _premultiply(b, alpha), alpha)
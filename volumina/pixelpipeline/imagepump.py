@@ -1,13 +1,52 @@
 #Python
+import time
+import threading
 from functools import partial
 
 #PyQt
-from PyQt4.QtCore import QObject, pyqtSignal, QRect
+from PyQt4.QtCore import QObject, pyqtSignal, QRect, QTimer
 
 #volumina
 from volumina.pixelpipeline.slicesources import SliceSource, SyncedSliceSources
 from volumina.pixelpipeline.imagesourcefactories import createImageSource
 from volumina.pixelpipeline.imagesources import AlphaModulatedImageSource, ColortableImageSource
+from volumina.config import cfg
+
+def coalesceRect( rects, rect, maxRects=16 ):
+    '''Add a rectangle to a list of coalesced rectangles in place.
+
+    The rectangle is merged with the rectangles in the list whose
+    bounding rectangle with it is not larger than both of them
+    together, e.g. duplicates, contained, overlapping or adjacent
+    rectangles. If more than maxRects remain, they are replaced by
+    their bounding rectangle.
+
+    '''
+    area = lambda r: r.width() * r.height()
+    i = 0
+    while i < len(rects):
+        united = rects[i].united(rect)
+        if area(united) <= area(rects[i]) + area(rect):
+            # the grown rect may merge with rects it missed before
+            rect = united
+            del rects[i]
+            i = 0
+        else:
+            i += 1
+    rects.append(rect)
+    if len(rects) > maxRects:
+        rects[:] = [reduce(QRect.united, rects)]
+
+def coalesceRects( rects, maxRects=16 ):
+    '''Merge rectangles into fewer ones covering the same area.
+
+    See coalesceRect(). At most maxRects rectangles are returned.
+
+    '''
+    coalesced = []
+    for rect in rects:
+        coalesceRect( coalesced, rect, maxRects )
+    return coalesced
 
 class StackedImageSources( QObject ):
     """Manages an ordered stack of image sources.
@@ -35,6 +74,8 @@ class StackedImageSources( QObject ):
     sizeChanged  = pyqtSignal()
     orderChanged = pyqtSignal()
     stackIdChanged = pyqtSignal( object, object ) # old id, new id
+    # starts the dirty timer in its own thread
+    _startDirtyTimer = pyqtSignal( int )
 
     @property
     def stackId( self ):
@@ -93,6 +134,21 @@ class StackedImageSources( QObject ):
         super(StackedImageSources, self).__init__()
         self._layerStackModel = layerStackModel
 
+        # dirty notifications of an image source that follow each
+        # other within this many seconds are coalesced
+        self._dirtyInterval = cfg.getint('pixelpipeline', 'dirty_coalesce_ms') / 1000.0
+        self._dirtyLock = threading.Lock()
+        # image source -> pending coalesced dirty rects, None if all
+        # is dirty
+        self._pendingDirty = {}
+        # image source -> end of its current coalescing window
+        self._dirtyWindowEnd = {}
+        self._dirtyTimer = QTimer(self)
+        self._dirtyTimer.setSingleShot(True)
+        self._dirtyTimer.timeout.connect(self.flushDirty)
+        self._startDirtyTimer.connect(self._dirtyTimer.start)
+        self._dirtyTimerStarted = False
+
         # we need to store partial functions to which we connect
         # for later disconnection
         self._curryRegistry = {'I':{}, "O":{}, "V":{}, "Id":{}}
@@ -180,6 +236,12 @@ class StackedImageSources( QObject ):
         assert( len(self.getRegisteredLayers() ) == 0 )
         self.sizeChanged.emit()
 
+    def close( self ):
+        '''Deregister all layers and stop observing the layer stack.'''
+        self.clear()
+        self._layerStackModel.orderChanged.disconnect( self._onOrderChanged )
+        self._layerStackModel.layerRemoved.disconnect( self._onLayerRemoved )
+
     def getRegisteredLayers( self ):
         return self._layerToIms.keys()
 
@@ -214,8 +276,50 @@ class StackedImageSources( QObject ):
         else:
             raise KeyError()
 
+    def flushDirty( self ):
+        '''Emit the pending coalesced dirty notifications now.'''
+        with self._dirtyLock:
+            pending, self._pendingDirty = self._pendingDirty, {}
+            # a timer still running finds nothing pending
+            self._dirtyTimerStarted = False
+            windowEnd = time.time() + self._dirtyInterval
+            for ims in pending:
+                self._dirtyWindowEnd[ims] = windowEnd
+        for ims, rects in pending.iteritems():
+            if ims not in self._imsToLayer:
+                continue # deregistered in the meantime
+            for rect in ([QRect()] if rects is None else rects):
+                self.layerDirty.emit( ims, rect )
+
     def _onImageSourceDirty( self, imageSource, rect ):
-        self.layerDirty.emit( imageSource, rect )
+        # Data sources can send bursts of dirty notifications (e.g.
+        # during live prediction). The first one after a quiet period
+        # is passed on right away, the following ones are collected
+        # and passed on, merged, at the end of a short time window.
+        if self._dirtyInterval <= 0:
+            self.layerDirty.emit( imageSource, rect )
+            return
+        with self._dirtyLock:
+            now = time.time()
+            if imageSource not in self._pendingDirty \
+               and now >= self._dirtyWindowEnd.get(imageSource, 0):
+                self._dirtyWindowEnd[imageSource] = now + self._dirtyInterval
+                emit = True
+            else:
+                emit = False
+                rects = self._pendingDirty.setdefault(imageSource, [])
+                if not rect.isValid():
+                    # an invalid rect means everything is dirty
+                    self._pendingDirty[imageSource] = None
+                elif rects is not None:
+                    coalesceRect( rects, rect )
+                if not self._dirtyTimerStarted:
+                    self._dirtyTimerStarted = True
+                    delay = max(self._dirtyWindowEnd[imageSource] - now, 0)
+                    # queued if the notification comes from another thread
+                    self._startDirtyTimer.emit( int(delay * 1000) )
+        if emit:
+            self.layerDirty.emit( imageSource, rect )
 
     def _onOpacityChanged( self, layer, opacity ):
         self._updateOcclusionInfo()
@@ -253,6 +357,9 @@ class StackedImageSources( QObject ):
 
         del self._imsToLayer[ims]
         del self._layerToIms[layer]
+        with self._dirtyLock:
+            self._pendingDirty.pop(ims, None)
+            self._dirtyWindowEnd.pop(ims, None)
 
         self._updateOcclusionInfo()
 
@@ -323,6 +430,18 @@ class ImagePump( object ):
         self._layerStackModel.layerRemoved.connect( self._onLayerRemoved )
         self._layerStackModel.stackCleared.connect( self._onStackCleared )
 
+    def close( self ):
+        '''Stop observing the layer stack and the data sources of its
+        layers; the pump cannot be used anymore.'''
+        self._layerStackModel.layerAdded.disconnect( self._onLayerAdded )
+        self._layerStackModel.layerRemoved.disconnect( self._onLayerRemoved )
+        self._layerStackModel.stackCleared.disconnect( self._onStackCleared )
+        self._syncedSliceSources.idChanged.disconnect( self._onIdChanged )
+        for sliceSources in self._layerToSliceSrcs.itervalues():
+            for ss in sliceSources:
+                ss.close()
+        self._stackedImageSources.close()
+
     # mappings
     def layerToSliceSources( self, layer ):
         '''Map from Layer instance to SliceSource instances.
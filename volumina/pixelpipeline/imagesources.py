@@ -7,12 +7,15 @@ except:
 
 from PyQt4.QtCore import QObject, QRect, pyqtSignal, QMutex
 from PyQt4.QtGui import QImage, QColor
-from qimage2ndarray import gray2qimage, array2qimage, alpha_view, rgb_view, byte_view
+from qimage2ndarray import alpha_view, rgb_view, byte_view, raw_view
 from asyncabcs import SourceABC, RequestABC
 from volumina.slicingtools import is_bounded, slicing2rect, rect2slicing, slicing2shape, is_pure_slicing
 from volumina.config import cfg
+from processpool import processPool
+import imagekernels
 import numpy as np
 import warnings
+import time
 
 _has_vigra = True
 try:
@@ -20,6 +23,105 @@ try:
 except ImportError:
     _has_vigra = False
 
+def kernelImage( kernel, arrays, args=(), format=QImage.Format_ARGB32_Premultiplied, pool=None ):
+    '''Convert 2D arrays into a QImage with one of the imagekernels.
+
+    The kernel writes directly into the pixel buffer of the result, so
+    no intermediate image has to be allocated and converted. If a
+    RenderProcessPool is given, the kernel is executed in one of its
+    worker processes.
+
+    '''
+    if pool is not None:
+        return pool.toImage(kernel, arrays, args, format=format)
+    shape = arrays[0].shape
+    img = QImage(shape[1], shape[0], format)
+    kernel(raw_view(img), *(list(arrays) + list(args)))
+    return img
+
+def timedWait( imageRequest, arrayRequests ):
+    '''Wait for the array requests and convert their results with
+    imageRequest.toImage().
+
+    The seconds spent waiting for the data and converting it are
+    stored as imageRequest.timings = (fetch, convert).
+
+    '''
+    start = time.time()
+    for req in arrayRequests:
+        req.wait()
+    fetched = time.time()
+    img = imageRequest.toImage()
+    imageRequest.timings = (fetched - start, time.time() - fetched)
+    return img
+
+#*******************************************************************************
+# D o w n s a m p l i n g                                                      *
+#*******************************************************************************
+
+def downsample2D( a, factor, method='nearest' ):
+    '''Reduce a 2D array by an integer factor along both axes.
+
+    method -- 'nearest' picks every factor-th value, which keeps
+              label values intact; 'mean' averages factor x factor
+              blocks, which is appropriate for raw data
+
+    Incomplete blocks at the borders are reduced as well, so the
+    result has the shape ceil(a.shape / factor).
+
+    '''
+    if factor == 1:
+        return a
+    if method == 'nearest':
+        return a[::factor, ::factor]
+    if method != 'mean':
+        raise ValueError("downsample2D: unknown method '%s'" % method)
+
+    h, w = a.shape
+    H, W = -(-h // factor), -(-w // factor)
+    # sum the blocks one axis after the other; the temporary is
+    # factor times smaller than a
+    sums = np.add.reduceat(a, np.arange(0, h, factor), axis=0, dtype=np.float32)
+    sums = np.add.reduceat(sums, np.arange(0, w, factor), axis=1)
+    countsY = np.minimum(factor, h - np.arange(H) * factor)
+    countsX = np.minimum(factor, w - np.arange(W) * factor)
+    result = sums / np.outer(countsY, countsX)
+    if issubclass(a.dtype.type, np.integer):
+        result = np.round(result)
+    return result.astype(a.dtype)
+
+class DownsampledArrayRequest( object ):
+    '''Wraps a request for a 2D array and downsamples its result.'''
+    def __init__( self, arrayrequest, factor, method='nearest' ):
+        self._arrayreq = arrayrequest
+        self._factor = factor
+        self._method = method
+        self._result = None
+
+    def wait( self ):
+        self._arrayreq.wait()
+        return self.getResult()
+
+    def getResult( self ):
+        if self._result is None:
+            self._result = downsample2D(self._arrayreq.getResult(),
+                                        self._factor, self._method)
+        return self._result
+
+    def cancel( self ):
+        self._arrayreq.cancel()
+
+    def submit( self ):
+        self._arrayreq.submit()
+
+    def notify( self, callback, **kwargs ):
+        self._arrayreq.notify(self._onNotify, package = (callback, kwargs))
+
+    def _onNotify( self, result, package ):
+        callback, kwargs = package
+        callback(self.getResult(), **kwargs)
+assert issubclass(DownsampledArrayRequest, RequestABC)
+
 #*******************************************************************************
 # I m a g e S o u r c e                                                        *
 #*******************************************************************************
@@ -31,9 +133,15 @@ class ImageSource( QObject ):
     isDirty -- a rectangular region has changed; transmits
                an empty QRect if the whole image is dirty
 
+    Image sources render coarser pyramid levels when request() is
+    called with a level > 0: the image of a rect at level n has
+    1/2**n of the rect's width and height. How the data is reduced is
+    given by the 'reduction' attribute (see downsample2D()).
+
     '''
 
     isDirty = pyqtSignal( QRect )
+    reduction = 'nearest'
 
     def __init__( self, guarantees_opaqueness = False, parent = None, direct=False ):
         ''' direct: whether this request will be computed synchronously in the GUI thread (direct=True)
@@ -44,9 +152,57 @@ class ImageSource( QObject ):
         self._opaque = guarantees_opaqueness
         self.direct = direct
 
-    def request( self, rect, along_through=None ):
+    def request( self, rect, along_through=None, level=0 ):
         raise NotImplementedError
 
+    def _requestArray( self, arraySource2D, qrect, along_through, level ):
+        '''Request the 2D data of qrect, downsampled to pyramid level.'''
+        slicing = rect2slicing(qrect)
+        if level > 0 and self.reduction == 'nearest' \
+           and getattr(arraySource2D, 'stridedRequests', False):
+            # pick every 2**level-th value right at the source
+            slicing = tuple(slice(s.start, s.stop, 2**level) for s in slicing)
+            return arraySource2D.request(slicing, along_through)
+        req = arraySource2D.request(slicing, along_through)
+        if level > 0:
+            req = DownsampledArrayRequest(req, 2**level, self.reduction)
+        return req
+
+    def requestsLessData( self ):
+        '''Whether requests at levels > 0 fetch less data from the
+        array sources instead of downsampling the full resolution
+        afterwards (see _requestArray()).'''
+        return self.reduction == 'nearest' and \
+            all(getattr(source, 'stridedRequests', False)
+                for source in self._arraySources())
+
+    def _arraySources( self ):
+        '''The 2D array sources the image is rendered from.'''
+        source = getattr(self, '_arraySource2D', None)
+        return [] if source is None else [source]
+
+    def sliceKey( self, along_through=None ):
+        '''Identify the slice rendered by request() with along_through,
+        e.g. to store its tiles beyond the session (see diskcache.py).
+
+        Per array source, the key holds the axes of its slice
+        projection and its full through position with along_through
+        applied; None for array sources that are not SliceSources.
+
+        '''
+        key = []
+        for source in self._arraySources():
+            projection = getattr(source, 'sliceProjection', None)
+            if projection is None:
+                key.append( None )
+                continue
+            through = source.through
+            for axis, value in along_through or ():
+                through[axis] = value
+            key.append( ((projection.abscissa, projection.ordinate, tuple(projection.along)),
+                         tuple(through)) )
+        return tuple(key)
+
     def setDirty( self, slicing ):
         '''Mark a region of the image as dirty.
 
@@ -84,6 +240,7 @@ class GrayscaleImageSource( ImageSource ):
     def __init__( self, arraySource2D, layer ):
         assert isinstance(arraySource2D, SourceABC), 'wrong type: %s' % str(type(arraySource2D))
         super(GrayscaleImageSource, self).__init__( guarantees_opaqueness = True, direct=layer.direct )
+        self.reduction = 'mean'
         self._arraySource2D = arraySource2D
 
         self._layer = layer
@@ -91,7 +248,7 @@ class GrayscaleImageSource( ImageSource ):
         self._arraySource2D.isDirty.connect(self.setDirty)
         self._layer.normalizeChanged.connect(lambda: self.setDirty((slice(None,None), slice(None,None))))
 
-    def request( self, qrect, along_through=None ):
+    def request( self, qrect, along_through=None, level=0 ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  GrayscaleImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d)" \
@@ -100,8 +257,7 @@ class GrayscaleImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
-        req = self._arraySource2D.request(s, along_through)
+        req = self._requestArray(self._arraySource2D, qrect, along_through, level)
         return GrayscaleImageRequest( req, self._layer.normalize[0], direct=self.direct )
 assert issubclass(GrayscaleImageSource, SourceABC)
 
@@ -113,22 +269,18 @@ class GrayscaleImageRequest( object ):
         self.direct = direct
 
     def wait(self):
-        self._arrayreq.wait()
-        return self.toImage()
+        return timedWait(self, [self._arrayreq])
         
     def toImage( self ):
         a = self._arrayreq.getResult()
         assert a.ndim == 2, "GrayscaleImageRequest.toImage(): result has shape %r, which is not 2-D" % (a.shape,)
         
-        normalize = self._normalize 
-        if normalize:
-            #clipping has been implemented in this commit,
-            #but it is not yet available in the packages obtained via easy_install
-            #http://www.informatik.uni-hamburg.de/~meine/hg/qimage2ndarray/diff/fcddc70a6dea/qimage2ndarray/__init__.py
-            a = np.clip(a, *normalize)
-        img = gray2qimage(a, normalize)
-        return img.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        pool = None if self.direct else processPool()
+        return kernelImage(imagekernels.grayscale, [a], (self._normalize,), pool=pool)
             
+    def cancel( self ):
+        self._arrayreq.cancel()
+
     def notify( self, callback, **kwargs ):
         self._arrayreq.notify(self._onNotify, package = (callback, kwargs))
     
@@ -147,12 +299,13 @@ class AlphaModulatedImageSource( ImageSource ):
     def __init__( self, arraySource2D, layer ):
         assert isinstance(arraySource2D, SourceABC), 'wrong type: %s' % str(type(arraySource2D))
         super(AlphaModulatedImageSource, self).__init__()
+        self.reduction = 'mean'
         self._arraySource2D = arraySource2D
         self._layer = layer
 
         self._arraySource2D.isDirty.connect(self.setDirty)
 
-    def request( self, qrect, along_through=None ):
+    def request( self, qrect, along_through=None, level=0 ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  AlphaModulatedImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d)" \
@@ -161,8 +314,7 @@ class AlphaModulatedImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
-        req = self._arraySource2D.request(s, along_through)
+        req = self._requestArray(self._arraySource2D, qrect, along_through, level)
         return AlphaModulatedImageRequest( req, self._layer.tintColor, self._layer.normalize[0] )
 assert issubclass(AlphaModulatedImageSource, SourceABC)
 
@@ -174,22 +326,17 @@ class AlphaModulatedImageRequest( object ):
         self._tintColor = tintColor
 
     def wait(self):
-        self._arrayreq.wait()
-        return self.toImage()
+        return timedWait(self, [self._arrayreq])
 
     def toImage( self ):
         a = self._arrayreq.getResult()
-        shape = a.shape + (4,)
-        d = np.empty(shape, dtype=np.float32)
-        d[:,:,0] = a[:,:]*self._tintColor.redF()
-        d[:,:,1] = a[:,:]*self._tintColor.greenF()
-        d[:,:,2] = a[:,:]*self._tintColor.blueF()
-        d[:,:,3] = a[:,:]
-
-        normalize = self._normalize
-        img = array2qimage(d, normalize)
-        return img.convertToFormat(QImage.Format_ARGB32_Premultiplied)        
+        tint = (self._tintColor.redF(), self._tintColor.greenF(), self._tintColor.blueF())
+        return kernelImage(imagekernels.alphaModulated, [a], (tint, self._normalize),
+                           pool=processPool())
             
+    def cancel( self ):
+        self._arrayreq.cancel()
+
     def notify( self, callback, **kwargs ):
         self._arrayreq.notify(self._onNotify, package = (callback, kwargs))
     
@@ -234,9 +381,11 @@ class ColortableImageSource( ImageSource ):
             self._colorTable[i,1] = color.green()
             self._colorTable[i,2] = color.red()
             self._colorTable[i,3] = color.alpha() 
+        # the same colors as pixel values, for the numpy conversion
+        self._argbTable = imagekernels.argbTable(self._colorTable)
         self.isDirty.emit(QRect()) # empty rect == everything is dirty
         
-    def request( self, qrect, along_through=None ):
+    def request( self, qrect, along_through=None, level=0 ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  ColortableImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d) = %r" \
@@ -245,27 +394,36 @@ class ColortableImageSource( ImageSource ):
             volumina.printLock.release()
             
         assert isinstance(qrect, QRect)
-        s = rect2slicing(qrect)
-        req = self._arraySource2D.request(s, along_through)
-        return ColortableImageRequest( req, self._colorTable, self._layer.normalize[0], self.direct )
+        # label values must not be averaged: use the default
+        # nearest neighbour reduction
+        req = self._requestArray(self._arraySource2D, qrect, along_through, level)
+        return ColortableImageRequest( req, self._colorTable, self._layer.normalize[0], self.direct,
+                                       self._argbTable )
 assert issubclass(ColortableImageSource, SourceABC)
 
 class ColortableImageRequest( object ):
-    def __init__( self, arrayrequest, colorTable, normalize, direct=False ):
+    def __init__( self, arrayrequest, colorTable, normalize, direct=False, argbTable=None ):
         self._mutex = QMutex()
         self._arrayreq = arrayrequest
         self._colorTable = colorTable
+        if argbTable is None:
+            argbTable = imagekernels.argbTable(colorTable)
+        self._argbTable = argbTable
         self.direct = direct
         self._normalize = normalize
 
     def wait(self):
-        self._arrayreq.wait()
-        return self.toImage()
+        return timedWait(self, [self._arrayreq])
         
     def toImage( self ):
         a = self._arrayreq.getResult()
         assert a.ndim == 2
 
+        pool = None if self.direct else processPool()
+        if pool is not None or not (_has_vigra and hasattr(vigra.colors, 'applyColortable')):
+            return kernelImage(imagekernels.colortable, [a], (self._argbTable, self._normalize),
+                               format=QImage.Format_ARGB32, pool=pool)
+
         if self._normalize:
             nmin, nmax = self._normalize
             if nmin:
@@ -280,33 +438,19 @@ class ColortableImageRequest( object ):
             elif len(self._colorTable) <= 2**32:
                 a = np.asarray( a, dtype=np.uint32 )
 
-        # Use vigra if possible (much faster)
-        if _has_vigra and hasattr(vigra.colors, 'applyColortable'):
-            img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32)
-            if not issubclass( a.dtype.type, np.integer ):
-                #FIXME: maybe this should be done in a better way using an operator before the colortable request which properly handles 
-                #this problem 
-                import warnings
-                warnings.warn("Data for colortable layers cannot be float, casting",RuntimeWarning)
-                a=a.astype(np.int32)
-            vigra.colors.applyColortable(a, self._colorTable, byte_view(img))
-
-        # Without vigra, do it the slow way 
-        else:
-            if _has_vigra:
-                # If this warning is annoying you, try this:
-                # warnings.filterwarnings("once")
-                warnings.warn("Using slow colortable images.  Upgrade to VIGRA > 1.9 to use faster implementation.")
-
-            #make sure that a has values in range [0, colortable_length)
-            a = np.remainder(a, len(self._colorTable))
-            #apply colortable
-            colortable = np.roll(np.fliplr(self._colorTable), -1, 1) # self._colorTable is BGRA, but array2qimage wants RGBA
-            img = colortable[a]
-            img = array2qimage(img)
-
+        # vigra is much faster
+        img = QImage(a.shape[1], a.shape[0], QImage.Format_ARGB32)
+        if not issubclass( a.dtype.type, np.integer ):
+            #FIXME: maybe this should be done in a better way using an operator before the colortable request which properly handles 
+            #this problem 
+            warnings.warn("Data for colortable layers cannot be float, casting",RuntimeWarning)
+            a=a.astype(np.int32)
+        vigra.colors.applyColortable(a, self._colorTable, byte_view(img))
         return img 
             
+    def cancel( self ):
+        self._arrayreq.cancel()
+
     def notify( self, callback, **kwargs ):
         self._arrayreq.notify(self._onNotify, package = (callback, kwargs))
     
@@ -337,11 +481,12 @@ class RGBAImageSource( ImageSource ):
                 assert isinstance(channel, SourceABC) , 'channel has wrong type: %s' % str(type(channel))
 
         super(RGBAImageSource, self).__init__( guarantees_opaqueness = guarantees_opaqueness )
+        self.reduction = 'mean'
         self._channels = channels
         for arraySource in self._channels:
             arraySource.isDirty.connect(self.setDirty)
 
-    def request( self, qrect, along_through=None ):
+    def request( self, qrect, along_through=None, level=0 ):
         if cfg.getboolean('pixelpipeline', 'verbose'):
             volumina.printLock.acquire()
             print Fore.RED + "  RGBAImageSource '%s' requests (x=%d, y=%d, w=%d, h=%d)" \
@@ -351,14 +496,16 @@ class RGBAImageSource( ImageSource ):
             
         assert isinstance(qrect, QRect)
         s = rect2slicing( qrect )
-        r = self._channels[0].request(s, along_through)
-        g = self._channels[1].request(s, along_through)
-        b = self._channels[2].request(s, along_through)
-        a = self._channels[3].request(s, along_through)
-        shape = list( slicing2shape(s) )
+        r, g, b, a = [self._requestArray(channel, qrect, along_through, level)
+                      for channel in self._channels]
+        f = 2**level
+        shape = [-(-x // f) for x in slicing2shape(s)]
         assert len(shape) == 2
         assert all([x > 0 for x in shape])
         return RGBAImageRequest( r, g, b, a, shape, *self._layer._normalize )
+
+    def _arraySources( self ):
+        return self._channels
 assert issubclass(RGBAImageSource, SourceABC)
 
 class RGBAImageRequest( object ):
@@ -367,29 +514,18 @@ class RGBAImageRequest( object ):
         self._mutex = QMutex()
         self._requests = r, g, b, a
         self._normalize = [normalizeR, normalizeG, normalizeB, normalizeA]
-        shape.append(4)
-        self._data = np.empty(shape, dtype=np.uint8)
         self._requestsFinished = 4 * [False,]
 
     def wait(self):
-        for req in self._requests:
-            req.wait()
-        return self.toImage()
+        return timedWait(self, self._requests)
 
     def toImage( self ):
-        for i, req in enumerate(self._requests):
-            a = self._requests[i].getResult()
-            if self._normalize[i] is not None:
-
-                normalize = self._normalize[i]
-                a = a.astype(np.float32)
-                a = (a - normalize[0])*255.0 / (normalize[1]-normalize[0])
-                a[a > 255] = 255
-                a[a < 0]   = 0
-                a = a.astype(np.uint8)
-            self._data[:,:,i] = a
-        img = array2qimage(self._data)
-        return img.convertToFormat(QImage.Format_ARGB32_Premultiplied)        
+        return kernelImage(imagekernels.rgba, [req.getResult() for req in self._requests],
+                           (self._normalize,), pool=processPool())
+
+    def cancel( self ):
+        for req in self._requests:
+            req.cancel()
 
     def notify( self, callback, **kwargs ):
         for i in xrange(4):
@@ -411,10 +547,11 @@ assert issubclass(RGBAImageRequest, RequestABC)
 
 class RandomImageSource( ImageSource ):
     '''Random noise image for testing and debugging.'''
-    def request( self, qrect, along_through=None ):
+    def request( self, qrect, along_through=None, level=0 ):
         assert isinstance(qrect, QRect)
         s = rect2slicing(qrect)
-        shape = slicing2shape( s )
+        f = 2**level
+        shape = tuple(-(-x // f) for x in slicing2shape( s ))
         return RandomImageRequest( shape )
 assert issubclass(RandomImageSource, SourceABC)
 
@@ -425,8 +562,10 @@ class RandomImageRequest( object ):
     def wait(self):
         d = (np.random.random(self.shape) * 255).astype(np.uint8)        
         assert d.ndim == 2
-        img = gray2qimage(d)
-        return img.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        return kernelImage(imagekernels.grayscale, [d], (None,))
+
+    def cancel( self ):
+        pass
             
     def notify( self, callback, **kwargs ):
         img = self.wait()
@@ -0,0 +1,143 @@
+'''Optional process pool for the image conversions.
+
+The conversion of the raw slices into images (normalization,
+colorization, channel composition) is pure numpy work that holds the
+GIL for most of its runtime, so the tile worker threads of the
+TileProvider do not scale with the number of cores. When the process
+pool is enabled, the image requests hand their arrays to one of the
+kernels in imagekernels.py, which is executed in a worker process.
+
+The arrays travel through shared memory (memory mapped files in
+/dev/shm, if available), the kernel writes its ARGB32 result directly
+into a shared output buffer that is finally copied into the QImage.
+Only the file names and the small kernel parameters are pickled.
+
+The pool is disabled by default. Enable it with
+
+  [pixelpipeline]
+  render_processes: 8
+
+in ~/.voluminarc or by calling enableProcessPool(). As the
+calling tile worker threads merely wait for the worker processes, the
+TileProvider should be configured with roughly as many threads as
+there are processes.
+
+'''
+import os
+import tempfile
+import threading
+import multiprocessing
+
+import numpy as np
+
+from PyQt4.QtGui import QImage
+from qimage2ndarray import raw_view
+
+from volumina.config import cfg
+
+_sharedMemoryDir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+
+def _sharedFile( nbytes ):
+    fd, name = tempfile.mkstemp(prefix='volumina-', dir=_sharedMemoryDir)
+    try:
+        os.ftruncate(fd, max(nbytes, 1))
+    finally:
+        os.close(fd)
+    return name
+
+def _toShared( a ):
+    a = np.asarray(a)
+    name = _sharedFile(a.nbytes)
+    m = np.memmap(name, dtype=a.dtype, mode='r+', shape=a.shape)
+    m[...] = a
+    del m
+    return (name, a.dtype.str, a.shape)
+
+def _fromShared( spec, mode='r' ):
+    name, dtype, shape = spec
+    return np.memmap(name, dtype=np.dtype(dtype), mode=mode, shape=shape)
+
+def _runKernel( kernel, inputs, output, args ):
+    '''Executed in the worker process.'''
+    arrays = [_fromShared(spec) for spec in inputs]
+    out = _fromShared(output, mode='r+')
+    kernel(out, *(arrays + list(args)))
+    out.flush()
+
+#*******************************************************************************
+# R e n d e r P r o c e s s P o o l                                            *
+#*******************************************************************************
+
+class RenderProcessPool( object ):
+    def __init__( self, processes=None ):
+        '''processes -- number of worker processes (default: number of cores)'''
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self._pool = multiprocessing.Pool(processes)
+
+    def toImage( self, kernel, arrays, args=(), format=QImage.Format_ARGB32_Premultiplied ):
+        '''Run kernel(out, *(arrays + args)) in a worker process.
+
+        arrays -- 2D numpy arrays of equal shape, passed via shared memory
+        args   -- further (picklable) kernel parameters
+        format -- 32 bit QImage format of the result
+
+        Blocks the calling thread (but not the GIL) until the image
+        is ready.
+
+        '''
+        shape = np.asarray(arrays[0]).shape
+        assert len(shape) == 2
+        inputs = []
+        output = (_sharedFile(4*shape[0]*shape[1]), np.dtype(np.uint32).str, shape)
+        try:
+            for a in arrays:
+                inputs.append(_toShared(a))
+            self._pool.apply(_runKernel, (kernel, inputs, output, tuple(args)))
+            img = QImage(shape[1], shape[0], format)
+            raw_view(img)[...] = _fromShared(output)
+            return img
+        finally:
+            for spec in inputs + [output]:
+                os.unlink(spec[0])
+
+    def close( self ):
+        self._pool.close()
+        self._pool.join()
+
+_processPool = None
+_processPoolConfigured = False
+_processPoolLock = threading.Lock()
+
+def enableProcessPool( processes=None ):
+    '''Render images in a pool of worker processes from now on.'''
+    global _processPool, _processPoolConfigured
+    with _processPoolLock:
+        old = _processPool
+        _processPool = RenderProcessPool(processes)
+        _processPoolConfigured = True
+    if old is not None:
+        old.close()
+
+def disableProcessPool():
+    '''Render images in the requesting threads (the default).'''
+    global _processPool, _processPoolConfigured
+    with _processPoolLock:
+        old = _processPool
+        _processPool = None
+        _processPoolConfigured = True
+    if old is not None:
+        old.close()
+
+def processPool():
+    '''Return the active RenderProcessPool or None.'''
+    global _processPool, _processPoolConfigured
+    if not _processPoolConfigured:
+        with _processPoolLock:
+            if not _processPoolConfigured:
+                processes = cfg.getint('pixelpipeline', 'render_processes')
+                if processes > 0:
+                    _processPool = RenderProcessPool(processes)
+                _processPoolConfigured = True
+    return _processPool
@@ -82,6 +82,11 @@ class SliceSource( QObject ):
         self._datasource.isDirty.connect(self._onDatasourceDirty)
         self._through = len(sliceProjection.along) * [0]
 
+    @property
+    def stridedRequests( self ):
+        '''request() accepts slicings with steps (see ArraySource).'''
+        return getattr(self._datasource, 'stridedRequests', False)
+
     def setThrough( self, index, value ):
         assert index < len(self.through)
         through = list(self.through)
@@ -120,6 +125,10 @@ class SliceSource( QObject ):
             print Fore.RED + "SliceSource requests '%r' from data source '%s'" % (slicing, self._datasource.name) + Fore.RESET
             volumina.printLock.release()
         return SliceRequest(self._datasource.request(slicing), self.sliceProjection)
+
+    def close( self ):
+        '''Stop observing the data source.'''
+        self._datasource.isDirty.disconnect(self._onDatasourceDirty)
         
     def setDirty( self, slicing ):
         assert isinstance(slicing, tuple)
@@ -109,7 +109,7 @@ def slicing2shape( slicing ):
     slicing = box(slicing)
     shape = []
     for sl in slicing:
-        shape.append(sl.stop - sl.start)
+        shape.append(-(-(sl.stop - sl.start) // (sl.step or 1)))
     return tuple(shape)
 
 def index2slice( slicing ):
@@ -0,0 +1,251 @@
+'''Render threads shared by all TileProviders.
+
+Instead of starting its own threads, every TileProvider registers as a
+client of one process-wide RenderThreadPool and submits its work items
+(layer tile requests and tile compositions) to it. The pool keeps a
+single priority queue for all clients, so the items of all views are
+processed in one global order, and its worker threads sleep on a
+condition variable while there is nothing to do.
+
+The number of threads defaults to the number of cores. Change it with
+
+  [pixelpipeline]
+  render_threads: 8
+
+in ~/.voluminarc.
+
+'''
+import sys
+import time
+import heapq
+import itertools
+import threading
+import multiprocessing
+from Queue import Full
+
+import volumina
+from volumina.config import cfg
+
+class _Client( object ):
+    def __init__( self, handler, maxQueued, maxRunning ):
+        self.handler = handler
+        self.maxQueued = maxQueued
+        self.maxRunning = maxRunning
+        self.queued = 0
+        self.running = 0
+        # queued and running items that join() waits for
+        self.unfinished = 0
+        self.removed = False
+
+#*******************************************************************************
+# R e n d e r T h r e a d P o o l                                              *
+#*******************************************************************************
+
+class RenderThreadPool( object ):
+    def __init__( self, nthreads=None ):
+        '''nthreads -- number of worker threads (default: number of cores)'''
+        if nthreads is None:
+            nthreads = multiprocessing.cpu_count()
+        self._cond = threading.Condition()
+        # (priority, seq, owner, item, background)
+        self._heap = []
+        self._seq = itertools.count()
+        self._clients = {}
+        self._threads = []
+        self.ensureThreads( nthreads )
+
+    @property
+    def nthreads( self ):
+        return len(self._threads)
+
+    def ensureThreads( self, nthreads ):
+        '''Start more worker threads if there are less than nthreads.'''
+        with self._cond:
+            while len(self._threads) < nthreads:
+                thread = threading.Thread(target=self._worker,
+                                          name='volumina render thread %d' % len(self._threads))
+                thread.daemon = True
+                self._threads.append( thread )
+                thread.start()
+
+    def aliveThreads( self ):
+        '''Return a map of thread identifiers and their alive status.'''
+        return dict((thread.ident, thread.isAlive())
+                    for thread in self._threads if thread.ident)
+
+    def addClient( self, owner, handler, maxQueued=None, maxRunning=None ):
+        '''Register owner, whose items are processed by handler(item).
+
+        maxQueued  -- submit() raises Queue.Full when that many items
+                      of owner are queued
+        maxRunning -- items of owner that are processed at the same
+                      time (default: no limit besides the threads)
+
+        '''
+        if maxRunning is not None:
+            self.ensureThreads( maxRunning )
+        with self._cond:
+            self._clients[owner] = _Client(handler, maxQueued, maxRunning)
+
+    def removeClient( self, owner ):
+        '''Unregister owner and drop its queued items.
+
+        Returns the dropped items. Items that are processed right now
+        are finished.
+
+        '''
+        with self._cond:
+            # in one go, so that no item of owner can be submitted
+            # after its queued items have been dropped
+            items = self._discard( owner )
+            client = self._clients.get( owner )
+            if client is not None:
+                client.removed = True
+                if client.running == 0:
+                    del self._clients[owner]
+        return items
+
+    def submit( self, owner, priority, item, background=False ):
+        '''Queue an item; items with the smallest priority come first.
+
+        join() does not wait for background items. Returns False and
+        drops the item if owner has been removed.
+
+        '''
+        with self._cond:
+            client = self._clients.get( owner )
+            if client is None or client.removed:
+                return False
+            if client.maxQueued is not None and client.queued >= client.maxQueued:
+                raise Full()
+            heapq.heappush(self._heap, (priority, next(self._seq), owner, item, background))
+            client.queued += 1
+            if not background:
+                client.unfinished += 1
+            self._cond.notify()
+            return True
+
+    def reprioritize( self, owner, priority ):
+        '''Recompute the priorities of owner's queued items with
+        priority(item).'''
+        with self._cond:
+            self._heap = [(priority(item) if o is owner else p, seq, o, item, background)
+                          for p, seq, o, item, background in self._heap]
+            heapq.heapify(self._heap)
+
+    def discard( self, owner ):
+        '''Drop all queued items of owner and return them.'''
+        with self._cond:
+            return self._discard( owner )
+
+    def _discard( self, owner ):
+        '''discard() with the lock held.'''
+        dropped = [entry for entry in self._heap if entry[2] is owner]
+        if not dropped:
+            return []
+        self._heap = [entry for entry in self._heap if entry[2] is not owner]
+        heapq.heapify(self._heap)
+        client = self._clients.get( owner )
+        if client is not None:
+            client.queued -= len(dropped)
+            client.unfinished -= sum(1 for entry in dropped if not entry[4])
+        self._cond.notify_all()
+        return [entry[3] for entry in dropped]
+
+    def load( self, owner ):
+        '''Return the numbers of queued and running items of owner.'''
+        with self._cond:
+            client = self._clients.get( owner )
+            if client is None:
+                return 0, 0
+            return client.queued, client.running
+
+    def join( self, owner, timeout=None, background=False ):
+        '''Wait until all items of owner that are not in the background
+        (or, if background is True, all items) have been processed.
+
+        Returns False if the timeout (in seconds) expired.
+
+        '''
+        if background:
+            predicate = lambda client: client.queued == 0 and client.running == 0
+        else:
+            predicate = lambda client: client.unfinished == 0
+        return self._waitFor( predicate, owner, timeout )
+
+    def joinRunning( self, owner, timeout=None ):
+        '''Wait until no item of owner is processed anymore.'''
+        return self._waitFor( lambda client: client.running == 0, owner, timeout )
+
+    def _waitFor( self, predicate, owner, timeout ):
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                client = self._clients.get( owner )
+                if client is None or predicate( client ):
+                    return True
+                if deadline is None:
+                    self._cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self._cond.wait( remaining )
+
+    def _next( self ):
+        '''Pop the first item whose owner may run another item.'''
+        postponed = []
+        entry = None
+        while self._heap:
+            candidate = heapq.heappop(self._heap)
+            client = self._clients.get( candidate[2] )
+            if client is None:
+                # the owner has been removed
+                continue
+            if client.maxRunning is None or client.running < client.maxRunning:
+                entry = candidate
+                break
+            postponed.append( candidate )
+        for candidate in postponed:
+            heapq.heappush(self._heap, candidate)
+        return entry
+
+    def _worker( self ):
+        while True:
+            with self._cond:
+                entry = self._next()
+                while entry is None:
+                    self._cond.wait()
+                    entry = self._next()
+                priority, seq, owner, item, background = entry
+                client = self._clients[owner]
+                client.queued -= 1
+                client.running += 1
+            try:
+                client.handler( item )
+            except:
+                with volumina.printLock:
+                    sys.excepthook( *sys.exc_info() )
+                    sys.stderr.write("ERROR: volumina render thread caught an unhandled exception.  See above.")
+            finally:
+                with self._cond:
+                    client.running -= 1
+                    if not background:
+                        client.unfinished -= 1
+                    if (client.removed and client.running == 0
+                        and self._clients.get( owner ) is client):
+                        del self._clients[owner]
+                    self._cond.notify_all()
+
+_renderThreadPool = None
+_renderThreadPoolLock = threading.Lock()
+
+def renderThreadPool():
+    '''Return the RenderThreadPool shared by all TileProviders.'''
+    global _renderThreadPool
+    if _renderThreadPool is None:
+        with _renderThreadPoolLock:
+            if _renderThreadPool is None:
+                nthreads = cfg.getint('pixelpipeline', 'render_threads')
+                _renderThreadPool = RenderThreadPool(nthreads if nthreads > 0 else None)
+    return _renderThreadPool
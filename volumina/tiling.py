@@ -1,21 +1,29 @@
 #Python
 import sys
 import time
+import math
+import bisect
+import itertools
 import collections
 import warnings
 from collections import defaultdict, OrderedDict
-from threading import Thread, Lock
-from Queue import Queue, Empty, Full, LifoQueue
+from threading import Lock
+from Queue import Full
 
 #SciPy
 import numpy
 
 #PyQt
-from PyQt4.QtCore import QRect, QRectF, QMutex, QObject, pyqtSignal, Qt
+from PyQt4.QtCore import QRect, QRectF, QSize, QMutex, QObject, pyqtSignal, Qt
 from PyQt4.QtGui import QImage, QPainter, QTransform, QColor
+from qimage2ndarray import alpha_view
 
 #volumina
 from patchAccessor import PatchAccessor
+from volumina.config import cfg
+from volumina.threadpool import renderThreadPool
+from volumina.metrics import LatencyHistogram
+from volumina.diskcache import diskTileStore
 import volumina
 
 #*******************************************************************************
@@ -76,17 +84,23 @@ class Tiling(object):
     blockSize  -- base tile size: blockSize x blockSize (default 256)
     overlap    -- overlap between tiles positive number prevents rendering
                   artifacts between tiles for certain zoom levels (default 1)
+    level      -- pyramid level; a tile of level n covers
+                  (blockSize * 2**n)^2 data pixels, but is rendered into
+                  an image of at most blockSize x blockSize pixels
+                  (default 0)
 
     '''
 
     def __init__(self, sliceShape, data2scene=QTransform(),
                  blockSize=256, overlap=0, overlap_draw=1e-3,
-                 name="Unnamed Tiling"):
+                 name="Unnamed Tiling", level=0):
         self.blockSize = blockSize
         self.overlap = overlap
+        self.level = level
+        self.downsamplingFactor = 2**level
         self._patchAccessor = PatchAccessor(sliceShape[0],
                                             sliceShape[1],
-                                            blockSize=self.blockSize)
+                                            blockSize=self.blockSize * self.downsamplingFactor)
         self._overlap_draw = overlap_draw
         self._overlap = overlap
 
@@ -98,8 +112,17 @@ class Tiling(object):
         self.imageRects  = [None]*numPatches
         self.dataRects   = [None]*numPatches
         self.tileRects   = [None]*numPatches
+        self.imageSizes  = [None]*numPatches
         self.sliceShape  = sliceShape
         self.name = name
+
+        # the data rectangles (with overlap) do not depend on the
+        # orientation of the scene
+        for patchNr in range(numPatches):
+            dataRectF = self._patchAccessor.patchRectF(patchNr, self.overlap)
+            self.dataRectFs[patchNr] = dataRectF
+            self.dataRects[ patchNr] = dataRectF.toAlignedRect()
+
         self.data2scene = data2scene
 
     @property
@@ -146,11 +169,32 @@ class Tiling(object):
                               round(imageRectF.height()))
 
             self.imageRectFs[patchNr] = imageRectF
-            self.dataRectFs[ patchNr] = imageRectF
             self.tileRectFs[ patchNr] = patchRectF
             self.imageRects[ patchNr] = imageRect
             self.tileRects[  patchNr] = patchRect
 
+            # size of the rendered patch image; smaller than the image
+            # rectangle for levels > 0
+            f = self.downsamplingFactor
+            self.imageSizes[ patchNr] = QSize(-(-imageRect.width() // f),
+                                              -(-imageRect.height() // f))
+
+    @property
+    def maxLevel(self):
+        '''Coarsest useful pyramid level: the level at which a single
+        tile covers the whole slice.'''
+        extent = max(self.sliceShape) if len(self.sliceShape) else 0
+        level = 0
+        while self.blockSize * 2**level < extent:
+            level += 1
+        return level
+
+    def atLevel(self, level):
+        '''Return a Tiling of the same slice at another pyramid level.'''
+        return Tiling(self.sliceShape, self.data2scene,
+                      blockSize=self.blockSize, overlap=self.overlap,
+                      overlap_draw=self._overlap_draw,
+                      name=self.name, level=level)
 
     def boundingRectF(self):
         if self.tileRectFs:
@@ -176,6 +220,21 @@ class Tiling(object):
                             rect.bottomRight().x(), rect.bottomRight().y() )
         return patchNumbers
 
+    def tileIdsForDataRect(self, dataRect):
+        '''Return the numbers of the tiles whose images cover parts
+        of dataRect (in data coordinates) as a numpy array.
+
+        An invalid rect stands for the whole slice.
+
+        '''
+        if not dataRect.isValid():
+            return numpy.arange(len(self))
+        o = self.overlap
+        return self._patchAccessor.getPatchIdsForRect(
+            dataRect.x() - o, dataRect.y() - o,
+            dataRect.x() + dataRect.width() + o,
+            dataRect.y() + dataRect.height() + o)
+
     def __len__(self):
         return len(self.imageRectFs)
 
@@ -197,32 +256,6 @@ class TiledImageLayer(object):
         for i in range(len(self._tiling)):
             yield self[i]
 
-class _MultiCache( object ):
-    def __init__( self, first_uid, default_factory=lambda:None,
-                  maxcaches=None ):
-        self._maxcaches = maxcaches
-        self.caches = OrderedDict()
-        self.add( first_uid, default_factory=default_factory)
-
-    def add( self, uid, default_factory=lambda:None ):
-        if uid not in self.caches:
-            cache = defaultdict(default_factory)
-            self.caches[uid] = cache
-        else:
-            raise Exception('MultiCache.add: uid %s is already in use' % str(uid))
-
-        # remove oldest cache, if necessary
-        old_uid = None
-        if self._maxcaches and len(self.caches) > self._maxcaches:
-            old_uid, v = self.caches.popitem(False) # removes item in LIFO order
-        return old_uid
-
-    def touch( self, uid ):
-        c = self.caches[uid]
-        del self.caches[uid]
-        self.caches[uid] = c
-
-
 from functools import wraps
 def synchronous( tlockname ):
     """A decorator to place an instance based lock around a method """
@@ -240,113 +273,612 @@ def synchronous( tlockname ):
     return _synched
 
 
+def _imageBytes( img ):
+    return img.byteCount() if img is not None else 0
+
+def _isOpaqueImage( img ):
+    '''True if no pixel of a layer tile is (partially) transparent.'''
+    if not img.hasAlphaChannel():
+        return True
+    if img.depth() != 32:
+        return False
+    return bool((alpha_view(img) == 255).all())
+
+class _StackCache( object ):
+    '''Tiles and layer tiles of a single stack.
+
+    The state is kept in arrays indexed by tile id and, for layer
+    tiles, by (layer slot, tile id).
+
+    '''
+    def __init__( self, nslots, ntiles ):
+        self.tiles = numpy.empty(ntiles, dtype=object)
+        self.progress = numpy.zeros(ntiles, dtype=numpy.float32)
+        self.tileDirty = numpy.ones(ntiles, dtype=bool)
+        self.layers = numpy.empty((nslots, ntiles), dtype=object)
+        self.layerDirty = numpy.ones((nslots, ntiles), dtype=bool)
+        self.layerTimestamp = numpy.zeros((nslots, ntiles))
+        # time of the last dirty notification of the layer tile
+        self.layerDirtyTime = numpy.zeros((nslots, ntiles))
+        # the cached layer tile has no transparent pixels
+        self.layerOpaque = numpy.zeros((nslots, ntiles), dtype=bool)
+        # layers of the tile have to be requested again: an opaque
+        # layer tile was replaced by a transparent one (uncovering the
+        # layers below it) or a layer tile was outdated on arrival
+        self.rerequest = numpy.zeros(ntiles, dtype=bool)
+        # layers that changed since the tile was composed last, and
+        # the single layer that changed before that (-1 if none)
+        self.layerChanged = numpy.zeros((nslots, ntiles), dtype=bool)
+        self.lastChanged = numpy.empty(ntiles, dtype=int)
+        self.lastChanged.fill(-1)
+        self.partials = numpy.empty(ntiles, dtype=object)
+        # bytes of all QImages in tiles, layers and partials
+        self.nbytes = 0
+
+class _PartialComposite( object ):
+    '''The composites of the layers below and above a pivot layer.
+
+    signature -- identifies the order, visibility and opacity of the
+                 other layers the composites were made with
+    below     -- opaque composite of the layers below the pivot
+    above     -- transparent composite of the layers above the pivot
+                 or None
+
+    '''
+    def __init__( self, pivot, signature, below, above ):
+        self.pivot = pivot
+        self.signature = signature
+        self.below = below
+        self.above = above
+
+    @property
+    def nbytes( self ):
+        return _imageBytes(self.below) + _imageBytes(self.above)
+
 class _TilesCache( object ):
-    def __init__(self, first_stack_id, sims, maxstacks=None):
+    '''Cache of the layer tiles and composed tiles of several stacks.
+
+    Each image source of the StackedImageSources gets a fixed layer
+    slot; the cache has to be recreated when image sources are added
+    or removed. Tile ids range from 0 to ntiles-1. The bulk methods
+    accept everything numpy can index an axis with as tile ids,
+    e.g. an array of tile ids or slice(None) for all tiles.
+
+    The cache is limited by the memory occupied by its QImages
+    (maxbytes) and optionally by the number of stacks (maxstacks).
+    Whole stacks are evicted following an adaptive replacement (ARC)
+    policy: stacks that have been viewed once are kept in a recency
+    list, stacks the user returned to in a frequency list. Ghost
+    entries of evicted stacks shift the share of the memory given to
+    either list. The most recently used stack is never evicted.
+
+    Layers below the topmost layer tile that is visible, has full
+    opacity and no transparent pixels are hidden in that tile. They
+    neither count for the progress of the tile nor have to be
+    requested (see neededLayers()).
+
+    Accessing an evicted stack or an unknown image source raises a
+    KeyError.
+
+    '''
+    def __init__(self, first_stack_id, sims, ntiles, maxstacks=None, maxbytes=None):
         self._lock = Lock()
         self._sims = sims
-
-        kwargs = {'first_uid' : first_stack_id,
-                  'maxcaches' : maxstacks}
-        self._tileCache = _MultiCache(default_factory=lambda: (None, 0.), **kwargs)
-        self._tileCacheDirty = _MultiCache(default_factory=lambda: True, **kwargs)
-        self._layerCache = _MultiCache(**kwargs)
-        self._layerCacheDirty = _MultiCache(default_factory=lambda: True, **kwargs)
-        self._layerCacheTimestamp = _MultiCache(default_factory=float, **kwargs)
+        self._ntiles = ntiles
+        self._layerIds = list(sims.viewImageSources())
+        self._slots = dict((ims, slot) for slot, ims in enumerate(self._layerIds))
+        # layers that are visible and not occluded, by slot
+        self._shown = numpy.zeros(len(self._slots), dtype=bool)
+        # layers that are visible with full opacity, by slot
+        self._canOcclude = numpy.zeros(len(self._slots), dtype=bool)
+        # slots in stacking order, topmost first
+        self._order = numpy.arange(len(self._slots))
+        self.updateShown()
+        self._maxstacks = maxstacks
+        self._maxbytes = maxbytes
+
+        self._stacks = {}
+        self._nbytes = 0
+        # LRU order, least recently used first
+        self._recent = OrderedDict()
+        self._frequent = OrderedDict()
+        self._recentGhosts = OrderedDict()
+        self._frequentGhosts = OrderedDict()
+        # bytes of the budget preferably given to the recency list
+        self._recentTarget = 0
+        # prefetched stacks, which have not been viewed yet
+        self._unviewed = set()
+        self._mru = None
+        self.evictions = 0
+
+        self._addStack( first_stack_id )
 
     @synchronous('_lock')
     def __contains__( self, stack_id ):
-        return stack_id in self._tileCache.caches
+        return stack_id in self._stacks
 
     @synchronous('_lock')
     def __len__( self ):
-        return len(self._tileCache.caches)
+        return len(self._stacks)
+
+    @property
+    def nbytes( self ):
+        '''Bytes occupied by the cached images.'''
+        return self._nbytes
+
+    @synchronous('_lock')
+    def setLimits( self, maxstacks, maxbytes ):
+        '''Change the limits; evicts stacks right away if necessary.'''
+        self._maxstacks = maxstacks
+        self._maxbytes = maxbytes
+        self._evict()
+
+    @synchronous('_lock')
+    def updateShown( self ):
+        '''Update which layers count for the progress of a tile.
+
+        Call this when the visibility, opacity or order of the
+        layers changed.
+
+        '''
+        for ims, slot in self._slots.iteritems():
+            self._shown[slot] = self._sims.isVisible(ims) and not self._sims.isOccluded(ims)
+        order = []
+        for visible, opacity, ims in self._sims:
+            if ims in self._slots:
+                slot = self._slots[ims]
+                order.append( slot )
+                self._canOcclude[slot] = visible and opacity == 1.0
+        self._order = numpy.array(order, dtype=int)
+
+    def _hidden( self, stack, tile_id ):
+        '''Mask of the slots below the topmost opaque layer tile.'''
+        hidden = numpy.zeros(len(self._slots), dtype=bool)
+        occluding = stack.layerOpaque[self._order, tile_id] & self._canOcclude[self._order]
+        if occluding.any():
+            hidden[self._order[numpy.argmax(occluding) + 1:]] = True
+        return hidden
+
+    @synchronous('_lock')
+    def neededLayers( self, stack_id, tile_id ):
+        '''Return the dirty layers of a tile that are shown and not
+        hidden by an opaque layer tile, topmost first.'''
+        stack = self._stacks[stack_id]
+        needed = self._shown & ~self._hidden(stack, tile_id) & stack.layerDirty[:, tile_id]
+        return [self._layerIds[slot] for slot in self._order if needed[slot]]
+
+    @synchronous('_lock')
+    def hiddenLayers( self, stack_id, tile_id ):
+        '''Return the layers below the topmost opaque layer tile.'''
+        hidden = self._hidden(self._stacks[stack_id], tile_id)
+        return [self._layerIds[slot] for slot in numpy.flatnonzero(hidden)]
 
     @synchronous('_lock')
     def tile( self, stack_id, tile_id ):
-        return self._tileCache.caches[stack_id][tile_id]
+        stack = self._stacks[stack_id]
+        return stack.tiles[tile_id], float(stack.progress[tile_id])
     @synchronous('_lock')
-    def setTile( self, stack_id, tile_id, img, stack_visible, stack_occluded ):
-        if len(stack_visible) > 0:
-            visible = numpy.asarray(stack_visible)
-            occluded = numpy.asarray(stack_occluded)
-            visibleAndNotOccluded = numpy.logical_and(visible, numpy.logical_not(occluded))
-            if numpy.count_nonzero(visibleAndNotOccluded) > 0:
-                dirty = numpy.asarray([self._layerCacheDirty.caches[stack_id][(ims, tile_id)]
-                                       for ims in self._sims.viewImageSources()])
-                num = numpy.count_nonzero(numpy.logical_and(dirty, visibleAndNotOccluded) == True)
-                denom = float(numpy.count_nonzero(visibleAndNotOccluded))
-                progress = 1.0 - num / denom
-            else:
-                progress = 1.0
+    def setTile( self, stack_id, tile_id, img ):
+        '''Set the composed image of a tile.
+
+        Its progress is the fraction of shown layers that are not dirty;
+        layers hidden by an opaque layer tile are not counted.
+
+        '''
+        stack = self._stacks[stack_id]
+        shown = self._shown & ~self._hidden(stack, tile_id)
+        nshown = numpy.count_nonzero(shown)
+        if nshown > 0:
+            ndirty = numpy.count_nonzero(stack.layerDirty[shown, tile_id])
+            stack.progress[tile_id] = 1.0 - ndirty / float(nshown)
         else:
-            progress = 1.0
-        self._tileCache.caches[stack_id][tile_id] = (img, progress)
+            stack.progress[tile_id] = 1.0
+        self._account( stack, _imageBytes(img) - _imageBytes(stack.tiles[tile_id]) )
+        stack.tiles[tile_id] = img
+        self._evict()
 
     @synchronous('_lock')
     def tileDirty( self, stack_id, tile_id ):
-        return self._tileCacheDirty.caches[stack_id][tile_id]
+        return self._stacks[stack_id].tileDirty[tile_id]
     @synchronous('_lock')
     def setTileDirty( self, stack_id, tile_id, b):
-        self._tileCacheDirty.caches[stack_id][tile_id] = b
+        self._stacks[stack_id].tileDirty[tile_id] = b
     @synchronous('_lock')
-    def setTileDirtyAll( self, tile_id, b):
-        for stack_id in self._tileCacheDirty.caches:
-            self._tileCacheDirty.caches[stack_id][tile_id] = b
+    def setTileDirtyAll( self, tile_ids, b):
+        '''Set the dirty flag of tiles in all stacks.'''
+        for stack in self._stacks.itervalues():
+            stack.tileDirty[tile_ids] = b
 
     @synchronous('_lock')
     def layer(self, stack_id, layer_id, tile_id ):
-        return self._layerCache.caches[stack_id][(layer_id,tile_id)]
+        return self._stacks[stack_id].layers[self._slots[layer_id], tile_id]
+    @synchronous('_lock')
+    def layers( self, stack_id, layer_ids, tile_id ):
+        '''Return the images of several layers of a tile.'''
+        slots = [self._slots[layer_id] for layer_id in layer_ids]
+        return self._stacks[stack_id].layers[slots, tile_id]
     @synchronous('_lock')
     def setLayer( self, stack_id, layer_id, tile_id, img ):
-        self._layerCache.caches[stack_id][(layer_id, tile_id)] = img
+        stack, slot = self._stacks[stack_id], self._slots[layer_id]
+        self._setLayer( stack, slot, tile_id, img )
+        stack.layerOpaque[slot, tile_id] = False
+        self._evict()
+
+    @synchronous('_lock')
+    def layersOpaque( self, stack_id, layer_ids, tile_id ):
+        '''Return whether the cached images of several layers of a tile
+        have no transparent pixels.'''
+        slots = [self._slots[layer_id] for layer_id in layer_ids]
+        return self._stacks[stack_id].layerOpaque[slots, tile_id]
+
+    @synchronous('_lock')
+    def takeRerequest( self, stack_id, tile_id ):
+        '''Return and reset whether layers of the tile have to be
+        requested again although the tile has been composed.'''
+        stack = self._stacks[stack_id]
+        rerequest = stack.rerequest[tile_id]
+        stack.rerequest[tile_id] = False
+        return rerequest
+
+    @synchronous('_lock')
+    def slots( self, layer_ids ):
+        return [self._slots[layer_id] for layer_id in layer_ids]
+
+    @synchronous('_lock')
+    def setLayerChangedAll( self, layer_id, tile_ids ):
+        '''Mark a layer as changed for the composition of tiles in all
+        stacks, e.g. because its opacity changed.'''
+        slot = self._slots[layer_id]
+        for stack in self._stacks.itervalues():
+            stack.layerChanged[slot, tile_ids] = True
+
+    @synchronous('_lock')
+    def takeChangedLayers( self, stack_id, tile_id ):
+        '''Return the slots of the layers that changed since the last
+        call for this tile and the slot of the single layer that
+        changed before (or -1).'''
+        stack = self._stacks[stack_id]
+        changed = numpy.flatnonzero(stack.layerChanged[:, tile_id])
+        stack.layerChanged[:, tile_id] = False
+        previous = stack.lastChanged[tile_id]
+        if len(changed) == 1:
+            stack.lastChanged[tile_id] = changed[0]
+        elif len(changed) > 1:
+            stack.lastChanged[tile_id] = -1
+        return changed, previous
+
+    @synchronous('_lock')
+    def partial( self, stack_id, tile_id ):
+        return self._stacks[stack_id].partials[tile_id]
+    @synchronous('_lock')
+    def setPartial( self, stack_id, tile_id, partial ):
+        stack = self._stacks[stack_id]
+        old = stack.partials[tile_id]
+        self._account( stack, (partial.nbytes if partial is not None else 0)
+                              - (old.nbytes if old is not None else 0) )
+        stack.partials[tile_id] = partial
+        self._evict()
+    @synchronous('_lock')
+    def clearPartials( self ):
+        for stack in self._stacks.itervalues():
+            for partial in stack.partials:
+                if partial is not None:
+                    self._account( stack, -partial.nbytes )
+            stack.partials.fill(None)
 
     @synchronous('_lock')
     def layerDirty(self, stack_id, layer_id, tile_id ):
-        return self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)]
+        return self._stacks[stack_id].layerDirty[self._slots[layer_id], tile_id]
     @synchronous('_lock')
     def setLayerDirty( self, stack_id, layer_id, tile_id, b ):
-        self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)] = b
+        self._stacks[stack_id].layerDirty[self._slots[layer_id], tile_id] = b
     @synchronous('_lock')
-    def setLayerDirtyAll( self, layer_id, tile_id, b ):
-        for stack_id in self._layerCacheDirty.caches:
-            self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)] = b
+    def setLayerDirtyAll( self, layer_id, tile_ids, b ):
+        '''Set the dirty flag of a layer\'s tiles in all stacks.'''
+        slot = self._slots[layer_id]
+        now = time.time()
+        for stack in self._stacks.itervalues():
+            stack.layerDirty[slot, tile_ids] = b
+            if b:
+                stack.layerDirtyTime[slot, tile_ids] = now
+    @synchronous('_lock')
+    def setLayersDirtyAll( self, tile_ids, b ):
+        '''Set the dirty flag of all layers\' tiles in all stacks.'''
+        now = time.time()
+        for stack in self._stacks.itervalues():
+            stack.layerDirty[:, tile_ids] = b
+            if b:
+                stack.layerDirtyTime[:, tile_ids] = now
 
     @synchronous('_lock')
     def layerTimestamp(self, stack_id, layer_id, tile_id ):
-        return self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)]
+        return self._stacks[stack_id].layerTimestamp[self._slots[layer_id], tile_id]
     @synchronous('_lock')
     def setLayerTimestamp( self, stack_id, layer_id, tile_id, time):
-        self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)] = time
+        self._stacks[stack_id].layerTimestamp[self._slots[layer_id], tile_id] = time
 
     @synchronous('_lock')
-    def addStack( self, stack_id ):
-        self._tileCache.add( stack_id )
-        self._tileCacheDirty.add( stack_id, default_factory=lambda:True )
-        self._layerCache.add( stack_id )
-        self._layerCacheDirty.add( stack_id, default_factory=lambda:True )
-        self._layerCacheTimestamp.add( stack_id, default_factory=float )
+    def addStack( self, stack_id, prefetch=False ):
+        '''Add a new stack.
+
+        A prefetched stack does not count as being viewed: it does not
+        become the most recently used stack until touchStack() is
+        called for it.
+
+        '''
+        self._addStack( stack_id, prefetch )
+        self._evict()
 
     @synchronous('_lock')
     def touchStack( self, stack_id ):
-        self._tileCache.touch( stack_id )
-        self._tileCacheDirty.touch( stack_id )
-        self._layerCache.touch( stack_id )
-        self._layerCacheDirty.touch( stack_id )
-        self._layerCacheTimestamp.touch( stack_id )
+        '''Mark a stack as being viewed.
+
+        Returns True if the stack was prefetched and is viewed for the
+        first time.
+
+        '''
+        if stack_id not in self._stacks:
+            raise KeyError(stack_id)
+        prefetched = stack_id in self._unviewed
+        if prefetched:
+            self._unviewed.discard( stack_id )
+            # first view: most recently used in the list it was added
+            # to (the frequency list for a ghost hit)
+            viewed = self._recent if stack_id in self._recent else self._frequent
+            del viewed[stack_id]
+            viewed[stack_id] = None
+        elif stack_id in self._recent:
+            if stack_id != self._mru:
+                # viewed again: promote to the frequency list
+                del self._recent[stack_id]
+                self._frequent[stack_id] = None
+        else:
+            del self._frequent[stack_id]
+            self._frequent[stack_id] = None
+        self._mru = stack_id
+        return prefetched
 
     @synchronous('_lock')
     def updateTileIfNecessary( self, stack_id, layer_id, tile_id,
-                               req_timestamp, img):
-        if req_timestamp > self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)]:
-            self._layerCache.caches[stack_id][(layer_id, tile_id)] = img
-            self._layerCacheDirty.caches[stack_id][(layer_id, tile_id)] = False
-            self._layerCacheTimestamp.caches[stack_id][(layer_id, tile_id)] = req_timestamp
-            self._tileCacheDirty.caches[stack_id][tile_id] = True
+                               req_timestamp, img, opaque=False ):
+        '''Store a layer tile unless a newer one is cached already.
 
+        opaque -- img has no transparent pixels
 
-class TileProvider( QObject ):
-    THREAD_HEARTBEAT = 0.2
+        Returns whether img was stored.
 
+        '''
+        stack = self._stacks[stack_id]
+        slot = self._slots[layer_id]
+        if req_timestamp > stack.layerTimestamp[slot, tile_id]:
+            if stack.layerOpaque[slot, tile_id] and not opaque:
+                stack.rerequest[tile_id] = True
+            self._setLayer( stack, slot, tile_id, img )
+            stack.layerOpaque[slot, tile_id] = opaque
+            # the layer became dirty after the request was made: show
+            # the image for now, but request the layer tile again
+            outdated = req_timestamp < stack.layerDirtyTime[slot, tile_id]
+            stack.layerDirty[slot, tile_id] = outdated
+            if outdated:
+                stack.rerequest[tile_id] = True
+            stack.layerTimestamp[slot, tile_id] = req_timestamp
+            stack.tileDirty[tile_id] = True
+            self._evict()
+            return True
+        return False
+
+    def _setLayer( self, stack, slot, tile_id, img ):
+        self._account( stack, _imageBytes(img) - _imageBytes(stack.layers[slot, tile_id]) )
+        stack.layers[slot, tile_id] = img
+        stack.layerChanged[slot, tile_id] = True
+
+    def _account( self, stack, delta ):
+        stack.nbytes += delta
+        self._nbytes += delta
+
+    def _addStack( self, stack_id, prefetch=False ):
+        if stack_id in self._stacks:
+            raise Exception('_TilesCache.addStack: stack %s is already cached' % str(stack_id))
+        self._stacks[stack_id] = _StackCache(len(self._slots), self._ntiles)
+
+        averageBytes = self._nbytes // max(len(self._stacks) - 1, 1)
+        if stack_id in self._recentGhosts:
+            # evicted too early from the recency list: give it more room
+            del self._recentGhosts[stack_id]
+            ratio = max(len(self._frequentGhosts) // max(len(self._recentGhosts), 1), 1)
+            self._recentTarget += ratio * averageBytes
+            if self._maxbytes is not None:
+                self._recentTarget = min(self._recentTarget, self._maxbytes)
+            self._frequent[stack_id] = None
+        elif stack_id in self._frequentGhosts:
+            del self._frequentGhosts[stack_id]
+            ratio = max(len(self._recentGhosts) // max(len(self._frequentGhosts), 1), 1)
+            self._recentTarget = max(self._recentTarget - ratio * averageBytes, 0)
+            self._frequent[stack_id] = None
+        else:
+            self._recent[stack_id] = None
+
+        if prefetch:
+            self._unviewed.add( stack_id )
+        else:
+            self._mru = stack_id
+
+    def _overLimit( self ):
+        return (self._maxbytes is not None and self._nbytes > self._maxbytes) \
+            or (self._maxstacks and len(self._stacks) > self._maxstacks)
+
+    def _victim( self ):
+        recent = [sid for sid in self._recent if sid != self._mru]
+        frequent = [sid for sid in self._frequent if sid != self._mru]
+        if not recent and not frequent:
+            return None
+        recentBytes = sum(self._stacks[sid].nbytes for sid in self._recent)
+        if recent and (recentBytes > self._recentTarget or not frequent):
+            return recent[0]
+        return frequent[0]
+
+    def _evict( self ):
+        while self._overLimit():
+            stack_id = self._victim()
+            if stack_id is None:
+                break
+            stack = self._stacks.pop( stack_id )
+            self._nbytes -= stack.nbytes
+            self._unviewed.discard( stack_id )
+            if stack_id in self._recent:
+                del self._recent[stack_id]
+                ghosts = self._recentGhosts
+            else:
+                del self._frequent[stack_id]
+                ghosts = self._frequentGhosts
+            ghosts[stack_id] = None
+            while len(ghosts) > max(len(self._stacks), 8):
+                ghosts.popitem(False)
+            self.evictions += 1
+
+
+# insertion order of the requests of all providers
+_requestSeq = itertools.count()
+
+class _LayerTileRequest( object ):
+    '''A layer tile request that is queued for the render threads.
+
+    Outstanding requests are tracked by the TileProvider, so that
+    they can be cancelled when their stack or layer goes out of view.
+
+    '''
+    def __init__( self, ims, tile_id, stack_id, image_req,
+                  timestamp, cache, prefetch, depth=0, diskKey=None ):
+        self.ims = ims
+        self.tile_id = tile_id
+        self.stack_id = stack_id
+        self.image_req = image_req
+        self.timestamp = timestamp
+        self.cache = cache
+        self.prefetch = prefetch
+        # position among the layers requested for the tile, topmost
+        # first; upper layers may make the lower ones unnecessary
+        self.depth = depth
+        # where to keep the result in the DiskTileStore, if anywhere
+        self.diskKey = diskKey
+        self.cancelled = False
+        # insertion order; set when the request is queued
+        self.seq = None
+
+
+class _LayerTileBatch( object ):
+    '''One image request for a layer in several neighbouring tiles.
+
+    The bounding rect of the tiles is fetched and converted once, by
+    whichever of the tiles' requests is waited for first; every tile
+    takes its part of the image (see _BatchedTileRequest). The
+    underlying request is cancelled when all its tiles are released
+    before it has been waited for.
+
+    '''
+    def __init__( self, ims, stack_id, level, rect ):
+        self.rect = rect
+        self.level = level
+        if level > 0:
+            self._req = ims.request(rect, stack_id[1], level=level)
+        else:
+            self._req = ims.request(rect, stack_id[1])
+        self._waitLock = Lock()
+        self._img = None
+        self._timings = None
+        self._lock = Lock()
+        # requests of tiles that have not been released
+        self._members = set()
+        self._sealed = False
+
+    def add( self, member ):
+        with self._lock:
+            self._members.add( member )
+
+    def seal( self ):
+        '''No more tiles are added; cancel the request if all the tiles
+        have been released already.'''
+        with self._lock:
+            self._sealed = True
+            cancel = not self._members
+        if cancel:
+            self._cancel()
+
+    def release( self, member ):
+        '''A tile does not need its part anymore; releasing it again
+        has no effect.'''
+        with self._lock:
+            if member not in self._members:
+                return
+            self._members.discard( member )
+            cancel = self._sealed and not self._members
+        if cancel:
+            self._cancel()
+
+    def _cancel( self ):
+        # not under the wait lock: a cancelled tile may still be
+        # waiting for the request
+        if self._img is None and hasattr(self._req, 'cancel'):
+            self._req.cancel()
+
+    def image( self ):
+        '''Return the image of the bounding rect and its (fetch,
+        convert) timings.'''
+        with self._waitLock:
+            if self._img is None:
+                start = time.time()
+                img = self._req.wait()
+                self._timings = getattr(self._req, 'timings', (time.time() - start, 0.0))
+                self._img = img
+            return self._img, self._timings
+
+class _BatchedTileRequest( object ):
+    '''Image request for the part of a _LayerTileBatch covering one
+    tile's data rect.'''
+    def __init__( self, batch, rect ):
+        self._batch = batch
+        self._rect = rect
+        batch.add( self )
+
+    def wait( self ):
+        img, (fetch, convert) = self._batch.image()
+        b, r = self._batch.rect, self._rect
+        # the image is in data orientation (its rows run along the
+        # first data axis); image sources that ignore the pyramid
+        # level deliver it at full resolution
+        if img.width() == b.height() and img.height() == b.width():
+            f = 1
+        else:
+            f = 2**self._batch.level
+        share = r.width() * r.height() / float(b.width() * b.height())
+        self.timings = (fetch * share, convert * share)
+        return img.copy((r.y() - b.y()) // f, (r.x() - b.x()) // f,
+                        -(-r.height() // f), -(-r.width() // f))
+
+    def cancel( self ):
+        self._batch.release( self )
+
+
+class _CompositeRequest( object ):
+    '''A tile that has to be composed from its cached layer tiles.
+
+    Composites are computed by the render threads, ahead of all
+    layer tile requests.
+
+    '''
+    prefetch = False
+    cancelled = False
+
+    def __init__( self, stack_id, tile_id, cache, generation ):
+        self.stack_id = stack_id
+        self.tile_id = tile_id
+        self.cache = cache
+        # TileProvider._viewGeneration at the time of the request
+        self.generation = generation
+        self.seq = None
+
+
+class TileProvider( QObject ):
     Tile = collections.namedtuple('Tile', 'id qimg rectF progress tiling')
     sceneRectChanged = pyqtSignal( QRectF )
 
@@ -356,44 +888,177 @@ class TileProvider( QObject ):
     Keyword Arguments:
     cache_size                -- maximal number of encountered stacks
                                  to cache, i.e. slices if the imagesources
-                                 draw from slicesources (default 10)
+                                 draw from slicesources (default 100)
+    cache_memory              -- maximal number of bytes occupied by the
+                                 cached tile images (default: the
+                                 [pixelpipeline] cache_memory_mb option)
     request_queue_size        -- maximal number of request to queue up (default 100000)
-    n_threads                 -- maximal number of request threads; this determines the
-                                 maximal number of simultaneously running requests
-                                 to the pixelpipeline (default: 2)
+    n_threads                 -- maximal number of simultaneously running requests
+                                 to the pixelpipeline; the render threads are shared
+                                 by all providers, see volumina.threadpool
+                                 (default: None, i.e. as many as there are threads)
     layerIdChange_means_dirty -- layerId changes invalidate the cache; by default only
                                  stackId changes do that (default False)
+    level_of_detail           -- when zoomed out, render coarser pyramid levels of
+                                 the tiling from downsampled data instead of
+                                 full resolution tiles (default False)
+    batch_tiles               -- request the dirty tiles of a layer in blocks of up to
+                                 batch_tiles x batch_tiles tiles, one request per
+                                 block; 0 or 1 requests every tile on its own
+                                 (default: the [pixelpipeline] batch_tiles option)
     parent                    -- QObject
 
     '''
 
     @property
-    def axesSwapped(self):
-        return self._axesSwapped
+    def levelOfDetail(self):
+        return self._levelOfDetail
+
+    @levelOfDetail.setter
+    def levelOfDetail(self, enable):
+        if enable != self._levelOfDetail:
+            self._levelOfDetail = enable
+            self._onSizeChanged()
+
+    @property
+    def settled(self):
+        '''Whether the slicing position has settled (see
+        PositionModel.slicingPositionSettled).
+
+        While the user scrolls through the slices of this provider
+        (i.e. its stack id changes while the position has not
+        settled), tiles that are not cached are rendered at the coarse
+        pyramid level previewLevel only; cached tiles are shown as
+        they are. Once the position settles, the tiles are refined to
+        full resolution. Providers whose slice does not change, e.g.
+        the views whose crosshair moved only, are not affected.
+
+        There is no preview if a shown layer would fetch its full
+        resolution data for it anyway (see
+        ImageSource.requestsLessData()), e.g. lazyflow sources or
+        layers averaged when downsampled.
+
+        '''
+        return self._settled
+
+    @settled.setter
+    def settled(self, settled):
+        if settled != self._settled:
+            self._settled = settled
+            scrolled, self._scrolled = self._scrolled, False
+            if settled and scrolled:
+                self.sceneRectChanged.emit( QRectF() )
+
+    @property
+    def previewLevel(self):
+        '''Pyramid level of the tiles rendered while the slicing position
+        has not settled; 0 disables the preview.'''
+        return self._previewLevel
+
+    @previewLevel.setter
+    def previewLevel(self, level):
+        if level != self._previewLevel:
+            self._previewLevel = level
+            self._onSizeChanged()
+
+    @property
+    def batchTiles(self):
+        '''Edge length, in tiles, of the blocks of neighbouring tiles
+        whose layer tiles are requested together (see _layerBatches()).'''
+        return self._batchTiles
+
+    @batchTiles.setter
+    def batchTiles(self, n):
+        self._batchTiles = n
+
+    @property
+    def cacheSize(self):
+        return self._cache_size
 
-    @axesSwapped.setter
-    def axesSwapped(self, value):
-        self._axesSwapped = value
+    @cacheSize.setter
+    def cacheSize(self, cache_size):
+        self._cache_size = cache_size
+        self._cache.setLimits( self._cache_size, self._cache_memory )
+
+    @property
+    def cacheMemory(self):
+        return self._cache_memory
+
+    @cacheMemory.setter
+    def cacheMemory(self, nbytes):
+        self._cache_memory = nbytes
+        self._cache.setLimits( self._cache_size, self._cache_memory )
+
+    def cacheMemoryUsed( self ):
+        '''Bytes currently occupied by the cached tile images.'''
+        return self._cache.nbytes
 
     def __init__( self, tiling, stackedImageSources, cache_size=100,
-                  request_queue_size=100000, n_threads=2,
-                  layerIdChange_means_dirty=False, parent=None ):
+                  request_queue_size=100000, n_threads=None,
+                  layerIdChange_means_dirty=False, level_of_detail=False,
+                  cache_memory=None, disk_store=None, preview_level=None,
+                  batch_tiles=None, parent=None ):
         QObject.__init__( self, parent = parent )
 
         self.tiling = tiling
-        self.axesSwapped = False
+        self._levelOfDetail = level_of_detail
+        if preview_level is None:
+            preview_level = cfg.getint('pixelpipeline', 'preview_level')
+        self._previewLevel = preview_level
+        self._settled = True
+        # the stack id changed since the position became unsettled
+        self._scrolled = False
+        self._setupLevels()
         self._sims = stackedImageSources
         self._cache_size = cache_size
+        if cache_memory is None:
+            cache_memory = cfg.getint('pixelpipeline', 'cache_memory_mb') * 2**20
+        self._cache_memory = cache_memory
         self._request_queue_size = request_queue_size
         self._n_threads = n_threads
         self._layerIdChange_means_dirty = layerIdChange_means_dirty
+        if batch_tiles is None:
+            batch_tiles = cfg.getint('pixelpipeline', 'batch_tiles')
+        self._batchTiles = batch_tiles
+        # layers with a cacheVersion keep their tiles on disk
+        self._diskStore = disk_store if disk_store is not None else diskTileStore()
 
         self._current_stack_id = self._sims.stackId
         self._cache = _TilesCache(self._current_stack_id, self._sims,
-                                  maxstacks=self._cache_size)
-
-        self._dirtyLayerQueue = LifoQueue(self._request_queue_size)
-        self._prefetchQueue = Queue(self._request_queue_size)
+                                  self._numTiles, maxstacks=self._cache_size,
+                                  maxbytes=self._cache_memory)
+
+        # Scene positions the user is looking at (see setViewportFocus)
+        self._focusPoints = []
+        self._active = True
+
+        # queued requests, which have not been processed yet
+        self._outstandingRequests = set()
+        self._outstandingLock = Lock()
+        self._requestCounts = dict.fromkeys(('queued', 'completed',
+                                             'cancelled', 'skipped',
+                                             'discarded', 'dropped',
+                                             'composited'), 0)
+        # tiles returned by getTiles(), complete (hits) or not
+        self._tileCounts = dict.fromkeys(('hits', 'misses'), 0)
+        # per image source: 'fetch', 'convert' and 'composite' latencies
+        self._latencies = {}
+        # (stack id, tile id) of the queued composites
+        self._pendingComposites = set()
+        # incremented when the orientation of the scene changes
+        self._viewGeneration = 0
+
+        # (stack id, layer, tile id) of the queued prefetch requests
+        self._pendingPrefetches = set()
+        # stacks of the latest prefetchSlices() call
+        self._prefetchWave = set()
+        self._prefetchCounts = dict.fromkeys(('hits', 'misses'), 0)
+        # moving average of the seconds needed to render a layer tile
+        self._tileLatency = None
+        # per image source: moving average of the seconds per data
+        # pixel of its full resolution layer tiles and their number
+        self._pixelTimes = {}
+        self._pixelSamples = collections.Counter()
 
         self._sims.layerDirty.connect(self._onLayerDirty)
         self._sims.visibleChanged.connect(self._onVisibleChanged)
@@ -406,13 +1071,87 @@ class TileProvider( QObject ):
 
         self._keepRendering = True
 
-        self._dirtyLayerThreads = [Thread(target=self._dirtyLayersWorker)
-                                   for i in range(self._n_threads)]
-        for thread in self._dirtyLayerThreads:
-            thread.daemon = True
-        [ thread.start() for thread in self._dirtyLayerThreads ]
+        # requests of all providers are ordered by _requestPriority()
+        # in the queue of the shared render threads
+        self._pool = renderThreadPool()
+        self._pool.addClient( self, self._processRequest,
+                              maxQueued=self._request_queue_size,
+                              maxRunning=self._n_threads )
+
+    @property
+    def active( self ):
+        '''Whether the view showing this provider's tiles is the one
+        the user works in; requests of active views are served first.'''
+        return self._active
+
+    @active.setter
+    def active( self, active ):
+        if active != self._active:
+            self._active = active
+            self._reprioritize()
+
+    def setViewportFocus( self, centerF, cursorF=None ):
+        '''Set the scene positions the user is looking at.
+
+        Pending tile requests are served in order of the distance of
+        their tiles to the nearest of these positions.
+
+        centerF -- center of the viewport (QPointF)
+        cursorF -- mouse cursor position, if it is on the viewport
+
+        '''
+        points = [(p.x(), p.y()) for p in (centerF, cursorF) if p is not None]
+        if self._focusMoved( points ):
+            self._focusPoints = points
+            self._reprioritize()
 
-    def getTiles( self, rectF ):
+    def levelForScale( self, scale ):
+        '''Pyramid level to render at for a given view scale.
+
+        scale -- ratio of screen pixels to scene pixels, i.e. 0.5
+                 when a view is zoomed out by a factor of two
+
+        Returns 0 unless levelOfDetail is enabled.
+
+        '''
+        if not self.levelOfDetail or scale <= 0 or scale >= 1.0:
+            return 0
+        level = int(math.floor(math.log(1.0 / scale, 2)))
+        return min(level, len(self._levelTilings) - 1)
+
+    def _previewLevelFor( self, level ):
+        if not self._previewable():
+            return level
+        return max(level, min(self._previewLevel, len(self._levelTilings) - 1))
+
+    def _previewable( self ):
+        '''Whether previews of the shown layers are cheaper to render
+        than their full resolution (see settled).'''
+        return all(ims.requestsLessData()
+                   for ims in self._sims.viewImageSources()
+                   if self._isShown( ims ))
+
+    def _previewing( self ):
+        return not self._settled and self._scrolled
+
+    def _renderLevel( self, scale ):
+        '''Pyramid level the tiles are rendered at right now.'''
+        level = self.levelForScale( scale )
+        if self._previewing():
+            level = self._previewLevelFor( level )
+        return level
+
+    def _previewTilesFor( self, level, tile_nos, previewLevel ):
+        '''Numbers of the tiles of previewLevel covering the given
+        tiles of level.'''
+        tiling = self._levelTilings[level]
+        previewTiling = self._levelTilings[previewLevel]
+        previewNos = set()
+        for tile_no in tile_nos:
+            previewNos.update( previewTiling.tileIdsForDataRect( tiling.dataRects[tile_no] ) )
+        return sorted(previewNos)
+
+    def getTiles( self, rectF, scale=1.0 ):
         '''Get tiles in rect and request a refresh.
 
         Returns tiles intersecting with rectF immediately and requests
@@ -420,32 +1159,79 @@ class TileProvider( QObject ):
         tiles may be already (partially) updated. If you want to wait
         until the rendering is fully complete, call join().
 
+        The tiles are taken from the pyramid level appropriate for
+        scale (see levelForScale()). The id of a returned tile is its
+        index into the returned tile's tiling.
+
+        Tiles that are not rendered yet are covered by the complete
+        preview tiles below them, which are returned first; while the
+        user scrolls through the slices, only these preview tiles are
+        rendered (see settled).
+
         '''
-        self.requestRefresh( rectF )
-        tile_nos = self.tiling.intersected( rectF )
+        self.requestRefresh( rectF, scale )
+        level = self.levelForScale( scale )
+        tiling = self._levelTilings[level]
+        offset = self._levelOffsets[level]
+        tile_nos = tiling.intersected( rectF )
         stack_id = self._current_stack_id
+        tiles = []
         for tile_no in tile_nos:
-            qimg, progress = self._cache.tile(stack_id, tile_no)
-            yield TileProvider.Tile(
+            qimg, progress = self._cache.tile(stack_id, offset + tile_no)
+            with self._outstandingLock:
+                self._tileCounts['hits' if progress >= 1.0 else 'misses'] += 1
+            tiles.append( TileProvider.Tile(
                 tile_no,
                 qimg,
-                QRectF(self.tiling.imageRects[tile_no]),
+                QRectF(tiling.imageRects[tile_no]),
                 progress,
-                self.tiling)
-
-    def requestRefresh( self, rectF ):
+                tiling) )
+
+        previewLevel = self._previewLevelFor( level )
+        missing = [tile.id for tile in tiles if tile.qimg is None]
+        if previewLevel != level and missing:
+            previewTiling = self._levelTilings[previewLevel]
+            previewOffset = self._levelOffsets[previewLevel]
+            for tile_no in self._previewTilesFor( level, missing, previewLevel ):
+                qimg, progress = self._cache.tile(stack_id, previewOffset + tile_no)
+                if qimg is not None and progress >= 1.0:
+                    yield TileProvider.Tile(
+                        tile_no,
+                        qimg,
+                        QRectF(previewTiling.imageRects[tile_no]),
+                        progress,
+                        previewTiling)
+        for tile in tiles:
+            yield tile
+
+    def requestRefresh( self, rectF, scale=1.0 ):
         '''Requests tiles to be refreshed.
 
         Returns immediately. Call join() to wait for
         the end of the rendering.
 
         '''
-        tile_nos = self.tiling.intersected( rectF )
-        for tile_no in tile_nos:
-            stack_id = self._current_stack_id
-            self._refreshTile( stack_id, tile_no )
-
-    def prefetch( self, rectF, through ):
+        # render with the latest dirty notifications
+        self._sims.flushDirty()
+        level = self.levelForScale( scale )
+        tile_nos = self._levelTilings[level].intersected( rectF )
+        stack_id = self._current_stack_id
+        previewLevel = self._previewLevelFor( level )
+        if self._previewing() and previewLevel != level:
+            # while scrolling, render the preview of the tiles that
+            # are not cached; they are refined once settled
+            offset = self._levelOffsets[level]
+            missing = []
+            for tile_no in tile_nos:
+                qimg, progress = self._cache.tile(stack_id, offset + tile_no)
+                if qimg is None or progress < 1.0:
+                    missing.append( tile_no )
+            tile_nos = self._previewTilesFor( level, missing, previewLevel )
+            level = previewLevel
+        offset = self._levelOffsets[level]
+        self._refreshTiles( stack_id, [offset + tile_no for tile_no in tile_nos] )
+
+    def prefetch( self, rectF, through, scale=1.0 ):
         '''Request fetching of tiles in advance.
 
         Returns immediately. Prefetch will commence after all regular
@@ -456,224 +1242,822 @@ class TileProvider( QObject ):
 
         '''
         if self._cache_size > 1:
-            stack_id = (self._current_stack_id[0], enumerate(through))
+            stack_id = self._stackIdThrough( through )
+            if stack_id is None or stack_id == self._current_stack_id:
+                return
+            self._prefetchWave.add( stack_id )
             if stack_id not in self._cache:
-                self._cache.addStack(stack_id)
-                self._cache.touchStack( self._current_stack_id )
-            tile_nos = self.tiling.intersected( rectF )
-            for tile_no in tile_nos:
-                self._refreshTile( stack_id, tile_no, prefetch=True )
+                self._cache.addStack(stack_id, prefetch=True)
+            level = self._renderLevel( scale )
+            offset = self._levelOffsets[level]
+            tile_nos = self._levelTilings[level].intersected( rectF )
+            self._refreshTiles( stack_id, [offset + tile_no for tile_no in tile_nos],
+                                prefetch=True )
+
+    def prefetchSlices( self, rectF, throughs, scale=1.0 ):
+        '''Prefetch several slices, nearest first.
+
+        Prefetch requests for slices that are not among throughs
+        anymore are cancelled.
+
+        '''
+        wave = set(self._stackIdThrough( through ) for through in throughs)
+        self._cancelRequests(lambda req: req.prefetch and req.stack_id not in wave)
+        self._prefetchWave = set()
+        for through in throughs:
+            self.prefetch( rectF, through, scale )
+
+    def _stackIdThrough( self, through ):
+        '''The stack id of the slice at 'through' (one value per
+        synchronized axis of the current stack id) or None.'''
+        slicing, along_through = self._current_stack_id
+        if len(along_through) != len(through):
+            return None
+        return (slicing, tuple((axis, value) for (axis, current), value
+                               in zip(along_through, through)))
+
+    def prefetchStatistics( self ):
+        '''Return counters of the slice changes.
+
+        hits   -- slices that had been prefetched before they were
+                  viewed
+        misses -- slices that were not cached at all
+
+        '''
+        with self._outstandingLock:
+            return dict(self._prefetchCounts)
+
+    def metrics( self ):
+        '''Return measurements of the rendering, e.g. to find slow layers.
+
+        layers   -- for each image source: its layer name and
+                    LatencyHistograms of the seconds its layer tiles
+                    took to be fetched ('fetch'), converted into
+                    images ('convert') and blended into tiles
+                    ('composite')
+        queued   -- requests and composites of this provider waiting
+                    for the render threads
+        running  -- requests and composites being processed
+        requests -- see requestStatistics()
+        prefetch -- see prefetchStatistics()
+        tiles    -- tiles returned by getTiles() that were complete
+                    ('hits') or not ('misses') and the hit rate
+        cache    -- bytes occupied ('bytes') and allowed ('maxBytes'),
+                    cached stacks and evicted stacks
 
-    def join( self ):
+        '''
+        with self._outstandingLock:
+            latencies = dict((ims, dict((kind, h.copy()) for kind, h in d.iteritems()))
+                             for ims, d in self._latencies.iteritems())
+            tiles = dict(self._tileCounts)
+        layers = {}
+        for ims, d in latencies.iteritems():
+            layer = self._sims._imsToLayer.get(ims)
+            d['name'] = layer.name if layer is not None else None
+            layers[ims] = d
+        ntiles = tiles['hits'] + tiles['misses']
+        tiles['hitRate'] = tiles['hits'] / float(ntiles) if ntiles else 0.0
+        queued, running = self._pool.load( self )
+        return { 'layers': layers,
+                 'queued': queued,
+                 'running': running,
+                 'requests': self.requestStatistics(),
+                 'prefetch': self.prefetchStatistics(),
+                 'tiles': tiles,
+                 'cache': { 'bytes': self._cache.nbytes,
+                            'maxBytes': self._cache_memory,
+                            'stacks': len(self._cache),
+                            'evictions': self._cache.evictions } }
+
+    def sliceRenderTime( self, rectF, scale=1.0 ):
+        '''Estimated seconds to render the tiles of a slice in rectF.
+
+        Based on the measured time per layer tile; 0 as long as no
+        layer tile has been rendered.
+
+        '''
+        if self._tileLatency is None:
+            return 0.0
+        level = self._renderLevel( scale )
+        ntiles = len(self._levelTilings[level].intersected( rectF ))
+        nlayers = sum(1 for ims in self._sims.viewImageSources() if self._isShown( ims ))
+        concurrency = self._n_threads or self._pool.nthreads
+        return self._tileLatency * ntiles * nlayers / float(concurrency)
+
+    def preferredBlockSize( self, latency=0.05, minimum=64, maximum=1024, samples=16 ):
+        '''Tile size at which a layer tile takes about latency seconds.
+
+        Big tiles cut the overhead per tile of fast layers (e.g. arrays
+        in memory), small tiles show the first pixels of slow layers
+        (e.g. a classifier) sooner. The size is chosen for the slowest
+        shown layer from the measured time per pixel, and is a power of
+        two between minimum and maximum.
+
+        Returns None until each shown layer has rendered the given
+        number of full resolution tiles.
+
+        '''
+        shown = [ims for ims in self._sims.viewImageSources() if self._isShown( ims )]
+        with self._outstandingLock:
+            if not shown or any(self._pixelSamples[ims] < samples for ims in shown):
+                return None
+            pixelTime = max(self._pixelTimes[ims] for ims in shown)
+        if pixelTime <= 0:
+            return maximum
+        blockSize = 2**int(round(math.log(math.sqrt(latency / pixelTime), 2)))
+        return max(minimum, min(maximum, blockSize))
+
+    def join( self, prefetch=False ):
         '''Wait until all refresh request are processed.
 
         Blocks until no refresh request pending anymore and all
-        rendering finished.
+        rendering finished, including the composition of the tiles.
+        With prefetch=True, wait for the prefetch requests as well.
 
         '''
-        return self._dirtyLayerQueue.join()
+        self._pool.join( self, background=prefetch )
+
+
+    def requestStatistics( self ):
+        '''Return counters of the layer tile requests handled so far.
 
+        queued    -- requests put on the render queues
+        completed -- requests whose result was stored in the cache
+        cancelled -- requests cancelled because their stack or layer
+                     went out of view
+        skipped   -- cancelled requests that the render threads
+                     dropped before computing them (saved work)
+        discarded -- cancelled requests that were already computing;
+                     their results were thrown away
+        dropped   -- requests not queued because the queue was full
+        composited -- tiles composed from their layer tiles
+        outstanding -- requests that are queued or computing right now
+
+        '''
+        with self._outstandingLock:
+            stats = dict(self._requestCounts)
+            stats['outstanding'] = len(self._outstandingRequests)
+        return stats
 
     def notifyThreadsToStop( self ):
-        '''Signals render threads to stop.
+        '''Detach from the render threads.
 
         Call this method at the end of the lifetime of a TileProvider
         instance. Otherwise the garbage collector will not clean up
-        the instance (even if you call del).
+        the instance (even if you call del). Queued requests are
+        dropped and the provider stops observing its stacked image
+        sources.
 
         '''
+        if self._keepRendering:
+            try:
+                self._sims.layerDirty.disconnect(self._onLayerDirty)
+                self._sims.visibleChanged.disconnect(self._onVisibleChanged)
+                self._sims.opacityChanged.disconnect(self._onOpacityChanged)
+                self._sims.sizeChanged.disconnect(self._onSizeChanged)
+                self._sims.orderChanged.disconnect(self._onOrderChanged)
+                self._sims.stackIdChanged.disconnect(self._onStackIdChanged)
+                if self._layerIdChange_means_dirty:
+                    self._sims.layerIdChanged.disconnect(self._onLayerIdChanged)
+            except RuntimeError:
+                pass # the stacked image sources are deleted already
         self._keepRendering = False
+        self._cancelRequests(lambda req: True)
+        self._dropQueued( self._pool.removeClient( self ) )
 
     def threadsAreNotifiedToStop( self ):
         '''Check if NotifyThreadsToStop() was called at least once.'''
         return not self._keepRendering
 
     def joinThreads( self, timeout=None ):
-        '''Wait until all threads terminated.
+        '''Wait until the render threads finished all requests of this
+        provider they are working on.
 
-        Without calling notifyThreadsToStop, threads will never
-        terminate.
+        The render threads are shared by all providers (see
+        volumina.threadpool); they keep running.
 
         Arguments:
         timeout -- timeout in seconds as a floating point number
 
         '''
-        for thread in self._dirtyLayerThreads:
-            thread.join( timeout )
+        self._pool.joinRunning( self, timeout )
 
     def aliveThreads( self ):
-        '''Return a map of thread identifiers and their alive status.
+        '''Return a map of thread identifiers and their alive status
+        for the shared render threads.'''
+        return self._pool.aliveThreads()
+
+    def _processRequest( self, req ):
+        '''Handle a layer tile request or a composite (render threads).'''
+        if isinstance(req, _CompositeRequest):
+            self._composite( req )
+            return
+
+        if req.cancelled:
+            self._retireRequest( req, 'skipped' )
+            return
+
+        stack_id, tile_nr, cache = req.stack_id, req.tile_id, req.cache
+        outcome = None
+        try:
+            try:
+                layerTimestamp = cache.layerTimestamp( stack_id, req.ims, tile_nr )
+            except KeyError:
+                pass
+            else:
+                if req.timestamp > layerTimestamp:
+                    start = time.time()
+                    img = req.image_req.wait()
+                    self._measureLatency( req.ims, req.image_req, time.time() - start, tile_nr )
+                    if req.cancelled:
+                        outcome = 'discarded'
+                        return
+                    opaque = req.ims.isOpaque() or _isOpaqueImage( img )
+                    try:
+                        updated = cache.updateTileIfNecessary( stack_id, req.ims, tile_nr,
+                                                               req.timestamp, img, opaque )
+                    except KeyError:
+                        pass
+                    else:
+                        outcome = 'completed'
+                        if updated and req.diskKey is not None:
+                            self._diskStore.put( req.diskKey, img )
+                        if updated and opaque:
+                            self._cancelHiddenLayerRequests( stack_id, tile_nr, cache )
+                        if stack_id == self._current_stack_id and cache is self._cache:
+                            self._scheduleComposite( stack_id, tile_nr )
+        except:
+            if req.cancelled:
+                # cancelling the underlying request may make it fail
+                outcome = 'discarded'
+            else:
+                with volumina.printLock:
+                    sys.excepthook( *sys.exc_info() )
+                    sys.stderr.write("ERROR: volumina tiling layer rendering worker thread caught an unhandled exception.  See above.")
+        finally:
+            self._retireRequest( req, outcome )
+
+    def _scheduleComposite( self, stack_id, tile_id ):
+        '''Queue the composition of a tile, unless it is queued already.'''
+        generation = self._viewGeneration
+        key = (stack_id, tile_id, generation)
+        with self._outstandingLock:
+            if key in self._pendingComposites:
+                return
+            self._pendingComposites.add( key )
+        req = _CompositeRequest( stack_id, tile_id, self._cache, generation )
+        req.seq = next(_requestSeq)
+        try:
+            submitted = self._pool.submit( self, self._requestPriority( req ), req )
+        except Full:
+            submitted = False
+            warnings.warn("Request queue full. Dropping tile composition request.")
+        if not submitted:
+            with self._outstandingLock:
+                self._pendingComposites.discard( key )
+
+    def _composite( self, req ):
+        '''Compose a tile and publish it to the cache (render threads).'''
+        stack_id, tile_id, cache = req.stack_id, req.tile_id, req.cache
+        with self._outstandingLock:
+            self._pendingComposites.discard( (stack_id, tile_id, req.generation) )
+        try:
+            # layer tiles arriving from now on schedule a new composite
+            cache.setTileDirty( stack_id, tile_id, False )
+            img = self._renderTile( stack_id, tile_id, cache )
+            if req.generation != self._viewGeneration:
+                # composed for an outdated orientation of the scene;
+                # compose the tile again with the next refresh
+                cache.setPartial( stack_id, tile_id, None )
+                cache.setTileDirty( stack_id, tile_id, True )
+                stale = True
+            else:
+                stale = False
+                cache.setTile( stack_id, tile_id, img )
+                if cache.takeRerequest( stack_id, tile_id ):
+                    # request the layers that are not hidden anymore or
+                    # outdated with the next refresh
+                    cache.setTileDirty( stack_id, tile_id, True )
+        except KeyError:
+            # the stack has been evicted or the layers have changed
+            return
+        if not stale:
+            with self._outstandingLock:
+                self._requestCounts['composited'] += 1
+        if stack_id == self._current_stack_id and cache is self._cache:
+            tiling, tile_no = self._tilingOf(tile_id)
+            self.sceneRectChanged.emit(QRectF(tiling.imageRects[tile_no]))
+
+    def _enqueueRequest( self, req ):
+        req.seq = next(_requestSeq)
+        with self._outstandingLock:
+            key = (req.stack_id, req.ims, req.tile_id)
+            # prefetch() is called on every repaint
+            duplicate = req.prefetch and key in self._pendingPrefetches
+            if not duplicate:
+                if req.prefetch:
+                    self._pendingPrefetches.add( key )
+                self._outstandingRequests.add( req )
+                self._requestCounts['queued'] += 1
+        if duplicate:
+            self._releaseImageRequest( req )
+            return
+        try:
+            submitted = self._pool.submit( self, self._requestPriority( req ), req,
+                                           background=req.prefetch )
+        except Full:
+            submitted = False
+            msg = " ".join(("Request queue full.",
+                            "Dropping tile refresh request.",
+                            "Increase queue size!"))
+            warnings.warn(msg)
+            with self._outstandingLock:
+                self._requestCounts['dropped'] += 1
+        if not submitted:
+            self._retireRequest( req )
+
+    def _dropQueued( self, reqs ):
+        '''Forget requests that were removed from the render queue.'''
+        for req in reqs:
+            if isinstance(req, _CompositeRequest):
+                with self._outstandingLock:
+                    self._pendingComposites.discard( (req.stack_id, req.tile_id, req.generation) )
+            else:
+                self._retireRequest( req, 'skipped' )
 
-        All threads are alive until notifyThreadsToStop() is
-        called. After that, they start dying. Call joinThreads() to wait
-        for the last thread to die.
+    def _requestPriority( self, req ):
+        '''Sort key of a request in the render queues; smallest first.
+
+        Composites come first, as they are cheap and make finished
+        layer tiles visible. Prefetch requests are served in the order
+        they were issued. Other requests are ordered by view (active view first), then
+        by the distance of their tile to the viewport focus, then
+        topmost layer first and finally newest first.
 
         '''
-        at = {}
-        for thread in self._dirtyLayerThreads:
-            if thread.ident:
-                at[thread.ident] = thread.isAlive()
-        return at
-
-    def _dirtyLayersWorker( self ):
-        while self._keepRendering:
-            # Save reference to the queue in case self._dirtyLayerQueue reassigned during this pass.
-            # See onSizeChanged()
-            dirtyLayerQueue = self._dirtyLayerQueue
-            prefetchQueue = self._prefetchQueue
+        if isinstance(req, _CompositeRequest):
+            return (-1, 0.0, 0, req.seq)
+        if req.prefetch:
+            return (2, 0.0, 0, req.seq)
+        distance = 0.0
+        if self._focusPoints:
+            tiling, tile_no = self._tilingOf(req.tile_id)
+            c = tiling.imageRectFs[tile_no].center()
+            distance = min(math.hypot(c.x() - x, c.y() - y)
+                           for x, y in self._focusPoints)
+        return (0 if self._active else 1, distance, req.depth, -req.seq)
+
+    def _focusMoved( self, points ):
+        '''The focus moved by more than half a tile.'''
+        if len(points) != len(self._focusPoints):
+            return True
+        threshold = self.tiling.blockSize / 2.0
+        return any(math.hypot(x0 - x1, y0 - y1) > threshold
+                   for (x0, y0), (x1, y1) in zip(points, self._focusPoints))
+
+    def _reprioritize( self ):
+        '''Re-sort the pending requests after the focus has changed.'''
+        self._pool.reprioritize( self, self._requestPriority )
+
+    def _latency( self, ims, kind ):
+        with self._outstandingLock:
+            if ims not in self._latencies:
+                self._latencies[ims] = dict((k, LatencyHistogram())
+                                            for k in ('fetch', 'convert', 'composite'))
+            return self._latencies[ims][kind]
+
+    def _measureLatency( self, ims, image_req, seconds, tile_id ):
+        '''Record the time a layer tile took to be rendered.'''
+        fetch, convert = getattr(image_req, 'timings', (seconds, 0.0))
+        if isinstance(image_req, _BatchedTileRequest):
+            # the tile's share of the time its batch took
+            seconds = fetch + convert
+        self._latency( ims, 'fetch' ).add( fetch )
+        self._latency( ims, 'convert' ).add( convert )
+        tiling, tile_no = self._tilingOf( tile_id )
+        rect = tiling.dataRects[tile_no]
+        pixels = rect.width() * rect.height()
+        with self._outstandingLock:
+            if self._tileLatency is None:
+                self._tileLatency = seconds
+            else:
+                self._tileLatency = 0.8 * self._tileLatency + 0.2 * seconds
+            if tiling.level == 0 and pixels > 0:
+                pixelTime = seconds / float(pixels)
+                if ims in self._pixelTimes:
+                    pixelTime = 0.8 * self._pixelTimes[ims] + 0.2 * pixelTime
+                self._pixelTimes[ims] = pixelTime
+                self._pixelSamples[ims] += 1
+
+    def _retireRequest( self, req, outcome=None ):
+        with self._outstandingLock:
+            self._outstandingRequests.discard( req )
+            if req.prefetch:
+                self._pendingPrefetches.discard( (req.stack_id, req.ims, req.tile_id) )
+            if outcome is not None:
+                self._requestCounts[outcome] += 1
+        self._releaseImageRequest( req )
+
+    def _releaseImageRequest( self, req ):
+        '''A layer tile request is done with its image request.
+
+        Batched tiles release their batch, which is cancelled once no
+        tile needs it anymore; other image requests are left alone.
 
-            try:
-                try:
-                    result = dirtyLayerQueue.get_nowait()
-                    queue = dirtyLayerQueue
-                except Empty:
-                    try:
-                        result = prefetchQueue.get_nowait()
-                        queue = prefetchQueue
-                    except Empty:
-                        try:
-                            result = dirtyLayerQueue.get(True, self.THREAD_HEARTBEAT)
-                            queue = dirtyLayerQueue
-                        except Empty:
-                            continue
-            except TypeError:
-                #the TypeError occurs when the queue
-                #is already None when the thread is being shut down
-                #on program exit.
-                #This avoids a lot of warnings.
-                continue
+        '''
+        if isinstance(req.image_req, _BatchedTileRequest):
+            req.image_req.cancel()
 
-            ims, transform, tile_nr, stack_id, image_req, timestamp, cache = result
-            try:
+    def _cancelRequests( self, predicate ):
+        '''Cancel all outstanding requests for which predicate(req) holds.
+
+        The cancel is forwarded to the underlying image request. Tiles
+        whose requests are cancelled are marked dirty again, so that
+        they are re-requested when they come back into view.
+
+        '''
+        with self._outstandingLock:
+            cancelled = [req for req in self._outstandingRequests
+                         if not req.cancelled and predicate(req)]
+            for req in cancelled:
+                req.cancelled = True
+            self._requestCounts['cancelled'] += len(cancelled)
+
+        for req in cancelled:
+            if hasattr(req.image_req, 'cancel'):
+                req.image_req.cancel()
+            if not req.prefetch:
                 try:
-                    layerTimestamp = cache.layerTimestamp( stack_id, ims, tile_nr )
+                    req.cache.setTileDirty( req.stack_id, req.tile_id, True )
                 except KeyError:
                     pass
-                else:
-                    if timestamp > layerTimestamp:
-                        img = image_req.wait()
-                        img = img.transformed(transform)
-                        try:
-                            cache.updateTileIfNecessary( stack_id, ims, tile_nr, timestamp, img )
-                        except KeyError:
-                            pass
-                        else:
-                            if stack_id == self._current_stack_id and cache is self._cache:
-                                self.sceneRectChanged.emit(QRectF(self.tiling.imageRects[tile_nr]))
-            except:
-                with volumina.printLock:
-                    sys.excepthook( *sys.exc_info() )
-                    sys.stderr.write("ERROR: volumina tiling layer rendering worker thread caught an unhandled exception.  See above.")
-            finally:
-                queue.task_done()
 
-    def _refreshTile( self, stack_id, tile_no, prefetch=False ):
-        if not self.axesSwapped:
-            transform = QTransform(0,1,0,1,0,0,1,1,1)
-        else:
-            transform = QTransform().rotate(90).scale(1,-1)
-        transform *= self.tiling.data2scene
+    def _isShown( self, ims ):
+        '''ImageSource is registered, visible and not occluded.'''
+        try:
+            return self._sims.isVisible( ims ) and not self._sims.isOccluded( ims )
+        except KeyError:
+            return False
+
+    def _cancelHiddenRequests( self ):
+        self._cancelRequests(lambda req: not self._isShown( req.ims ))
 
+    def _cancelHiddenLayerRequests( self, stack_id, tile_id, cache ):
+        '''Cancel the requests for layers of a tile that are hidden by
+        an opaque layer tile.'''
         try:
-            if self._cache.tileDirty( stack_id, tile_no ):
+            hidden = set(cache.hiddenLayers( stack_id, tile_id ))
+        except KeyError:
+            return
+        if hidden:
+            self._cancelRequests(lambda req: req.tile_id == tile_id
+                                 and req.stack_id == stack_id
+                                 and req.cache is cache and req.ims in hidden)
+
+    def _setupLevels( self ):
+        '''(Re-)create the coarser pyramid levels of self.tiling.
+
+        Tiles of all levels share one id space: the tiles of level n
+        are numbered consecutively after the tiles of level n-1.
+
+        '''
+        self._levelTilings = [self.tiling]
+        if self._levelOfDetail or self._previewLevel > 0:
+            for level in range(1, self.tiling.maxLevel + 1):
+                self._levelTilings.append(self.tiling.atLevel(level))
+        self._levelOffsets = [0]
+        for tiling in self._levelTilings:
+            self._levelOffsets.append(self._levelOffsets[-1] + len(tiling))
+        self._numTiles = self._levelOffsets.pop()
+
+    def _tilingOf( self, tile_id ):
+        '''Map a tile id to its (tiling, tile number in tiling).'''
+        level = bisect.bisect_right(self._levelOffsets, tile_id) - 1
+        return self._levelTilings[level], tile_id - self._levelOffsets[level]
+
+    def _diskLayer( self, ims ):
+        '''(layer id, cacheVersion) of the layer of an image source
+        whose tiles are kept on disk, otherwise None.'''
+        if self._diskStore is None:
+            return None
+        layer = getattr(ims, '_layer', None)
+        if layer is None or layer.cacheVersion is None:
+            return None
+        return (layer.layerId, layer.cacheVersion)
+
+    def _diskRegion( self, ims, dataRect ):
+        '''Region of the DiskTileStore covering dataRect in the slices
+        of an image source (see DiskTileStore.key()); None for an
+        invalid rect, which stands for the whole slice.'''
+        if not dataRect.isValid():
+            return None
+        plane = tuple(key and key[0] for key in ims.sliceKey())
+        return (plane, (dataRect.x(), dataRect.y(), dataRect.width(), dataRect.height()))
+
+    def _requestLayerTile( self, ims, stack_id, tile_id, batch=None ):
+        '''Return an image request for a layer tile and its disk key.
+
+        A tile kept in the DiskTileStore is read from there (and the
+        disk key is None); otherwise the disk key tells where to keep
+        the rendered tile, if anywhere. A tile in a _LayerTileBatch is
+        cut out of the batch's image.
+
+        '''
+        tiling, tile_no = self._tilingOf( tile_id )
+        dataRect = tiling.dataRects[tile_no]
+        if batch is not None:
+            return _BatchedTileRequest(batch, dataRect), None
+        def request():
+            if tiling.level > 0:
+                return ims.request(dataRect, stack_id[1], level=tiling.level)
+            return ims.request(dataRect, stack_id[1])
+
+        layer = self._diskLayer( ims )
+        if layer is None:
+            return request(), None
+        key = self._diskStore.key( layer, (ims.sliceKey(stack_id[1]), tiling.level,
+                                           dataRect.x(), dataRect.y(),
+                                           dataRect.width(), dataRect.height()),
+                                   self._diskRegion( ims, dataRect ) )
+        stored = self._diskStore.request( key, request )
+        if stored is not None:
+            return stored, None
+        return request(), key
+
+    def _layerBatches( self, stack_id, tile_ids ):
+        '''Group the dirty layer tiles of neighbouring tiles.
+
+        The tiles are divided into blocks of batchTiles x batchTiles
+        tiles. Per layer, the dirty tiles of a block are fetched and
+        converted with a single request for their bounding rect, which
+        saves the fixed costs of the requests (e.g. scheduling them
+        in lazyflow) and reads the overlap between the tiles only
+        once. Layers whose tiles are kept on disk are requested per
+        tile.
+
+        Returns a dict mapping (image source, tile id) to the
+        _LayerTileBatch of the layer tile.
+
+        '''
+        blocks = defaultdict(list)
+        try:
+            for tile_id in tile_ids:
+                if not self._cache.tileDirty( stack_id, tile_id ):
+                    continue
+                tiling, tile_no = self._tilingOf( tile_id )
+                span = tiling.blockSize * tiling.downsamplingFactor * self._batchTiles
+                center = tiling.dataRectFs[tile_no].center()
+                block = (tiling.level, int(center.x()) // span, int(center.y()) // span)
+                for ims in self._cache.neededLayers( stack_id, tile_id ):
+                    if self._diskLayer( ims ) is None:
+                        blocks[(ims, block)].append( tile_id )
+        except KeyError:
+            return {}
+
+        batches = {}
+        for (ims, (level, bx, by)), members in blocks.iteritems():
+            if len(members) < 2:
+                continue
+            tiling = self._levelTilings[level]
+            rects = [tiling.dataRects[self._tilingOf(tile_id)[1]] for tile_id in members]
+            rect = reduce(QRect.united, rects)
+            # the downsampled parts must start at the same data pixels
+            # as the downsampled tiles
+            f = tiling.downsamplingFactor
+            if any((r.x() - rect.x()) % f or (r.y() - rect.y()) % f for r in rects):
+                continue
+            batch = _LayerTileBatch( ims, stack_id, level, rect )
+            for tile_id in members:
+                batches[(ims, tile_id)] = batch
+        return batches
+
+    def _refreshTiles( self, stack_id, tile_ids, prefetch=False ):
+        batches = {}
+        if self._batchTiles > 1:
+            batches = self._layerBatches( stack_id, tile_ids )
+        for tile_id in tile_ids:
+            self._refreshTile( stack_id, tile_id, prefetch, batches )
+        for batch in set(batches.itervalues()):
+            batch.seal()
+
+    def _refreshTile( self, stack_id, tile_id, prefetch=False, batches=None ):
+        tiling, tile_no = self._tilingOf(tile_id)
+        try:
+            if self._cache.tileDirty( stack_id, tile_id ):
                 if not prefetch:
-                    self._cache.setTileDirty(stack_id, tile_no, False)
-                    img = self._renderTile( stack_id, tile_no )
-                    self._cache.setTile(stack_id, tile_no, img,
-                                        self._sims.viewVisible(),
-                                        self._sims.viewOccluded())
-
-                # refresh dirty layer tiles
-                for ims in self._sims.viewImageSources():
-                    if self._cache.layerDirty(stack_id, ims, tile_no) \
-                       and not self._sims.isOccluded(ims) \
-                       and self._sims.isVisible(ims):
-
-                        rect = self.tiling.imageRects[tile_no]
-                        dataRect = self.tiling.scene2data.mapRect(rect)
-                        ims_req = ims.request(dataRect, stack_id[1])
-                        if ims.direct and not prefetch:
-                            # The ImageSource 'ims' is fast (it has the
-                            # direct flag set to true) so we process
-                            # the request synchronously here. This
-                            # improves the responsiveness for layers
-                            # that have the data readily available.
-                            start = time.time()
-                            img = ims_req.wait()
-
-                            img = img.transformed(transform)
-                            stop = time.time()
-
-                            ims._layer.timePerTile(stop-start,
-                                                   self.tiling.imageRects[tile_no])
-
-                            self._cache.updateTileIfNecessary(
-                                stack_id, ims, tile_no, time.time(), img )
-                            img = self._renderTile( stack_id, tile_no )
-                            self._cache.setTile(stack_id, tile_no,
-                                                img, self._sims.viewVisible(),
-                                                self._sims.viewOccluded() )
-                        else:
-                            req = (ims, transform, tile_no, stack_id,
-                                   ims_req, time.time(), self._cache)
-                            try:
-                                if prefetch:
-                                    self._prefetchQueue.put_nowait( req )
-                                else:
-                                    self._dirtyLayerQueue.put_nowait( req )
-                            except Full:
-                                msg = " ".join(("Request queue full.",
-                                                "Dropping tile refresh request.",
-                                                "Increase queue size!"))
-                                warnings.warn(msg)
+                    self._scheduleComposite( stack_id, tile_id )
+
+                # refresh dirty layer tiles, skipping the layers below
+                # an opaque layer tile
+                hidden = ()
+                for depth, ims in enumerate(self._cache.neededLayers( stack_id, tile_id )):
+                    if ims in hidden:
+                        continue
+                    dataRect = tiling.dataRects[tile_no]
+                    batch = batches.get( (ims, tile_id) ) if batches else None
+                    # taken before the request: dirty notifications
+                    # sent while it is rendered (e.g. by a MinMaxSource
+                    # whose range grows) make the tile outdated
+                    timestamp = time.time()
+                    ims_req, diskKey = self._requestLayerTile( ims, stack_id, tile_id, batch )
+                    if ims.direct and not prefetch:
+                        # The ImageSource 'ims' is fast (it has the
+                        # direct flag set to true) so we process
+                        # the request synchronously here. This
+                        # improves the responsiveness for layers
+                        # that have the data readily available.
+                        start = time.time()
+                        img = ims_req.wait()
+                        stop = time.time()
+
+                        ims._layer.timePerTile(stop-start, dataRect)
+                        self._measureLatency( ims, ims_req, stop - start, tile_id )
+
+                        opaque = ims.isOpaque() or _isOpaqueImage( img )
+                        if self._cache.updateTileIfNecessary(
+                            stack_id, ims, tile_id, timestamp, img, opaque ) \
+                           and diskKey is not None:
+                            self._diskStore.put( diskKey, img )
+                        self._scheduleComposite( stack_id, tile_id )
+                        if opaque:
+                            hidden = set(self._cache.hiddenLayers( stack_id, tile_id ))
+                            self._cancelHiddenLayerRequests( stack_id, tile_id, self._cache )
+                    else:
+                        req = _LayerTileRequest(ims, tile_id,
+                                                stack_id, ims_req,
+                                                timestamp, self._cache,
+                                                prefetch, depth, diskKey)
+                        self._enqueueRequest( req )
         except KeyError:
             pass
 
-    def _renderTile( self, stack_id, tile_nr): 
-        qimg = None
-        p = None
-        for i, v in enumerate(reversed(self._sims)):
-            visible, layerOpacity, layerImageSource = v
-            if not visible:
-                continue
+    def _patchTransform( self, tiling, tile_no, patch ):
+        '''Map a layer patch into the composed image of a tile.
+
+        Layer patches are cached in data orientation: the rows of a
+        patch run along the first data axis, its columns along the
+        second. The orientation of the scene is applied only here,
+        when the patches are drawn into the tile image.
 
-            patch = self._cache.layer(stack_id, layerImageSource, tile_nr )
-            if patch is not None:
-                if qimg is None:
-                    qimg = QImage(self.tiling.imageRects[tile_nr].size(), QImage.Format_ARGB32_Premultiplied)
-                    qimg.fill(0xffffffff) # Use a hex constant instead.
-                    p = QPainter(qimg)
-                p.setOpacity(layerOpacity)
-                p.drawImage(0,0, patch)
-        
-        if p is not None:
-            p.end()
+        '''
+        dataRect = tiling.dataRectFs[tile_no]
+        # image sources that ignore the pyramid level deliver full
+        # resolution patches; these are scaled down by the transform
+        patchToData = QTransform(0, dataRect.height() / patch.width(),
+                                 dataRect.width() / patch.height(), 0,
+                                 dataRect.x(), dataRect.y())
+        imageRect = tiling.imageRects[tile_no]
+        imageSize = tiling.imageSizes[tile_no]
+        sceneToImage = QTransform.fromTranslate(-imageRect.x(), -imageRect.y())
+        sceneToImage *= QTransform.fromScale(imageSize.width() / float(imageRect.width()),
+                                             imageSize.height() / float(imageRect.height()))
+        return patchToData * tiling.data2scene * sceneToImage
+
+    def _drawPatches( self, img, tiling, tile_no, patches ):
+        '''Draw (opacity, patch, ims) triples into a tile image, bottom
+        first.'''
+        p = QPainter(img)
+        for opacity, patch, ims in patches:
+            start = time.time()
+            p.setOpacity(opacity)
+            p.setTransform(self._patchTransform(tiling, tile_no, patch))
+            p.drawImage(0, 0, patch)
+            self._latency( ims, 'composite' ).add( time.time() - start )
+        p.end()
+
+    def _renderTile( self, stack_id, tile_nr, cache ):
+        '''Compose a tile from its cached layer tiles.
+
+        When the same layer of a tile changes repeatedly (e.g. a live
+        prediction or its opacity), the composites of the layers below
+        and above it are cached. Then an update of that layer takes
+        two blends instead of one per layer.
+
+        Layers below an opaque layer tile are not blended.
 
+        '''
+        tiling, tile_no = self._tilingOf(tile_nr)
+        layers = list(reversed(self._sims)) # bottom first
+        imss = [ims for visible, opacity, ims in layers]
+        slots = cache.slots(imss)
+        patches = cache.layers(stack_id, imss, tile_nr)
+        opaque = cache.layersOpaque(stack_id, imss, tile_nr)
+        changed, previous = cache.takeChangedLayers(stack_id, tile_nr)
+
+        partial = cache.partial(stack_id, tile_nr)
+        if partial is not None:
+            if len(changed) > 1 or (len(changed) == 1 and changed[0] != partial.pivot) \
+               or partial.signature != self._layerSignature(layers, slots, partial.pivot):
+                cache.setPartial(stack_id, tile_nr, None)
+                partial = None
+        if partial is None and len(changed) == 1 and changed[0] == previous:
+            partial = self._partialComposite(tiling, tile_no, layers, slots,
+                                             patches, opaque, changed[0])
+            cache.setPartial(stack_id, tile_nr, partial)
+
+        if partial is not None:
+            qimg = partial.below.copy()
+            i = slots.index(partial.pivot)
+            visible, opacity, ims = layers[i]
+            pivotPatches = [(opacity, patches[i], ims)] \
+                           if visible and patches[i] is not None \
+                           and self._bottomLayer(layers, patches, opaque, i) <= i else []
+            self._drawPatches(qimg, tiling, tile_no, pivotPatches)
+            if partial.above is not None:
+                p = QPainter(qimg)
+                p.drawImage(0, 0, partial.above)
+                p.end()
+            return qimg
+
+        bottom = self._bottomLayer(layers, patches, opaque)
+        visiblePatches = [(opacity, patch, ims) for (visible, opacity, ims), patch
+                          in zip(layers[bottom:], patches[bottom:])
+                          if visible and patch is not None]
+        if not visiblePatches:
+            return None
+        qimg = QImage(tiling.imageSizes[tile_no], QImage.Format_ARGB32_Premultiplied)
+        qimg.fill(0xffffffff)
+        self._drawPatches(qimg, tiling, tile_no, visiblePatches)
         return qimg
-    
+
+    def _layerSignature( self, layers, slots, pivot ):
+        '''Order, visibility and opacity of all layers but the pivot.'''
+        return tuple((slot,) if slot == pivot else (slot, visible, opacity)
+                     for (visible, opacity, ims), slot in zip(layers, slots))
+
+    def _bottomLayer( self, layers, patches, opaque, ignore=None ):
+        '''Index of the lowest layer (bottom first) that is not hidden
+        by an opaque layer tile; the layer 'ignore' hides nothing.'''
+        for i in reversed(range(len(layers))):
+            visible, opacity, ims = layers[i]
+            if i != ignore and visible and opacity == 1.0 \
+               and opaque[i] and patches[i] is not None:
+                return i
+        return 0
+
+    def _partialComposite( self, tiling, tile_no, layers, slots, patches, opaque, pivot ):
+        i = slots.index(pivot)
+        # the pivot changes, so whether it is opaque must not matter
+        bottom = self._bottomLayer(layers, patches, opaque, i)
+        def visiblePatches( begin, end ):
+            begin = max(begin, bottom)
+            return [(opacity, patch, ims) for (visible, opacity, ims), patch
+                    in zip(layers[begin:end], patches[begin:end])
+                    if visible and patch is not None]
+
+        below = QImage(tiling.imageSizes[tile_no], QImage.Format_ARGB32_Premultiplied)
+        below.fill(0xffffffff)
+        self._drawPatches(below, tiling, tile_no, visiblePatches(0, i))
+
+        above = None
+        abovePatches = visiblePatches(i + 1, len(layers))
+        if abovePatches:
+            above = QImage(tiling.imageSizes[tile_no], QImage.Format_ARGB32_Premultiplied)
+            above.fill(0)
+            self._drawPatches(above, tiling, tile_no, abovePatches)
+        return _PartialComposite(pivot, self._layerSignature(layers, slots, pivot),
+                                 below, above)
+
+    def _tileIdsForDataRect( self, dataRect ):
+        '''Ids of the tiles of all levels covering dataRect.'''
+        return numpy.concatenate([offset + tiling.tileIdsForDataRect( dataRect )
+                                  for tiling, offset
+                                  in zip(self._levelTilings, self._levelOffsets)])
+
     def _onLayerDirty(self, dirtyImgSrc, dataRect ):
-        sceneRect = self.tiling.data2scene.mapRect(dataRect)
         if dirtyImgSrc in self._sims.viewImageSources():
+            layer = self._diskLayer( dirtyImgSrc )
+            if layer is not None:
+                self._diskStore.discard( layer, self._diskRegion( dirtyImgSrc, dataRect ) )
             visibleAndNotOccluded = self._sims.isVisible( dirtyImgSrc ) \
                                     and not self._sims.isOccluded( dirtyImgSrc )
-            for tile_no in xrange(len(self.tiling)):
-                # an invalid rect means everything is dirty
-                if not sceneRect.isValid() \
-                   or self.tiling.tileRects[tile_no].intersected( sceneRect ):
-                    for ims in self._sims.viewImageSources():
-                        self._cache.setLayerDirtyAll(ims, tile_no, True)
-                    if visibleAndNotOccluded:
-                        self._cache.setTileDirtyAll(tile_no, True)
+            tile_ids = self._tileIdsForDataRect( dataRect )
+            self._cache.setLayerDirtyAll(dirtyImgSrc, tile_ids, True)
             if visibleAndNotOccluded:
+                self._cache.setTileDirtyAll(tile_ids, True)
+                sceneRect = self.tiling.data2scene.mapRect(dataRect)
                 self.sceneRectChanged.emit( QRectF(sceneRect) )
 
     def _onStackIdChanged( self, oldId, newId ):
-        if newId in self._cache:
-            self._cache.touchStack( newId )
-        else:
+        try:
+            hit = self._cache.touchStack( newId )
+        except KeyError:
             self._cache.addStack( newId )
+            hit = None
+        with self._outstandingLock:
+            if hit:
+                self._prefetchCounts['hits'] += 1
+            elif hit is None:
+                self._prefetchCounts['misses'] += 1
         self._current_stack_id = newId
-        self._prefetchQueue = Queue(self._request_queue_size)
+        if not self._settled:
+            self._scrolled = True
+        # Requests for other slices are not needed anymore, except
+        # for the prefetch requests of slices that are probably
+        # prefetched again relative to the new slice.
+        wave = self._prefetchWave
+        self._cancelRequests(lambda req: req.stack_id != newId
+                             and not (req.prefetch and req.stack_id in wave))
         self.sceneRectChanged.emit(QRectF())
 
     def _onLayerIdChanged( self, ims, oldId, newId ):
@@ -681,25 +2065,55 @@ class TileProvider( QObject ):
             self._onLayerDirty( ims, QRect() )
 
     def _onVisibleChanged(self, ims, visible):
-        for tile_no in xrange(len(self.tiling)):
-            self._cache.setTileDirtyAll(tile_no, True)
+        self._cancelHiddenRequests()
+        self._cache.updateShown()
+        self._cache.setLayerChangedAll(ims, slice(None))
+        self._cache.setTileDirtyAll(slice(None), True)
         if not self._sims.isOccluded( ims ):
             self.sceneRectChanged.emit(QRectF())
 
     def _onOpacityChanged(self, ims, opacity):
-        for tile_no in xrange(len(self.tiling)):
-            self._cache.setTileDirtyAll(tile_no, True)
+        # opacity changes can occlude other layers
+        self._cancelHiddenRequests()
+        self._cache.updateShown()
+        self._cache.setLayerChangedAll(ims, slice(None))
+        self._cache.setTileDirtyAll(slice(None), True)
         if self._sims.isVisible( ims ) and not self._sims.isOccluded( ims ):
             self.sceneRectChanged.emit(QRectF())
 
+    def viewMatrixChanged( self ):
+        '''Call after the data2scene transform of the tiling changed,
+        e.g. when the view is rotated or its axes are swapped.
+
+        The cached layer tiles stay valid, only the tiles are composed
+        again; no data is requested.
+
+        '''
+        for tiling in self._levelTilings[1:]:
+            tiling.data2scene = self.tiling.data2scene
+        with self._outstandingLock:
+            self._viewGeneration += 1
+            # queued composites of the old orientation are dropped when
+            # they run; they must not keep new ones from being queued
+            self._pendingComposites.clear()
+        self._cache.clearPartials()
+        self._cache.setTileDirtyAll(slice(None), True)
+        self._reprioritize()
+        self.sceneRectChanged.emit(QRectF())
+
     def _onSizeChanged(self):
+        self._cancelRequests(lambda req: True)
+        self._dropQueued( self._pool.discard( self ) )
+        self._setupLevels()
         self._cache = _TilesCache(self._current_stack_id, self._sims,
-                                  maxstacks=self._cache_size)
-        self._dirtyLayerQueue = LifoQueue(self._request_queue_size)
-        self._prefetchQueue = Queue(self._request_queue_size)
+                                  self._numTiles, maxstacks=self._cache_size,
+                                  maxbytes=self._cache_memory)
+        with self._outstandingLock:
+            self._pendingComposites.clear()
         self.sceneRectChanged.emit(QRectF())
 
     def _onOrderChanged(self):
-        for tile_no in xrange(len(self.tiling)):
-            self._cache.setTileDirtyAll(tile_no, True)
+        self._cancelHiddenRequests()
+        self._cache.updateShown()
+        self._cache.setTileDirtyAll(slice(None), True)
         self.sceneRectChanged.emit(QRectF())
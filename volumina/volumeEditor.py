@@ -45,6 +45,15 @@ class VolumeEditor( QObject ):
             s.showTileOutlines = show
         self._showDebugPatches = show
 
+    @property
+    def showMetrics(self):
+        return self._showMetrics
+    @showMetrics.setter
+    def showMetrics(self, show):
+        for s in self.imageScenes:
+            s.showMetrics = show
+        self._showMetrics = show
+
     @property
     def showTileProgress(self):
         return self._showTileProgress
@@ -63,6 +72,14 @@ class VolumeEditor( QObject ):
         for s in self.imageScenes:
             s.setCacheSize(cache_size)
 
+    @property
+    def cacheMemory(self):
+        return self.imageScenes[0].cacheMemory()
+    @cacheMemory.setter
+    def cacheMemory(self, nbytes):
+        for s in self.imageScenes:
+            s.setCacheMemory(nbytes)
+
     @property
     def navigationInterpreterType(self):
         return type(self.navInterpret)
@@ -120,6 +137,7 @@ class VolumeEditor( QObject ):
         ##
         self._showDebugPatches   = False
         self._showTileProgress   = True
+        self._showMetrics        = False
 
         ##
         ## base components
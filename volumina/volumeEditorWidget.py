@@ -385,6 +385,13 @@ class VolumeEditorWidget(QWidget):
         actionUsePrefetching.setCheckable(True)
         actionUsePrefetching.toggled.connect(enablePrefetching)
 
+        def enableLevelOfDetail( enable ):
+            for scene in self.editor.imageScenes:
+                scene.setLevelOfDetailEnabled( enable )
+        actionUseLevelOfDetail = self._viewMenu.addAction( "Use level of detail" )
+        actionUseLevelOfDetail.setCheckable(True)
+        actionUseLevelOfDetail.toggled.connect(enableLevelOfDetail)
+
         def blockGuiForRendering():
             for v in self.editor.imageViews:
                 v.scene().joinRenderingAllTiles()